@@ -0,0 +1,106 @@
+"""
+Контроль допуска задач в очередь генерации.
+
+Если очередь слишком длинная или новая задача будет ждать дольше допустимого,
+задача не принимается: сервер отвечает 429 с заголовком Retry-After вместо того,
+чтобы копить задержку, которую клиент все равно не дождется.
+
+Ожидание оценивается как число задач впереди, деленное на скорость разбора
+очереди (завершенных задач в секунду за последнюю минуту). Задача interactive
+обгоняет prefetch, поэтому для нее впереди только interactive задачи. Пакет
+задач оценивается по ожиданию его первой задачи: остальные разбираются по мере
+работы обработчиков, и большой пакет не должен отклоняться при пустой очереди.
+"""
+import math
+import threading
+
+from task_queue import PRIORITY_INTERACTIVE
+
+DEFAULT_MAX_DEPTH = 500
+DEFAULT_MAX_WAIT = 120.0
+# Retry-After, если скорость разбора еще неизвестна (ни одна задача не завершилась)
+DEFAULT_RETRY_AFTER = 5
+
+REASON_DEPTH = "queue_depth"
+REASON_WAIT = "estimated_wait"
+# Пакет больше, чем вмещает очередь: повтор не поможет, Retry-After не отправляется
+REASON_BATCH_SIZE = "batch_size"
+
+
+class AdmissionRejected(Exception):
+    """retry_after - через сколько секунд повторить запрос; None, если запрос не будет принят никогда"""
+
+    def __init__(self, reason, retry_after, depth, estimated_wait):
+        self.reason = reason
+        self.retry_after = retry_after
+        self.depth = depth
+        self.estimated_wait = estimated_wait
+        if retry_after is None:
+            super().__init__(f"Запрос не может быть принят ({reason})")
+        else:
+            super().__init__(f"Очередь перегружена ({reason}), повторите через {retry_after} сек")
+
+
+def tasks_ahead(depth, priority):
+    """Сколько задач из очереди будет выдано раньше новой задачи с этим приоритетом"""
+    if priority == PRIORITY_INTERACTIVE:
+        return depth.get(PRIORITY_INTERACTIVE, 0)
+    return sum(depth.values())
+
+
+class AdmissionController:
+    def __init__(self, max_depth=DEFAULT_MAX_DEPTH, max_wait=DEFAULT_MAX_WAIT):
+        """max_depth - максимум задач в очереди, max_wait - максимум ожидания в секундах (0 - без ограничения)"""
+        self.max_depth = max_depth
+        self.max_wait = max_wait
+
+        self._lock = threading.Lock()
+        self.admitted = 0
+        self.rejected = {REASON_DEPTH: 0, REASON_WAIT: 0, REASON_BATCH_SIZE: 0}
+
+    def estimated_wait(self, ahead, drain_rate):
+        """Оценка ожидания в секундах; None, если скорость разбора неизвестна"""
+        return ahead / drain_rate if drain_rate > 0 else None
+
+    def admit(self, depth, drain_rate, priority, count=1):
+        """
+        Проверяет, можно ли поставить в очередь count задач с приоритетом priority.
+        depth - глубина очереди по приоритетам. Возвращает оценку ожидания первой
+        задачи; выбрасывает AdmissionRejected.
+        """
+        total = sum(depth.values())
+        ahead = tasks_ahead(depth, priority)
+        # Ожидание первой задачи пакета (включая ее собственное выполнение)
+        wait = self.estimated_wait(ahead + 1, drain_rate)
+
+        reason = None
+        retry_after = None
+        if self.max_depth and count > self.max_depth:
+            reason = REASON_BATCH_SIZE
+        elif self.max_depth and total + count > self.max_depth:
+            reason = REASON_DEPTH
+            # Ждем, пока очередь разберется до лимита
+            excess = total + count - self.max_depth
+            retry_after = excess / drain_rate if drain_rate > 0 else DEFAULT_RETRY_AFTER
+        elif self.max_wait and ahead > 0 and wait is not None and wait > self.max_wait:
+            # Если впереди никого нет, задача принимается при любой скорости разбора
+            reason = REASON_WAIT
+            retry_after = min(wait - self.max_wait, ahead / drain_rate)
+
+        with self._lock:
+            if reason is None:
+                self.admitted += count
+                return wait
+            self.rejected[reason] += 1
+        if retry_after is not None:
+            retry_after = max(1, math.ceil(retry_after))
+        raise AdmissionRejected(reason, retry_after, total, wait)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "max_depth": self.max_depth,
+                "max_wait": self.max_wait,
+                "admitted": self.admitted,
+                "rejected": dict(self.rejected)
+            }
@@ -0,0 +1,223 @@
+"""
+Пакетная генерация упражнений: несколько слов упаковываются в один запрос к LM.
+
+Длинный системный промпт и задержка одного вызова делятся на всю колоду,
+а модель возвращает JSON-массив, каждый элемент которого проверяется отдельно.
+Слова, для которых элемент не прошёл проверку, генерируются повторно по одному.
+"""
+import json
+import logging
+import re
+
+# Сколько слов упаковывать в один запрос к модели
+DEFAULT_BATCH_SIZE = 8
+# Примерный бюджет токенов на одно упражнение в пакетном ответе
+TOKENS_PER_EXERCISE = 220
+
+REQUIRED_FIELDS = ["sentence_with_gap", "pinyin", "translation", "options", "answer"]
+
+BATCH_SYSTEM_PROMPT = """Ты помощник для изучения китайского языка. Твоя задача - создавать упражнения в формате JSON.
+
+⚠️⚠️⚠️ КРИТИЧЕСКИ ВАЖНО: ⚠️⚠️⚠️
+1. Возвращай ТОЛЬКО чистый валидный JSON-массив, НЕ оборачивая его в тройные обратные кавычки.
+2. НЕ используй никаких Markdown форматирований (```json, ``` и т.д.)
+3. Используй ТОЛЬКО прямые двойные кавычки (") для ключей и значений JSON.
+4. Убедись, что все ключи и строковые значения обрамлены двойными кавычками.
+5. НЕ включай никакого вступительного или заключительного текста.
+6. ТОЛЬКО JSON, ничего больше."""
+
+
+def build_batch_prompt(words, hsk_level, system_language):
+    """Формирует пользовательский промпт для генерации упражнений сразу для нескольких слов"""
+    word_list = "\n".join(f"- {word}" for word in words)
+    return f"""Ты генератор учебных упражнений по китайскому языку. Вот твоя задача:
+
+На вход ты получаешь:
+- список китайских слов (всего {len(words)}):
+{word_list}
+- уровень сложности HSK (от 1 до 9+): {hsk_level}
+- системный язык пользователя: {system_language}
+
+Для КАЖДОГО слова из списка генерируй отдельное упражнение по следующей структуре:
+
+1. Составь одно естественное китайское предложение, в котором органично используется это слово. Тематика — на твоё усмотрение.
+2. Сделай версию этого же предложения с пропущенным словом (замени слово на '____').
+3. Предложи четыре варианта ответа: один правильный (то самое слово) и три лексически близких, но по смыслу в этом предложении неподходящих.
+4. Приведи полную версию предложения с пиньинем.
+5. Приведи перевод предложения на {system_language}.
+
+⚠️ КРИТИЧЕСКИ ВАЖНЫЕ ТРЕБОВАНИЯ К ФОРМАТУ ОТВЕТА:
+
+1. Ответ должен быть СТРОГО JSON-массивом из {len(words)} объектов и НИЧЕГО кроме JSON.
+2. Порядок объектов должен совпадать с порядком слов в списке.
+3. В каждом объекте обязательно поле "word" с исходным словом.
+4. НЕ добавляй пояснений, комментариев или любого другого текста до или после JSON.
+
+Формат возвращаемого JSON-ответа (соблюдай его точно):
+
+[
+  {{
+    "word": "...",
+    "sentence_with_gap": "...",
+    "pinyin": "...",
+    "translation": "...",
+    "options": ["...", "...", "...", "..."],
+    "answer": "..."
+  }}
+]"""
+
+
+def build_batch_messages(words, hsk_level, system_language):
+    """Сообщения для chat completion с пакетным промптом"""
+    return [
+        {"role": "system", "content": BATCH_SYSTEM_PROMPT},
+        {"role": "user", "content": build_batch_prompt(words, hsk_level, system_language)}
+    ]
+
+
+def extract_json_array(content):
+    """Извлекает первый JSON-массив верхнего уровня из ответа модели"""
+    # Убираем обёртку Markdown, если модель её всё-таки добавила
+    content = re.sub(r'```[\w]*\s*|\s*```', '', content)
+    content = content.replace('“', '"').replace('”', '"')
+
+    start = content.find('[')
+    if start < 0:
+        return None
+
+    # Ищем парную закрывающую скобку с учётом строк
+    depth = 0
+    in_string = False
+    escaped = False
+    for i in range(start, len(content)):
+        char = content[i]
+        if in_string:
+            if escaped:
+                escaped = False
+            elif char == '\\':
+                escaped = True
+            elif char == '"':
+                in_string = False
+            continue
+        if char == '"':
+            in_string = True
+        elif char == '[':
+            depth += 1
+        elif char == ']':
+            depth -= 1
+            if depth == 0:
+                array_str = re.sub(r',(\s*[\]}])', r'\1', content[start:i + 1])
+                try:
+                    parsed = json.loads(array_str)
+                except json.JSONDecodeError as e:
+                    logging.warning(f"Не удалось разобрать JSON-массив пакетного ответа: {e}")
+                    return None
+                return parsed if isinstance(parsed, list) else None
+
+    logging.warning("JSON-массив в пакетном ответе не закрыт (ответ обрезан?)")
+    return None
+
+
+def check_exercise(exercise, word):
+    """Проверяет один элемент пакетного ответа. Возвращает причину отказа или None"""
+    if not isinstance(exercise, dict):
+        return "элемент не является объектом"
+
+    missing = [field for field in REQUIRED_FIELDS if not exercise.get(field)]
+    if missing:
+        return f"отсутствуют поля: {', '.join(missing)}"
+
+    options = exercise["options"]
+    if not isinstance(options, list) or len(options) < 2:
+        return "некорректный список вариантов"
+    if word not in options:
+        return "правильный ответ отсутствует в вариантах"
+    if any(not isinstance(opt, str) or opt.startswith("选项") for opt in options):
+        return "варианты содержат заглушки"
+    if exercise["answer"] != word:
+        return "ответ не совпадает с исходным словом"
+    if "____" not in exercise["sentence_with_gap"]:
+        return "в предложении отсутствует пропуск ____"
+    return None
+
+
+def parse_batch_response(content, words):
+    """
+    Разбирает пакетный ответ модели.
+
+    Возвращает (exercises, failed): словарь слово -> упражнение для прошедших
+    проверку элементов и список слов, которые нужно сгенерировать повторно.
+    """
+    items = extract_json_array(content or "")
+    if items is None:
+        return {}, list(words)
+
+    by_word = {}
+    unmatched = []
+    for item in items:
+        key = (item.get("word") or item.get("answer")) if isinstance(item, dict) else None
+        if key in words and key not in by_word:
+            by_word[key] = item
+        else:
+            unmatched.append(item)
+
+    # Элементы без распознанного слова сопоставляем по позиции
+    if unmatched and len(items) == len(words):
+        for index, word in enumerate(words):
+            if word not in by_word and items[index] in unmatched:
+                by_word[word] = items[index]
+
+    exercises = {}
+    failed = []
+    for word in words:
+        item = by_word.get(word)
+        reason = check_exercise(item, word) if item is not None else "нет элемента для слова"
+        if reason:
+            logging.warning(f"Пакетное упражнение для '{word}' отклонено: {reason}")
+            failed.append(word)
+            continue
+        exercise = {field: item[field] for field in REQUIRED_FIELDS}
+        if item.get("sentence"):
+            exercise["sentence"] = item["sentence"]
+        exercises[word] = exercise
+
+    return exercises, failed
+
+
+def generate_batch(words, hsk_level, system_language, complete, generate_single,
+                   batch_size=DEFAULT_BATCH_SIZE, temperature=0.7):
+    """
+    Генерирует упражнения для списка слов пакетами.
+
+    complete(messages, temperature, max_tokens) -> str выполняет один запрос к LM,
+    generate_single(word) -> dict генерирует упражнение для одного слова и
+    используется только для слов, не прошедших проверку в пакете.
+
+    Возвращает (exercises, stats), где exercises упорядочены как words.
+    """
+    results = {}
+    stats = {"words": len(words), "lm_batch_calls": 0, "batched": 0, "regenerated": 0}
+
+    for offset in range(0, len(words), batch_size):
+        chunk = words[offset:offset + batch_size]
+        messages = build_batch_messages(chunk, hsk_level, system_language)
+        max_tokens = TOKENS_PER_EXERCISE * len(chunk)
+
+        try:
+            stats["lm_batch_calls"] += 1
+            content = complete(messages, temperature, max_tokens)
+            exercises, failed = parse_batch_response(content, chunk)
+        except Exception as e:
+            logging.error(f"Ошибка пакетной генерации для {chunk}: {str(e)}", exc_info=True)
+            exercises, failed = {}, list(chunk)
+
+        logging.info(f"Пакет из {len(chunk)} слов: принято {len(exercises)}, на повторную генерацию {len(failed)}")
+        results.update(exercises)
+        stats["batched"] += len(exercises)
+
+        # Повторно генерируем только слова с отклонёнными элементами
+        for word in failed:
+            results[word] = generate_single(word)
+            stats["regenerated"] += 1
+
+    return [results[word] for word in words], stats
@@ -0,0 +1,173 @@
+"""
+Кэш эмбеддингов вариантов ответов для оценки дистракторов.
+
+Одни и те же слова HSK постоянно встречаются в вариантах ответов, поэтому
+эмбеддинг слова считается моделью один раз. Кэш двухуровневый:
+
+1. LRU в памяти - недавно использованные эмбеддинги (float32);
+2. матрица float16 на диске (.npy), которая при запуске отображается в память
+   (memmap) и читается по строкам без загрузки целиком; индекс слов хранится
+   рядом в JSON.
+
+Новые эмбеддинги накапливаются в памяти и дописываются в матрицу пачками
+(flush) - файл перезаписывается атомарно. Кэш привязан к модели: если модель
+изменилась, дисковая часть не используется.
+"""
+import json
+import logging
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+DEFAULT_MAX_MEMORY_ENTRIES = 20000
+# Сколько новых эмбеддингов накапливается перед записью на диск
+DEFAULT_FLUSH_EVERY = 256
+
+
+class OptionEmbeddingCache:
+    def __init__(self, path, model_name, max_memory_entries=DEFAULT_MAX_MEMORY_ENTRIES,
+                 flush_every=DEFAULT_FLUSH_EVERY):
+        """path - путь без расширения: матрица хранится в path.npy, индекс в path.json"""
+        self.matrix_path = path + ".npy"
+        self.index_path = path + ".json"
+        self.model_name = model_name
+        self.max_memory_entries = max_memory_entries
+        self.flush_every = flush_every
+
+        self._lock = threading.Lock()
+        self._memory = OrderedDict()
+        # Эмбеддинги, которых еще нет в файле
+        self._pending = {}
+        self._disk_index = {}
+        self._matrix = None
+        self.dim = None
+
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+        self._load()
+
+    def _load(self):
+        if not (os.path.exists(self.matrix_path) and os.path.exists(self.index_path)):
+            return
+        try:
+            with open(self.index_path, encoding="utf-8") as f:
+                index = json.load(f)
+            if index.get("model_name") != self.model_name:
+                logging.warning(f"Кэш эмбеддингов создан для модели {index.get('model_name')}, "
+                                f"текущая модель {self.model_name}: кэш не используется")
+                return
+            matrix = np.load(self.matrix_path, mmap_mode="r")
+            words = index["words"]
+            if matrix.shape[0] != len(words):
+                logging.warning("Размер матрицы эмбеддингов не совпадает с индексом: кэш не используется")
+                return
+            self._matrix = matrix
+            self._disk_index = {word: row for row, word in enumerate(words)}
+            self.dim = matrix.shape[1]
+            logging.info(f"Кэш эмбеддингов вариантов загружен: {len(words)} слов ({self.matrix_path})")
+        except Exception as e:
+            logging.error(f"Не удалось загрузить кэш эмбеддингов: {str(e)}")
+
+    def _remember(self, word, vector):
+        self._memory[word] = vector
+        self._memory.move_to_end(word)
+        while len(self._memory) > self.max_memory_entries:
+            self._memory.popitem(last=False)
+
+    def get_many(self, words):
+        """Эмбеддинги известных слов: возвращает (слово -> вектор float32, список отсутствующих слов)"""
+        found = {}
+        missing = []
+        with self._lock:
+            for word in words:
+                vector = self._memory.get(word)
+                if vector is not None:
+                    self._memory.move_to_end(word)
+                    self.memory_hits += 1
+                elif word in self._pending:
+                    vector = self._pending[word]
+                    self._remember(word, vector)
+                    self.memory_hits += 1
+                elif word in self._disk_index:
+                    vector = np.asarray(self._matrix[self._disk_index[word]], dtype=np.float32)
+                    self._remember(word, vector)
+                    self.disk_hits += 1
+                else:
+                    self.misses += 1
+                    missing.append(word)
+                    continue
+                found[word] = vector
+        return found, missing
+
+    def put_many(self, vectors):
+        """Добавляет эмбеддинги (слово -> вектор); при накоплении flush_every новых записывает их на диск"""
+        with self._lock:
+            for word, vector in vectors.items():
+                vector = np.asarray(vector, dtype=np.float32)
+                if self.dim is None:
+                    self.dim = vector.shape[0]
+                self._remember(word, vector)
+                if word not in self._disk_index:
+                    self._pending[word] = vector
+            should_flush = len(self._pending) >= self.flush_every
+        if should_flush:
+            self.flush()
+
+    def flush(self):
+        """Дописывает новые эмбеддинги в матрицу на диске (файл заменяется атомарно)"""
+        with self._lock:
+            if not self._pending:
+                return
+            pending_words = list(self._pending)
+            new_rows = np.stack([self._pending[word] for word in pending_words]).astype(np.float16)
+            words = [None] * len(self._disk_index)
+            for word, row in self._disk_index.items():
+                words[row] = word
+            if self._matrix is not None:
+                matrix = np.concatenate([np.asarray(self._matrix), new_rows])
+            else:
+                matrix = new_rows
+            words += pending_words
+
+            try:
+                directory = os.path.dirname(self.matrix_path)
+                if directory:
+                    os.makedirs(directory, exist_ok=True)
+                # np.save сам добавляет .npy, поэтому временный файл тоже оканчивается на .npy
+                tmp_matrix = self.matrix_path[:-len(".npy")] + ".tmp.npy"
+                np.save(tmp_matrix, matrix)
+                tmp_index = self.index_path + ".tmp"
+                with open(tmp_index, "w", encoding="utf-8") as f:
+                    json.dump({"model_name": self.model_name, "dim": int(matrix.shape[1]), "words": words},
+                              f, ensure_ascii=False)
+                # Отображение старого файла закрывается до замены (в Windows открытый файл не заменить)
+                self._matrix = None
+                os.replace(tmp_matrix, self.matrix_path)
+                os.replace(tmp_index, self.index_path)
+            except Exception as e:
+                logging.error(f"Не удалось сохранить кэш эмбеддингов: {str(e)}")
+                if self._disk_index and os.path.exists(self.matrix_path):
+                    self._matrix = np.load(self.matrix_path, mmap_mode="r")
+                return
+
+            self._matrix = np.load(self.matrix_path, mmap_mode="r")
+            self._disk_index = {word: row for row, word in enumerate(words)}
+            self._pending = {}
+            logging.info(f"Кэш эмбеддингов вариантов сохранен: {len(words)} слов")
+
+    def stats(self):
+        with self._lock:
+            lookups = self.memory_hits + self.disk_hits + self.misses
+            return {
+                "memory_entries": len(self._memory),
+                "disk_entries": len(self._disk_index),
+                "pending": len(self._pending),
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": (self.memory_hits + self.disk_hits) / lookups if lookups else 0.0
+            }
@@ -0,0 +1,126 @@
+"""
+JSON-схема упражнения для генерации с ограничением формата (response_format)
+и быстрый строгий разбор ответа модели.
+
+Если модель вернула JSON по схеме, ответ разбирается с первой попытки;
+каскад восстановления (extract_exercise_data / safe_json_parse) остаётся
+только запасным путём, и каждое его использование учитывается в статистике.
+"""
+import json
+import logging
+import threading
+
+REQUIRED_FIELDS = ["sentence_with_gap", "pinyin", "translation", "options", "answer"]
+
+EXERCISE_JSON_SCHEMA = {
+    "type": "object",
+    "properties": {
+        # Полное предложение без пропуска (его запрашивает промпт app/main.py)
+        "sentence": {"type": "string"},
+        "sentence_with_gap": {"type": "string"},
+        "pinyin": {"type": "string"},
+        "translation": {"type": "string"},
+        "options": {
+            "type": "array",
+            "items": {"type": "string"},
+            "minItems": 4,
+            "maxItems": 4
+        },
+        "answer": {"type": "string"}
+    },
+    "required": REQUIRED_FIELDS,
+    "additionalProperties": False
+}
+
+
+def exercise_response_format(with_sentence=False):
+    """
+    Параметр response_format для OpenAI-совместимого API LM Studio.
+    with_sentence=True делает обязательным поле sentence (полное предложение).
+    """
+    schema = EXERCISE_JSON_SCHEMA
+    if with_sentence:
+        schema = dict(schema, required=["sentence"] + REQUIRED_FIELDS)
+    return {
+        "type": "json_schema",
+        "json_schema": {
+            "name": "exercise",
+            "strict": True,
+            "schema": schema
+        }
+    }
+
+
+def is_response_format_rejected(error):
+    """
+    Отклонил ли сервер именно параметр response_format. Другие ошибки 400
+    (например, слишком длинный запрос) не должны отключать структурированный вывод.
+    """
+    message = str(error).lower()
+    return getattr(error, "status_code", None) == 400 and (
+        "response_format" in message or "json_schema" in message
+    )
+
+
+def parse_exercise_strict(content, original_word):
+    """
+    Строгий разбор ответа: только json.loads и проверка структуры.
+    Возвращает упражнение или None, если нужен каскад восстановления.
+    """
+    try:
+        data = json.loads(content.strip())
+    except (json.JSONDecodeError, AttributeError):
+        return None
+
+    if not isinstance(data, dict):
+        return None
+    if any(not isinstance(data.get(field), (str, list)) for field in REQUIRED_FIELDS):
+        return None
+
+    options = data["options"]
+    if not isinstance(options, list) or not all(isinstance(opt, str) for opt in options):
+        return None
+    if original_word not in options or "____" not in data["sentence_with_gap"]:
+        return None
+
+    data["answer"] = original_word
+    return data
+
+
+class ParseStats:
+    """Счётчики путей разбора ответов модели"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.strict = 0
+        self.repaired = 0
+        self.schema_rejected = 0
+
+    def record(self, path):
+        with self._lock:
+            setattr(self, path, getattr(self, path) + 1)
+
+    def stats(self):
+        with self._lock:
+            parsed = self.strict + self.repaired
+            return {
+                "strict": self.strict,
+                "repaired": self.repaired,
+                "schema_rejected": self.schema_rejected,
+                "repair_rate": self.repaired / parsed if parsed else 0.0
+            }
+
+
+def parse_exercise(content, original_word, repair, parse_stats):
+    """
+    Разбирает ответ модели: сначала строго, затем через функцию repair(content, word).
+    Использование запасного пути учитывается в parse_stats.
+    """
+    exercise = parse_exercise_strict(content, original_word)
+    if exercise is not None:
+        parse_stats.record("strict")
+        return exercise
+
+    logging.warning(f"Ответ для '{original_word}' не соответствует схеме, используем восстановление JSON")
+    parse_stats.record("repaired")
+    return repair(content, original_word)
@@ -0,0 +1,211 @@
+"""
+Хранилище сгенерированных упражнений: ограниченный LRU в памяти процесса
+и SQLite-файл для долговременного хранения.
+
+Ключ упражнения - (word, hsk_level, system_language, prompt_version), поэтому
+смена промпта автоматически делает старые записи недоступными.
+
+Счётчики обращений копятся в памяти и записываются в SQLite пакетом раз в
+HIT_FLUSH_INTERVAL секунд отдельным соединением, поэтому попадание в LRU
+не ждет записи на диск.
+"""
+import atexit
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+DEFAULT_STORE_PATH = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data", "exercises.sqlite3"
+)
+# Как часто накопленные счётчики обращений записываются в SQLite
+HIT_FLUSH_INTERVAL = 5.0
+
+
+class ExerciseStore:
+    def __init__(self, db_path=None, prompt_version="v1", capacity=1000):
+        self.db_path = db_path or os.environ.get("EXERCISE_STORE_PATH", DEFAULT_STORE_PATH)
+        self.prompt_version = prompt_version
+        self.capacity = capacity
+
+        # LRU хранит сериализованный JSON, чтобы вызывающий код не мог изменить кэш
+        self._lru = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.writes = 0
+        # key -> (число обращений, время последнего) с момента последней записи в SQLite
+        self._pending_hits = {}
+
+        directory = os.path.dirname(self.db_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self._conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS exercises (
+                word TEXT NOT NULL,
+                hsk_level TEXT NOT NULL,
+                system_language TEXT NOT NULL,
+                prompt_version TEXT NOT NULL,
+                exercise TEXT NOT NULL,
+                hits INTEGER NOT NULL DEFAULT 0,
+                created_at REAL NOT NULL,
+                last_access REAL NOT NULL,
+                PRIMARY KEY (word, hsk_level, system_language, prompt_version)
+            )
+        """)
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_exercises_hits ON exercises (prompt_version, hits DESC)"
+        )
+        self._conn.commit()
+
+        # Отдельное соединение для записи счётчиков: в режиме WAL она не мешает чтению
+        self._flush_conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        self._flush_lock = threading.Lock()
+        self._closed = threading.Event()
+        self._flusher = threading.Thread(target=self._flush_loop, name="exercise-store-hits", daemon=True)
+        self._flusher.start()
+        atexit.register(self.flush_hits)
+        logging.info(f"Хранилище упражнений открыто: {self.db_path} (LRU: {capacity}, промпт: {prompt_version})")
+
+    def _key(self, word, hsk_level, system_language):
+        return (str(word), str(hsk_level), str(system_language), self.prompt_version)
+
+    def _remember(self, key, payload):
+        """Помещает запись в LRU и вытесняет самые старые записи сверх лимита"""
+        self._lru[key] = payload
+        self._lru.move_to_end(key)
+        while len(self._lru) > self.capacity:
+            self._lru.popitem(last=False)
+
+    def get(self, word, hsk_level, system_language):
+        """Возвращает копию сохранённого упражнения или None"""
+        key = self._key(word, hsk_level, system_language)
+        now = time.time()
+        with self._lock:
+            payload = self._lru.get(key)
+            if payload is not None:
+                self._lru.move_to_end(key)
+                self.memory_hits += 1
+            else:
+                row = self._conn.execute(
+                    "SELECT exercise FROM exercises WHERE word=? AND hsk_level=? AND system_language=? AND prompt_version=?",
+                    key
+                ).fetchone()
+                if row is None:
+                    self.misses += 1
+                    return None
+                payload = row[0]
+                self._remember(key, payload)
+                self.disk_hits += 1
+
+            # Счётчик обращений нужен для прогрева самых популярных ключей
+            hits, _ = self._pending_hits.get(key, (0, now))
+            self._pending_hits[key] = (hits + 1, now)
+        return json.loads(payload)
+
+    def put(self, word, hsk_level, system_language, exercise):
+        """Сохраняет упражнение в LRU и в SQLite"""
+        key = self._key(word, hsk_level, system_language)
+        payload = json.dumps(exercise, ensure_ascii=False)
+        now = time.time()
+        with self._lock:
+            self._remember(key, payload)
+            self._conn.execute(
+                "INSERT INTO exercises (word, hsk_level, system_language, prompt_version, exercise, hits, created_at, last_access) "
+                "VALUES (?, ?, ?, ?, ?, 0, ?, ?) "
+                "ON CONFLICT (word, hsk_level, system_language, prompt_version) "
+                "DO UPDATE SET exercise = excluded.exercise, created_at = excluded.created_at",
+                key + (payload, now, now)
+            )
+            self._conn.commit()
+            self.writes += 1
+
+    def contains(self, word, hsk_level, system_language):
+        """Проверяет наличие упражнения без изменения счётчиков попаданий"""
+        key = self._key(word, hsk_level, system_language)
+        with self._lock:
+            if key in self._lru:
+                return True
+            row = self._conn.execute(
+                "SELECT 1 FROM exercises WHERE word=? AND hsk_level=? AND system_language=? AND prompt_version=?",
+                key
+            ).fetchone()
+        return row is not None
+
+    def flush_hits(self):
+        """Записывает накопленные счётчики обращений в SQLite одной транзакцией"""
+        with self._lock:
+            pending, self._pending_hits = self._pending_hits, {}
+        if not pending:
+            return 0
+        with self._flush_lock:
+            if self._closed.is_set():
+                return 0
+            self._flush_conn.executemany(
+                "UPDATE exercises SET hits = hits + ?, last_access = MAX(last_access, ?) "
+                "WHERE word=? AND hsk_level=? AND system_language=? AND prompt_version=?",
+                [(hits, last_access) + key for key, (hits, last_access) in pending.items()]
+            )
+            self._flush_conn.commit()
+        return len(pending)
+
+    def _flush_loop(self):
+        while not self._closed.wait(HIT_FLUSH_INTERVAL):
+            try:
+                self.flush_hits()
+            except Exception as e:
+                logging.error(f"Не удалось записать счётчики обращений хранилища: {str(e)}")
+
+    def warm_up(self, limit=None):
+        """Загружает в LRU самые востребованные упражнения текущей версии промпта"""
+        self.flush_hits()
+        limit = min(limit or self.capacity, self.capacity)
+        start_time = time.time()
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT word, hsk_level, system_language, prompt_version, exercise FROM exercises "
+                "WHERE prompt_version=? ORDER BY hits DESC, last_access DESC LIMIT ?",
+                (self.prompt_version, limit)
+            ).fetchall()
+            # Загружаем от менее популярных к более популярным, чтобы самые горячие оказались в конце LRU
+            for word, hsk_level, system_language, prompt_version, payload in reversed(rows):
+                self._remember((word, hsk_level, system_language, prompt_version), payload)
+        logging.info(f"Прогрев хранилища упражнений: загружено {len(rows)} записей за {time.time() - start_time:.3f} сек")
+        return len(rows)
+
+    def stats(self):
+        """Статистика попаданий и размера хранилища"""
+        with self._lock:
+            stored = self._conn.execute(
+                "SELECT COUNT(*) FROM exercises WHERE prompt_version=?", (self.prompt_version,)
+            ).fetchone()[0]
+            hits = self.memory_hits + self.disk_hits
+            total = hits + self.misses
+            return {
+                "prompt_version": self.prompt_version,
+                "lru_size": len(self._lru),
+                "lru_capacity": self.capacity,
+                "stored": stored,
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "writes": self.writes,
+                "hit_rate": hits / total if total else 0.0
+            }
+
+    def close(self):
+        self.flush_hits()
+        with self._flush_lock:
+            self._closed.set()
+            self._flush_conn.close()
+        with self._lock:
+            self._conn.close()
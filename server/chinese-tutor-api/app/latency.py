@@ -0,0 +1,47 @@
+"""
+Оценка длительности этапов обработки задачи.
+
+Для каждого этапа (генерация в LM Studio, валидация BERT) хранится
+экспоненциальное скользящее среднее (EWMA) недавних длительностей: оно быстро
+следует за изменением нагрузки и не требует хранить историю. По сумме средних
+оценивается время выполнения задачи и время ожидания в очереди.
+"""
+import threading
+
+STAGE_GENERATION = "generation"
+STAGE_VALIDATION = "validation"
+
+# Вес нового измерения в скользящем среднем
+DEFAULT_ALPHA = 0.2
+
+
+class DurationEstimator:
+    def __init__(self, alpha=DEFAULT_ALPHA):
+        self.alpha = alpha
+        self._lock = threading.Lock()
+        # этап -> {"mean", "last", "samples"}
+        self._stages = {}
+
+    def record(self, stage, seconds):
+        with self._lock:
+            entry = self._stages.get(stage)
+            if entry is None:
+                # Первое измерение становится начальным значением среднего
+                self._stages[stage] = {"mean": seconds, "last": seconds, "samples": 1}
+                return
+            entry["mean"] += self.alpha * (seconds - entry["mean"])
+            entry["last"] = seconds
+            entry["samples"] += 1
+
+    def mean(self, stage):
+        """Средняя длительность этапа в секундах; None, если измерений еще нет"""
+        with self._lock:
+            entry = self._stages.get(stage)
+            return entry["mean"] if entry is not None else None
+
+    def stats(self):
+        with self._lock:
+            return {
+                "alpha": self.alpha,
+                "stages": {stage: dict(entry) for stage, entry in self._stages.items()}
+            }
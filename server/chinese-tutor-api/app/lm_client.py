@@ -0,0 +1,203 @@
+"""
+Асинхронный клиент OpenAI-совместимого API LM Studio с общим пулом keep-alive соединений.
+
+Клиент работает в собственном event loop в фоновом потоке, поэтому
+синхронный код Flask может как дождаться результата (run), так и
+запустить десятки запросов одновременно (submit / asyncio.gather)
+без отдельного потока ОС на каждый запрос.
+"""
+import asyncio
+import json
+import logging
+import queue
+import threading
+
+import httpx
+
+
+class LMRequestError(Exception):
+    """Ошибка ответа LM Studio (код статуса, отличный от 200)"""
+
+    def __init__(self, message, status_code=None):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+_STREAM_DONE = object()
+
+
+class LoopRunner:
+    """
+    Собственный event loop в фоновом потоке и синхронные обертки над ним.
+    Наследник должен реализовать асинхронный генератор stream_chat_completion.
+    """
+
+    def _start_loop(self, name):
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._run_loop, name=name, daemon=True)
+        self._thread.start()
+
+    def _run_loop(self):
+        asyncio.set_event_loop(self._loop)
+        self._loop.run_forever()
+
+    def _stop_loop(self, timeout=5.0):
+        if self._thread is not None:
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join(timeout)
+
+    def submit(self, coro):
+        """Запускает корутину в event loop клиента и возвращает concurrent.futures.Future"""
+        return asyncio.run_coroutine_threadsafe(coro, self._loop)
+
+    def run(self, coro, timeout=None):
+        """Выполняет корутину в event loop клиента и ждёт результата"""
+        return self.submit(coro).result(timeout)
+
+    def iter_stream(self, payload, timeout=None):
+        """Синхронный итератор поверх stream_chat_completion для потоков Flask"""
+        chunks = queue.Queue()
+
+        async def pump():
+            try:
+                async for delta in self.stream_chat_completion(payload, timeout):
+                    chunks.put(delta)
+            except Exception as e:
+                chunks.put(e)
+            finally:
+                chunks.put(_STREAM_DONE)
+
+        future = self.submit(pump())
+        try:
+            while True:
+                item = chunks.get()
+                if item is _STREAM_DONE:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            # Клиент отключился раньше времени - прерываем запрос к LM Studio
+            future.cancel()
+
+
+class AsyncLMClient(LoopRunner):
+    def __init__(self, base_url, max_connections=32, max_keepalive_connections=16,
+                 keepalive_expiry=30.0, connect_timeout=5.0, default_timeout=90.0, loop=None):
+        """
+        loop - event loop, запущенный в другом потоке (например, общий loop маршрутизатора);
+        если не указан, клиент запускает собственный.
+        """
+        self.base_url = base_url.rstrip('/')
+        self.default_timeout = default_timeout
+        self.max_connections = max_connections
+
+        self.requests_total = 0
+        self.errors_total = 0
+        self.in_flight = 0
+        self._stats_lock = threading.Lock()
+
+        if loop is None:
+            self._start_loop("lm-client-loop")
+        else:
+            self._loop = loop
+            self._thread = None
+
+        limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive_connections,
+            keepalive_expiry=keepalive_expiry
+        )
+        timeout = httpx.Timeout(default_timeout, connect=connect_timeout)
+        # trust_env=False: системные настройки прокси мешают доступу к LM Studio в локальной сети
+        self._client = self.run(self._create_client(limits, timeout))
+        logging.info(f"Пул соединений LM Studio создан: {self.base_url} (макс. соединений: {max_connections})")
+
+    async def _create_client(self, limits, timeout):
+        return httpx.AsyncClient(base_url=self.base_url, limits=limits, timeout=timeout, trust_env=False)
+
+    def _track(self, delta, error=False):
+        with self._stats_lock:
+            self.in_flight += delta
+            if delta > 0:
+                self.requests_total += 1
+            if error:
+                self.errors_total += 1
+
+    async def list_models(self, timeout=5.0):
+        """Возвращает идентификаторы моделей из /v1/models"""
+        self._track(1)
+        try:
+            response = await self._client.get("/v1/models", timeout=timeout)
+            if response.status_code != 200:
+                raise LMRequestError(f"HTTP {response.status_code}: {response.text[:200]}", response.status_code)
+            return [model.get("id", "unknown") for model in response.json().get("data", [])]
+        except Exception:
+            self._track(0, error=True)
+            raise
+        finally:
+            self._track(-1)
+
+    async def chat_completion(self, payload, timeout=None):
+        """Выполняет chat completion и возвращает JSON-ответ целиком"""
+        self._track(1)
+        try:
+            response = await self._client.post(
+                "/v1/chat/completions", json=payload, timeout=timeout or self.default_timeout
+            )
+            if response.status_code != 200:
+                raise LMRequestError(f"HTTP {response.status_code}: {response.text[:200]}", response.status_code)
+            return response.json()
+        except Exception:
+            self._track(0, error=True)
+            raise
+        finally:
+            self._track(-1)
+
+    async def stream_chat_completion(self, payload, timeout=None):
+        """Асинхронный генератор фрагментов текста потокового chat completion"""
+        payload = dict(payload, stream=True)
+        self._track(1)
+        try:
+            async with self._client.stream(
+                "POST", "/v1/chat/completions", json=payload, timeout=timeout or self.default_timeout
+            ) as response:
+                if response.status_code != 200:
+                    body = await response.aread()
+                    raise LMRequestError(
+                        f"HTTP {response.status_code}: {body[:200].decode('utf-8', 'replace')}",
+                        response.status_code
+                    )
+                async for line in response.aiter_lines():
+                    line = line.strip()
+                    if not line.startswith("data:"):
+                        continue
+                    data = line[len("data:"):].strip()
+                    if data == "[DONE]":
+                        break
+                    choices = json.loads(data).get("choices") or []
+                    delta = choices[0].get("delta", {}).get("content") if choices else None
+                    if delta:
+                        yield delta
+        except Exception:
+            self._track(0, error=True)
+            raise
+        finally:
+            self._track(-1)
+
+    def stats(self):
+        with self._stats_lock:
+            return {
+                "base_url": self.base_url,
+                "max_connections": self.max_connections,
+                "in_flight": self.in_flight,
+                "requests_total": self.requests_total,
+                "errors_total": self.errors_total
+            }
+
+    def close(self, timeout=5.0):
+        """Закрывает соединения и останавливает собственный event loop"""
+        try:
+            self.run(self._client.aclose(), timeout=timeout)
+        finally:
+            self._stop_loop(timeout)
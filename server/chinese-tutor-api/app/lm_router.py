@@ -0,0 +1,271 @@
+"""
+Маршрутизатор запросов между несколькими OpenAI-совместимыми серверами моделей
+(LM Studio, llama.cpp server и т.п.).
+
+Каждый запрос отправляется на сервер с наименьшим числом выполняющихся запросов
+(least outstanding requests) с учетом лимита одновременных запросов на сервер.
+Сервер, несколько раз подряд не ответивший (сетевая ошибка, таймаут, HTTP 5xx),
+исключается из маршрутизации на время EJECTION_TIME; успешный запрос, в том числе
+периодический запрос списка моделей, возвращает его обратно.
+
+Интерфейс совпадает с AsyncLMClient, поэтому маршрутизатор используется вместо
+одиночного клиента без изменений в вызывающем коде.
+"""
+import asyncio
+import logging
+import time
+
+import httpx
+
+from lm_client import AsyncLMClient, LMRequestError, LoopRunner
+
+# Лимит одновременных запросов на сервер по умолчанию
+DEFAULT_MAX_CONCURRENCY = 4
+# После скольких ошибок подряд сервер исключается из маршрутизации
+EJECT_AFTER_FAILURES = 3
+# На сколько секунд исключается сервер
+EJECTION_TIME = 30.0
+
+
+def parse_backend_urls(value):
+    """Список адресов серверов из строки через запятую"""
+    return [url.strip().rstrip('/') for url in (value or "").split(",") if url.strip()]
+
+
+def parse_concurrency(value, count, default=DEFAULT_MAX_CONCURRENCY):
+    """
+    Лимиты одновременных запросов: одно число для всех серверов или список через
+    запятую в порядке адресов (недостающие значения берутся из последнего).
+    """
+    limits = [int(item) for item in (value or "").split(",") if item.strip()] or [default]
+    return [max(1, limits[min(i, len(limits) - 1)]) for i in range(count)]
+
+
+def is_backend_failure(error):
+    """Ошибка говорит о проблеме сервера, а не запроса (4xx не исключают сервер)"""
+    if isinstance(error, LMRequestError):
+        return error.status_code is None or error.status_code >= 500
+    return isinstance(error, (httpx.TransportError, asyncio.TimeoutError))
+
+
+def should_try_next_backend(error):
+    """Запрос стоит повторить на другом сервере: сервер не ответил или на нем не загружена модель"""
+    if isinstance(error, LMRequestError) and error.status_code == 404:
+        return True
+    return is_backend_failure(error)
+
+
+class LMBackend:
+    """Один сервер моделей и его состояние для маршрутизации"""
+
+    def __init__(self, client, max_concurrency):
+        self.client = client
+        self.url = client.base_url
+        self.max_concurrency = max_concurrency
+
+        self.outstanding = 0
+        self.requests = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.ejections = 0
+        self.ejected_until = 0.0
+        self.last_error = None
+        # Модели, загруженные на сервере (по последнему запросу списка моделей)
+        self.models = []
+
+    def is_ejected(self, now):
+        return now < self.ejected_until
+
+    def stats(self, now):
+        return {
+            "url": self.url,
+            "outstanding": self.outstanding,
+            "max_concurrency": self.max_concurrency,
+            "requests": self.requests,
+            "failures": self.failures,
+            "ejected": self.is_ejected(now),
+            "ejections": self.ejections,
+            "last_error": self.last_error,
+            "models": list(self.models)
+        }
+
+
+class LMRouter(LoopRunner):
+    def __init__(self, urls, max_concurrency=DEFAULT_MAX_CONCURRENCY,
+                 eject_after_failures=EJECT_AFTER_FAILURES, ejection_time=EJECTION_TIME,
+                 max_keepalive_connections=16, connect_timeout=5.0, default_timeout=90.0):
+        """
+        urls - адреса серверов, max_concurrency - общий лимит одновременных
+        запросов на сервер или список лимитов в порядке адресов.
+        """
+        if not urls:
+            raise ValueError("Не указан ни один сервер моделей")
+        if isinstance(max_concurrency, int):
+            max_concurrency = [max_concurrency] * len(urls)
+
+        self.urls = [url.rstrip('/') for url in urls]
+        self.base_url = ",".join(self.urls)
+        self.eject_after_failures = eject_after_failures
+        self.ejection_time = ejection_time
+
+        self._start_loop("lm-router-loop")
+        # Все клиенты работают в общем event loop маршрутизатора
+        self.backends = [
+            LMBackend(
+                AsyncLMClient(
+                    url,
+                    max_connections=limit,
+                    max_keepalive_connections=min(limit, max_keepalive_connections),
+                    connect_timeout=connect_timeout,
+                    default_timeout=default_timeout,
+                    loop=self._loop
+                ),
+                limit
+            )
+            for url, limit in zip(self.urls, max_concurrency)
+        ]
+        self._condition = self.run(self._create_condition())
+        logging.info(f"Маршрутизатор LM создан: {self.urls} (лимиты: {list(max_concurrency)})")
+
+    async def _create_condition(self):
+        return asyncio.Condition()
+
+    def _pick(self, exclude, model=None):
+        """Свободный сервер с наименьшим числом выполняющихся запросов или None"""
+        now = time.time()
+        candidates = [b for b in self.backends if b not in exclude]
+        # Предпочитаем серверы, на которых загружена запрошенная модель
+        with_model = [b for b in candidates if model in b.models]
+        candidates = with_model or candidates
+        healthy = [b for b in candidates if not b.is_ejected(now)]
+        # Если исключены все серверы, пробуем их все: это лучше, чем отказать сразу
+        free = [b for b in (healthy or candidates) if b.outstanding < b.max_concurrency]
+        if not free:
+            return None
+        return min(free, key=lambda b: (b.outstanding, b.requests))
+
+    async def _acquire(self, exclude=(), model=None):
+        async with self._condition:
+            while True:
+                backend = self._pick(exclude, model)
+                if backend is not None:
+                    backend.outstanding += 1
+                    backend.requests += 1
+                    return backend
+                await self._condition.wait()
+
+    async def _release(self, backend, error=None):
+        async with self._condition:
+            backend.outstanding -= 1
+            self._record(backend, error)
+            self._condition.notify_all()
+
+    def _record(self, backend, error):
+        """Учитывает результат запроса для решения об исключении сервера"""
+        if error is None or not is_backend_failure(error):
+            if backend.consecutive_failures:
+                logging.info(f"Сервер моделей {backend.url} снова отвечает")
+            backend.consecutive_failures = 0
+            backend.ejected_until = 0.0
+            return
+
+        backend.failures += 1
+        backend.consecutive_failures += 1
+        backend.last_error = str(error)[:200]
+        if backend.consecutive_failures >= self.eject_after_failures:
+            backend.ejected_until = time.time() + self.ejection_time
+            backend.ejections += 1
+            logging.warning(
+                f"Сервер моделей {backend.url} исключен на {self.ejection_time:.0f} сек "
+                f"после {backend.consecutive_failures} ошибок подряд: {backend.last_error}"
+            )
+
+    async def chat_completion(self, payload, timeout=None):
+        """Chat completion на наименее загруженном сервере; при сбое сервера или 404 - на следующем"""
+        tried = set()
+        while True:
+            backend = await self._acquire(tried, payload.get("model"))
+            tried.add(backend)
+            try:
+                response = await backend.client.chat_completion(payload, timeout)
+            except Exception as e:
+                await self._release(backend, e)
+                if should_try_next_backend(e) and len(tried) < len(self.backends):
+                    logging.warning(f"Запрос к серверу моделей {backend.url} не выполнен, пробуем другой: {e}")
+                    continue
+                raise
+            except BaseException:
+                # Отмена запроса - освобождаем слот без учета ошибки
+                await asyncio.shield(self._release(backend))
+                raise
+            await self._release(backend)
+            return response
+
+    async def stream_chat_completion(self, payload, timeout=None):
+        """Потоковый chat completion; на другой сервер переключается только до первого фрагмента"""
+        tried = set()
+        while True:
+            backend = await self._acquire(tried, payload.get("model"))
+            tried.add(backend)
+            started = False
+            try:
+                async for delta in backend.client.stream_chat_completion(payload, timeout):
+                    started = True
+                    yield delta
+            except Exception as e:
+                await self._release(backend, e)
+                if not started and should_try_next_backend(e) and len(tried) < len(self.backends):
+                    logging.warning(f"Запрос к серверу моделей {backend.url} не выполнен, пробуем другой: {e}")
+                    continue
+                raise
+            except BaseException:
+                # Отмена (клиент отключился) - освобождаем слот без учета ошибки
+                await asyncio.shield(self._release(backend))
+                raise
+            await self._release(backend)
+            return
+
+    async def list_models(self, timeout=5.0):
+        """
+        Объединенный список моделей всех серверов. Запрос отправляется и на
+        исключенные серверы, поэтому служит проверкой их работоспособности.
+        """
+        results = await asyncio.gather(
+            *[b.client.list_models(timeout) for b in self.backends], return_exceptions=True
+        )
+        models = []
+        errors = []
+        async with self._condition:
+            for backend, result in zip(self.backends, results):
+                if isinstance(result, Exception):
+                    self._record(backend, result)
+                    errors.append(result)
+                else:
+                    self._record(backend, None)
+                    backend.models = list(result)
+                    models.extend(m for m in result if m not in models)
+            self._condition.notify_all()
+        if errors and len(errors) == len(self.backends):
+            raise errors[0]
+        return models
+
+    def stats(self):
+        now = time.time()
+        backends = [b.stats(now) for b in self.backends]
+        return {
+            "base_url": self.base_url,
+            "max_connections": sum(b.max_concurrency for b in self.backends),
+            "in_flight": sum(b.outstanding for b in self.backends),
+            "requests_total": sum(b.client.requests_total for b in self.backends),
+            "errors_total": sum(b.client.errors_total for b in self.backends),
+            "healthy_backends": sum(1 for b in self.backends if not b.is_ejected(now)),
+            "backends": backends
+        }
+
+    def close(self, timeout=5.0):
+        """Закрывает соединения всех серверов и останавливает event loop"""
+        try:
+            for backend in self.backends:
+                backend.client.close(timeout)
+        finally:
+            self._stop_loop(timeout)
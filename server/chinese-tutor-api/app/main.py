@@ -1,33 +1,54 @@
-from flask import Flask, request, jsonify
-from openai import OpenAI
-from validator import ContentValidator, BertChineseValidator
+from flask import Flask, request, jsonify, Response, stream_with_context
+from validator import ContentValidator
 from translator import Translator
+from batch_generator import generate_batch
+from exercise_store import ExerciseStore
+from streaming import IncrementalFieldParser, format_sse
+from exercise_schema import exercise_response_format, is_response_format_rejected, parse_exercise, ParseStats
+from single_flight import SingleFlight
+from lm_client import LMRequestError
+from lm_router import LMRouter, parse_backend_urls, parse_concurrency
+from token_budget import TokenBudget, EXERCISE_STOP, restore_json_end
+from task_queue import PRIORITIES, PRIORITY_INTERACTIVE, PRIORITY_PREFETCH
+from worker_pool import WorkerPool
+from admission import AdmissionController, AdmissionRejected, tasks_ahead
+from latency import DurationEstimator, STAGE_GENERATION, STAGE_VALIDATION
+from task_backend import (MemoryTaskBackend, SqliteTaskBackend, TaskCancelled, cancelled_record,
+                          CANCEL_CANCELLED, CANCEL_FINISHED)
 import logging
 import sys
+import atexit
 import json
 import time
 import re
+import math
 import threading
 import uuid
+import concurrent.futures
 from datetime import datetime
-import queue
+import os
 
 app = Flask(__name__)
 logging.basicConfig(level=logging.DEBUG, 
                    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
                    stream=sys.stdout)
 
+# Серверы моделей (OpenAI-совместимые): LM_STUDIO_URLS через запятую или один LM_STUDIO_URL.
+# Запросы распределяются между ними по числу выполняющихся запросов
+LM_STUDIO_URLS = parse_backend_urls(
+    os.environ.get("LM_STUDIO_URLS") or os.environ.get("LM_STUDIO_URL", "http://localhost:1234")
+)
 # Увеличиваем таймаут для LM Studio до 90 секунд
-lm_client = OpenAI(
-    base_url="http://localhost:1234/v1",
-    api_key="not-needed",
-    timeout=90.0,
-    http_client=None
+lm_router = LMRouter(
+    LM_STUDIO_URLS,
+    max_concurrency=parse_concurrency(os.environ.get("LM_BACKEND_CONCURRENCY"), len(LM_STUDIO_URLS)),
+    ejection_time=float(os.environ.get("LM_BACKEND_EJECTION_TIME", 30)),
+    default_timeout=90.0
 )
 
 # Инициализация валидатора упражнений с BERT-Chinese-WWM
 try:
-    validator = BertChineseValidator()
+    validator = ContentValidator()
     validator_enabled = True
     logging.info("Валидатор упражнений BERT-Chinese-WWM успешно инициализирован")
 except Exception as e:
@@ -43,99 +64,283 @@ except Exception as e:
     translator_enabled = False
     logging.error(f"Ошибка инициализации переводчика: {str(e)}")
 
-# Очередь для асинхронных задач генерации
-task_queue = queue.Queue()
-# Хранилище результатов выполнения задач
-task_results = {}
+# Версия промпта входит в ключ хранилища: при изменении промпта старые упражнения не используются
+PROMPT_VERSION = "gemma-v1"
+
+# Хранилище готовых упражнений (LRU в памяти + SQLite)
+exercise_store = ExerciseStore(
+    prompt_version=PROMPT_VERSION,
+    capacity=int(os.environ.get("EXERCISE_STORE_CAPACITY", 2000))
+)
+exercise_store.warm_up(int(os.environ.get("EXERCISE_STORE_WARMUP", 500)))
+
+# Ограничение формата ответа JSON-схемой упражнения (LM_STRUCTURED_OUTPUT=0 отключает)
+structured_output_enabled = os.environ.get("LM_STRUCTURED_OUTPUT", "1") != "0"
+# Статистика разбора ответов: строгий разбор / восстановление JSON
+parse_stats = ParseStats()
+
+# max_tokens для каждой пары (HSK, язык) по наблюдаемой длине ответов
+token_budget = TokenBudget(default=int(os.environ.get("LM_MAX_TOKENS", 600)))
+
+# Одинаковые одновременные запросы (слово, HSK, язык) ждут одну общую генерацию
+generation_flight = SingleFlight()
+
+# Скользящие средние длительности генерации и валидации: по ним считается ETA задач
+durations = DurationEstimator()
+
+def validate_exercise_timed(exercise):
+    """Валидация упражнения с учетом ее длительности"""
+    started = time.time()
+    validation_result = validator.validate_exercise(exercise)
+    durations.record(STAGE_VALIDATION, time.time() - started)
+    return validation_result
+
+def validate_exercises_timed(exercises):
+    """Пакетная валидация упражнений; в оценку длительности идет среднее время на одно упражнение"""
+    started = time.time()
+    validation_results = validator.validate_exercises(exercises)
+    if exercises:
+        durations.record(STAGE_VALIDATION, (time.time() - started) / len(exercises))
+    return validation_results
+
 # Максимальное время хранения результатов (5 минут)
 RESULT_TTL = 300
 
-# Запускаем обработчик задач в отдельном потоке
-def task_worker():
+def create_task_backend():
+    """
+    Очередь и результаты асинхронных задач: в памяти процесса (TASK_BACKEND=memory)
+    или в SQLite (TASK_BACKEND=sqlite), общей для нескольких процессов сервера.
+    """
+    backend = os.environ.get("TASK_BACKEND", "memory").lower()
+    prefetch_aging = float(os.environ.get("PREFETCH_AGING_SECONDS", 30))
+    if backend == "sqlite":
+        return SqliteTaskBackend(
+            db_path=os.environ.get("TASK_DB_PATH"),
+            prefetch_aging=prefetch_aging,
+            result_ttl=RESULT_TTL,
+            visibility_timeout=float(os.environ.get("TASK_VISIBILITY_TIMEOUT", 300)),
+            max_attempts=int(os.environ.get("TASK_MAX_ATTEMPTS", 3))
+        )
+    if backend != "memory":
+        logging.warning(f"Неизвестный TASK_BACKEND '{backend}', используется очередь в памяти")
+    # interactive раньше prefetch, prefetch со старением; результаты с TTL и ограничением числа и размера
+    return MemoryTaskBackend(
+        prefetch_aging=prefetch_aging,
+        result_ttl=RESULT_TTL,
+        max_entries=int(os.environ.get("TASK_RESULTS_MAX_ENTRIES", 10000)),
+        max_bytes=int(os.environ.get("TASK_RESULTS_MAX_BYTES", 64 * 1024 * 1024))
+    )
+
+task_backend = create_task_backend()
+# Закрывается после остановки обработчиков (atexit вызывает функции в обратном порядке)
+atexit.register(task_backend.close)
+
+# Ограничение очереди: при превышении глубины или оценки ожидания /generate и /tasks отвечают 429
+admission = AdmissionController(
+    max_depth=int(os.environ.get("TASK_QUEUE_MAX_DEPTH", 500)),
+    max_wait=float(os.environ.get("TASK_QUEUE_MAX_WAIT", 120))
+)
+
+def admit_tasks(priority, count=1):
+    """Проверяет, можно ли поставить задачи в очередь; выбрасывает AdmissionRejected"""
+    return admission.admit(task_backend.depth(), task_backend.drain_rate(), priority, count)
+
+def overloaded_response(e):
+    """
+    Ответ 429 с Retry-After, рассчитанным по скорости разбора очереди;
+    413 без Retry-After, если пакет больше, чем вмещает очередь
+    """
+    logging.warning(f"Задача не принята: {str(e)} (в очереди {e.depth})")
+    if e.retry_after is None:
+        return jsonify({
+            "status": "rejected",
+            "error": f"Пакет больше, чем вмещает очередь (максимум {admission.max_depth} задач)",
+            "reason": e.reason,
+            "queue_depth": e.depth
+        }), 413
+    return jsonify({
+        "status": "rejected",
+        "error": "Сервер перегружен, повторите запрос позже",
+        "reason": e.reason,
+        "retry_after": e.retry_after,
+        "queue_depth": e.depth,
+        "estimated_wait": e.estimated_wait
+    }), 429, {"Retry-After": str(e.retry_after)}
+
+# Как часто выполняющийся запрос к LM проверяет, не отменена ли задача (DELETE /task/<task_id>)
+TASK_CANCEL_CHECK_INTERVAL = 0.5
+# Задача, которую выполняет текущий поток пула: is_cancelled() - запрошена ли ее отмена
+task_context = threading.local()
+
+def run_lm_request(coro):
+    """
+    Выполняет запрос к LM в event loop маршрутизатора. Если поток выполняет задачу
+    и ее отменили, запрос прерывается (соединение закрывается, сервер модели
+    перестает генерировать) и выбрасывается TaskCancelled.
+    """
+    future = lm_router.submit(coro)
+    is_cancelled = getattr(task_context, "is_cancelled", None)
+    if is_cancelled is None:
+        return future.result()
     while True:
         try:
-            task_id, word, hsk_level, system_language, temperature, validate, retry_on_invalid = task_queue.get()
-            logging.info(f"Обработка задачи {task_id} для слова '{word}'")
-            
-            try:
-                result = generate_exercise_with_gemma(word, hsk_level, system_language, temperature)
-                
-                # Если включена валидация
-                if validate and validator_enabled and 'error' not in result:
-                    try:
-                        validation_result = validator.validate_exercise(result)
-                        result["validation"] = {
-                            "is_valid": validation_result.get("is_valid", True),
-                            "confidence": validation_result.get("confidence", 0.0),
-                            "semantic_score": validation_result.get("semantic_score", 0.0),
-                            "distractor_score": validation_result.get("distractor_score", 0.0)
-                        }
-                        
-                        # Повторная генерация если не прошло валидацию
-                        if not validation_result.get("is_valid", True) and retry_on_invalid:
-                            logging.warning(f"Упражнение для '{word}' не прошло валидацию, генерируем повторно")
-                            retry_result = generate_exercise_with_gemma(word, hsk_level, system_language, 0.9)
-                            
-                            if 'error' not in retry_result:
-                                retry_validation = validator.validate_exercise(retry_result)
-                                retry_result["validation"] = {
-                                    "is_valid": retry_validation.get("is_valid", True),
-                                    "confidence": retry_validation.get("confidence", 0.0),
-                                    "semantic_score": retry_validation.get("semantic_score", 0.0),
-                                    "distractor_score": retry_validation.get("distractor_score", 0.0),
-                                    "is_retry": True
-                                }
-                                
-                                if retry_validation.get("confidence", 0.0) > validation_result.get("confidence", 0.0):
-                                    result = retry_result
-                                    logging.info("Используется повторно сгенерированное упражнение с более высокой оценкой")
-                    except Exception as e:
-                        logging.error(f"Ошибка валидации для задачи {task_id}: {str(e)}", exc_info=True)
-                        result["validation_error"] = str(e)
-                
-                task_results[task_id] = {
-                    "status": "completed",
-                    "result": result,
-                    "created_at": datetime.now().timestamp()
-                }
-                logging.info(f"Задача {task_id} успешно выполнена")
-                
-            except Exception as e:
-                logging.error(f"Ошибка при генерации упражнения для задачи {task_id}: {str(e)}", exc_info=True)
-                task_results[task_id] = {
-                    "status": "error",
-                    "error": str(e),
-                    "created_at": datetime.now().timestamp()
-                }
-            
-            # Отмечаем задачу как выполненную
-            task_queue.task_done()
-            
-            # Очистка устаревших результатов
-            current_time = datetime.now().timestamp()
-            to_delete = []
-            for tid, data in task_results.items():
-                if current_time - data["created_at"] > RESULT_TTL:
-                    to_delete.append(tid)
+            return future.result(timeout=TASK_CANCEL_CHECK_INTERVAL)
+        except concurrent.futures.TimeoutError:
+            if is_cancelled():
+                future.cancel()
+                raise TaskCancelled("Задача отменена клиентом")
+
+def generation_key(word, hsk_level, system_language, validate=True, retry_on_invalid=True, temperature=0.7):
+    """Ключ объединения одинаковых генераций: параметры, от которых зависит результат"""
+    return (str(word), str(hsk_level), str(system_language), bool(validate), bool(retry_on_invalid), float(temperature))
+
+def is_placeholder_result(result, word):
+    """Ошибка или упражнение, дополненное заглушками при восстановлении ответа модели"""
+    if 'error' in result or result.get("sentence_with_gap") == f"这个句子中使用{word}。":
+        return True
+    return any(isinstance(option, str) and option.startswith("选项") for option in result.get("options") or [])
+
+def cached_exercise(word, hsk_level, system_language, validate):
+    """Упражнение из хранилища; непроверенное не подходит для запроса с валидацией"""
+    cached = exercise_store.get(word, hsk_level, system_language)
+    if cached is None or (validate and validator_enabled and "validation" not in cached):
+        return None
+    return cached
+
+def store_exercise(word, hsk_level, system_language, result):
+    """Сохраняет только настоящие упражнения модели, прошедшие валидацию (или без валидации)"""
+    if is_placeholder_result(result, word) or "validation_error" in result:
+        return
+    # Ключ хранилища не учитывает режим валидации, поэтому при работающем валидаторе
+    # сохраняются только проверенные упражнения
+    if validator_enabled and "validation" not in result:
+        return
+    if not result.get("validation", {}).get("is_valid", True):
+        return
+    try:
+        exercise_store.put(word, hsk_level, system_language, result)
+    except Exception as e:
+        logging.error(f"Не удалось сохранить упражнение для '{word}': {str(e)}", exc_info=True)
+
+def generate_validated_exercise(word, hsk_level, system_language, temperature=0.7,
+                                validate=True, retry_on_invalid=True, use_cache=True):
+    """Генерация упражнения с валидацией и повторной генерацией через хранилище упражнений"""
+    if use_cache:
+        cached = cached_exercise(word, hsk_level, system_language, validate)
+        if cached is not None:
+            logging.info(f"Упражнение для '{word}' (HSK {hsk_level}, {system_language}) найдено в хранилище")
+            cached["cached"] = True
+            return cached
+    
+    # Дубликаты, пришедшие пока идет генерация, получат ее результат
+    return generation_flight.do(
+        generation_key(word, hsk_level, system_language, validate, retry_on_invalid, temperature),
+        lambda: _generate_validated_exercise(word, hsk_level, system_language, temperature,
+                                             validate, retry_on_invalid)
+    )
+
+def _generate_validated_exercise(word, hsk_level, system_language, temperature, validate, retry_on_invalid):
+    result = generate_exercise_with_gemma(word, hsk_level, system_language, temperature)
+    
+    # Если включена валидация
+    if validate and validator_enabled and 'error' not in result:
+        try:
+            validation_result = validate_exercise_timed(result)
+            result["validation"] = {
+                "is_valid": validation_result.get("is_valid", True),
+                "confidence": validation_result.get("confidence", 0.0),
+                "semantic_score": validation_result.get("semantic_score", 0.0),
+                "distractor_score": validation_result.get("distractor_score", 0.0)
+            }
             
-            for tid in to_delete:
-                del task_results[tid]
+            # Повторная генерация если не прошло валидацию
+            if not validation_result.get("is_valid", True) and retry_on_invalid:
+                logging.warning(f"Упражнение для '{word}' не прошло валидацию, генерируем повторно")
+                retry_result = generate_exercise_with_gemma(word, hsk_level, system_language, 0.9)
                 
+                if 'error' not in retry_result:
+                    retry_validation = validate_exercise_timed(retry_result)
+                    retry_result["validation"] = {
+                        "is_valid": retry_validation.get("is_valid", True),
+                        "confidence": retry_validation.get("confidence", 0.0),
+                        "semantic_score": retry_validation.get("semantic_score", 0.0),
+                        "distractor_score": retry_validation.get("distractor_score", 0.0),
+                        "is_retry": True
+                    }
+                    
+                    if retry_validation.get("confidence", 0.0) > validation_result.get("confidence", 0.0):
+                        result = retry_result
+                        logging.info("Используется повторно сгенерированное упражнение с более высокой оценкой")
+        except TaskCancelled:
+            raise
         except Exception as e:
-            logging.error(f"Ошибка в worker потоке: {str(e)}", exc_info=True)
-            
-# Запуск worker потока
-worker_thread = threading.Thread(target=task_worker, daemon=True)
-worker_thread.start()
+            logging.error(f"Ошибка валидации для '{word}': {str(e)}", exc_info=True)
+            result["validation_error"] = str(e)
+    
+    store_exercise(word, hsk_level, system_language, result)
+    return result
+
+# Обработка одной задачи из очереди (выполняется потоками пула обработчиков)
+def task_worker(task):
+    task_id, params = task
+    word = params["word"]
+    logging.info(f"Обработка задачи {task_id} для слова '{word}'")
+    
+    # Отмена прерывает генерацию, только если ее результат не ждут другие запросы того же слова
+    key = generation_key(word, params["hsk_level"], params["system_language"],
+                         params["validate"], params["retry_on_invalid"], params["temperature"])
+    task_context.is_cancelled = lambda: (
+        task_backend.is_cancel_requested(task_id) and generation_flight.abandon(key)
+    )
+    try:
+        if task_backend.is_cancel_requested(task_id):
+            raise TaskCancelled("Задача отменена клиентом")
+        
+        result = generate_validated_exercise(
+            word, params["hsk_level"], params["system_language"], params["temperature"],
+            validate=params["validate"],
+            retry_on_invalid=params["retry_on_invalid"],
+            use_cache=params["use_cache"]
+        )
+        
+        task_backend.complete(task_id, {
+            "status": "completed",
+            "result": result,
+            "created_at": datetime.now().timestamp()
+        })
+        logging.info(f"Задача {task_id} успешно выполнена")
+        
+    except TaskCancelled:
+        logging.info(f"Задача {task_id} отменена, генерация прервана")
+        task_backend.complete(task_id, cancelled_record())
+    except Exception as e:
+        logging.error(f"Ошибка при генерации упражнения для задачи {task_id}: {str(e)}", exc_info=True)
+        task_backend.complete(task_id, {
+            "status": "error",
+            "error": str(e),
+            "created_at": datetime.now().timestamp()
+        })
+    finally:
+        task_context.is_cancelled = None
+
+# Пул обработчиков: по умолчанию столько потоков, сколько запросов одновременно принимают серверы моделей
+worker_pool = WorkerPool(
+    task_backend,
+    task_worker,
+    size=int(os.environ.get("TASK_WORKERS", lm_router.stats()["max_connections"]))
+)
+worker_pool.start()
+# При остановке сервера даем текущим задачам завершиться
+atexit.register(worker_pool.shutdown, float(os.environ.get("TASK_WORKERS_SHUTDOWN_TIMEOUT", 30)))
 
 @app.route('/test-connection', methods=['GET'])
 def test_connection():
     """Тестовый endpoint для проверки подключения к LM Studio"""
     try:
-        response = lm_client.models.list()
         return jsonify({
             "status": "success",
-            "models": [model.id for model in response.data]
+            "models": lm_router.run(lm_router.list_models(timeout=5)),
+            "backends": lm_router.stats()["backends"]
         })
     except Exception as e:
         logging.error(f"Ошибка при подключении к LM Studio: {str(e)}", exc_info=True)
@@ -195,6 +400,22 @@ def translate_text():
             "error": f"Ошибка перевода: {str(e)}"
         }), 500
 
+def submit_generation_task(word, hsk_level, system_language, validate, retry_on_invalid, use_cache, priority,
+                           idempotency_key=None):
+    """
+    Ставит генерацию упражнения в очередь и возвращает ID задачи.
+    Если задача с таким ключом идемпотентности уже есть, возвращается ее ID.
+    """
+    return task_backend.submit(str(uuid.uuid4()), {
+        "word": word,
+        "hsk_level": hsk_level,
+        "system_language": system_language,
+        "temperature": 0.7,
+        "validate": validate,
+        "retry_on_invalid": retry_on_invalid,
+        "use_cache": use_cache
+    }, priority, idempotency_key=idempotency_key)
+
 @app.route('/generate', methods=['POST'])
 def generate_exercise():
     """Endpoint для генерации упражнений на основе заданного китайского слова"""
@@ -208,73 +429,66 @@ def generate_exercise():
         system_language = data.get('system_language', 'ru')
         validate = data.get('validate', True)  # По умолчанию включена валидация
         fast_response = data.get('fast_response', True)  # Быстрый ответ или ждать результат
+        use_cache = data.get('use_cache', True)  # Можно ли вернуть готовое упражнение из хранилища
+        # interactive - пользователь ждет упражнение, prefetch - фоновая предзагрузка
+        priority = data.get('priority', PRIORITY_INTERACTIVE)
         
         if not word:
             return jsonify({"error": "Не указано слово (параметр 'word')"}), 400
+        if priority not in PRIORITIES:
+            return jsonify({"error": f"Неизвестный приоритет '{priority}', допустимые значения: {list(PRIORITIES)}"}), 400
+        
+        # Потоковый режим: поля упражнения отправляются как SSE-события по мере генерации
+        stream = data.get('stream', False) or request.args.get('stream') == 'true'
+        if stream:
+            events = stream_exercise_events(word, hsk_level, system_language, validate, use_cache)
+            return Response(
+                stream_with_context(events),
+                mimetype='text/event-stream',
+                headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+            )
         
         # Для быстрого ответа используем асинхронную генерацию
         if fast_response:
-            # Создаем ID задачи
-            task_id = str(uuid.uuid4())
+            # Повтор запроса с тем же Idempotency-Key возвращает уже созданную задачу
+            idempotency_key = request.headers.get('Idempotency-Key')
+            
+            # Новая задача проходит контроль допуска, повтор уже принятой - нет
+            if not (idempotency_key and task_backend.find_by_idempotency_key(idempotency_key)):
+                try:
+                    admit_tasks(priority)
+                except AdmissionRejected as e:
+                    return overloaded_response(e)
             
             # Добавляем задачу в очередь
-            task_queue.put((task_id, word, hsk_level, system_language, 0.7, validate, data.get('retry_on_invalid', True)))
+            task_id = submit_generation_task(
+                word, hsk_level, system_language, validate,
+                data.get('retry_on_invalid', True), use_cache, priority,
+                idempotency_key=idempotency_key
+            )
             
             # Возвращаем ID задачи для последующей проверки статуса
-            return jsonify({
+            response = {
                 "task_id": task_id,
                 "status": "pending",
+                "priority": priority,
                 "message": f"Задача генерации упражнения для '{word}' принята в обработку"
-            })
+            }
+            if idempotency_key:
+                response["idempotency_key"] = idempotency_key
+            return jsonify(response)
         else:
             # Синхронная генерация (традиционный подход)
-            # Генерация упражнения с использованием Gemma3-IT-QAT через LM Studio
-            result = generate_exercise_with_gemma(word, hsk_level, system_language)
+            # Генерация упражнения с использованием Gemma3-IT-QAT через LM Studio и валидация BERT-Chinese-WWM
+            result = generate_validated_exercise(
+                word, hsk_level, system_language,
+                validate=validate,
+                retry_on_invalid=data.get('retry_on_invalid', True),
+                use_cache=use_cache
+            )
             
             if 'error' in result:
                 return jsonify(result), 500
-                
-            # Валидация упражнения с помощью BERT-Chinese-WWM, если включена
-            if validate and validator_enabled:
-                try:
-                    validation_result = validator.validate_exercise(result)
-                    
-                    # Добавляем информацию о валидации к результату
-                    result["validation"] = {
-                        "is_valid": validation_result.get("is_valid", True),
-                        "confidence": validation_result.get("confidence", 0.0),
-                        "semantic_score": validation_result.get("semantic_score", 0.0),
-                        "distractor_score": validation_result.get("distractor_score", 0.0)
-                    }
-                    
-                    # Если упражнение не прошло валидацию, попробуем сгенерировать еще раз
-                    if not validation_result.get("is_valid", True) and data.get('retry_on_invalid', True):
-                        logging.warning(f"Упражнение не прошло валидацию: {validation_result}")
-                        
-                        # Повторная генерация с более высокой температурой для разнообразия
-                        retry_result = generate_exercise_with_gemma(
-                            word, hsk_level, system_language, temperature=0.9
-                        )
-                        
-                        if 'error' not in retry_result:
-                            # Валидируем повторную генерацию
-                            retry_validation = validator.validate_exercise(retry_result)
-                            retry_result["validation"] = {
-                                "is_valid": retry_validation.get("is_valid", True),
-                                "confidence": retry_validation.get("confidence", 0.0),
-                                "semantic_score": retry_validation.get("semantic_score", 0.0),
-                                "distractor_score": retry_validation.get("distractor_score", 0.0),
-                                "is_retry": True
-                            }
-                            
-                            # Используем результат с лучшей оценкой
-                            if retry_validation.get("confidence", 0.0) > validation_result.get("confidence", 0.0):
-                                result = retry_result
-                                logging.info("Используется повторно сгенерированное упражнение с более высокой оценкой")
-                        
-                except Exception as e:
-                    logging.error(f"Ошибка валидации: {str(e)}", exc_info=True)
-                    result["validation_error"] = str(e)
             
             return jsonify(result)
         
@@ -285,24 +499,338 @@ def generate_exercise():
             "message": "Внутренняя ошибка сервера"
         }), 500
 
+# Сколько секунд /task/<task_id>?wait=... может держать запрос открытым
+TASK_MAX_WAIT = float(os.environ.get("TASK_MAX_WAIT", 60))
+# Интервал повторных событий pending в SSE; по ним же обнаруживается отключение клиента
+TASK_EVENTS_KEEPALIVE = 15
+
+def expected_task_duration():
+    """Оценка длительности одной задачи: генерация плюс валидация; None, пока нет измерений"""
+    generation = durations.mean(STAGE_GENERATION)
+    if generation is None:
+        return None
+    validation = durations.mean(STAGE_VALIDATION) if validator_enabled else None
+    return generation + (validation or 0.0)
+
+def pending_task_status(task_id):
+    """
+    Статус незавершенной задачи: место в очереди, число задач впереди и оценка
+    времени завершения (eta_seconds), чтобы клиент мог выбрать момент следующего опроса
+    """
+    status = {
+        "status": "pending",
+        "message": "Задача все еще выполняется или не существует"
+    }
+    position = task_backend.position(task_id)
+    if position is None:
+        return status
+    
+    now = time.time()
+    duration = expected_task_duration()
+    eta = None
+    if position["state"] == "queued":
+        ahead = position["tasks_ahead"]
+        status.update(state="queued", queue_position=ahead + 1, tasks_ahead=ahead,
+                      message="Задача ожидает в очереди")
+        # Задачи впереди разбираются всеми обработчиками параллельно, затем выполняется эта
+        if duration is not None:
+            eta = (ahead / worker_pool.size + 1) * duration
+    else:
+        elapsed = now - position["started_at"]
+        status.update(state="running", running_for=round(elapsed, 1), message="Задача выполняется")
+        if duration is not None:
+            eta = max(0.0, duration - elapsed)
+    
+    if eta is not None:
+        status["eta_seconds"] = round(eta, 1)
+        status["estimated_completion"] = now + eta
+    return status
+
 @app.route('/task/<task_id>', methods=['GET'])
 def check_task_status(task_id):
-    """Endpoint для проверки статуса асинхронной задачи"""
-    if task_id not in task_results:
+    """
+    Endpoint для проверки статуса асинхронной задачи.
+    С параметром wait=N запрос ждет завершения задачи до N секунд (long-poll).
+    """
+    try:
+        wait = float(request.args.get('wait', 0))
+    except ValueError:
+        wait = None
+    if wait is None or not math.isfinite(wait):
+        return jsonify({"error": "Параметр 'wait' должен быть числом секунд"}), 400
+    wait = min(max(wait, 0.0), TASK_MAX_WAIT)
+    
+    task_result = task_backend.wait_result(task_id, wait)
+    if task_result is None:
+        return jsonify(pending_task_status(task_id))
+    
+    return jsonify(task_result)
+
+@app.route('/task/<task_id>', methods=['DELETE'])
+def cancel_task(task_id):
+    """
+    Отмена задачи: задача из очереди удаляется сразу, у выполняющейся
+    прерывается запрос к LM Studio (статус cancelling, затем cancelled).
+    """
+    outcome = task_backend.cancel(task_id)
+    if outcome is None:
+        return jsonify({"error": f"Задача {task_id} не найдена"}), 404
+    if outcome == CANCEL_FINISHED:
         return jsonify({
-            "status": "pending",
-            "message": "Задача все еще выполняется или не существует"
-        })
+            "task_id": task_id,
+            "status": "finished",
+            "message": "Задача уже завершена"
+        }), 409
     
-    return jsonify(task_results[task_id])
+    logging.info(f"Задача {task_id} отменена клиентом ({outcome})")
+    return jsonify({
+        "task_id": task_id,
+        "status": outcome
+    }), 200 if outcome == CANCEL_CANCELLED else 202
 
-def generate_exercise_with_gemma(word, hsk_level, system_language, temperature=0.7):
-    """Генерация упражнения с использованием Gemma3-IT-QAT через LM Studio"""
+@app.route('/task/<task_id>/events', methods=['GET'])
+def task_events(task_id):
+    """
+    SSE-вариант статуса задачи: событие pending сразу и затем периодически
+    (с местом в очереди и ETA), событие result при завершении
+    """
+    def events():
+        yield format_sse("pending", pending_task_status(task_id))
+        deadline = time.time() + RESULT_TTL
+        while time.time() < deadline:
+            task_result = task_backend.wait_result(task_id, TASK_EVENTS_KEEPALIVE)
+            if task_result is not None:
+                yield format_sse("result", task_result)
+                return
+            yield format_sse("pending", pending_task_status(task_id))
+        yield format_sse("timeout", {"message": "Задача не завершилась за отведенное время"})
+    
+    return Response(
+        stream_with_context(events()),
+        mimetype='text/event-stream',
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+# Максимальное число слов в одном POST /tasks и задач в одном POST /tasks/status
+TASKS_MAX_BATCH = int(os.environ.get("TASKS_MAX_BATCH", 200))
+
+def request_words(data):
+    """
+    Слова пакетного запроса: карточки ({hanzi, ...}) и/или простой список слов,
+    без пустых значений и дубликатов. Возвращает (слова, None) или (None, текст ошибки для 400).
+    """
+    cards = data.get('cards') or []
+    words = data.get('words') or []
+    if not isinstance(cards, list) or not all(isinstance(card, dict) for card in cards):
+        return None, "Параметр 'cards' должен быть списком объектов"
+    if not isinstance(words, list) or not all(isinstance(word, str) for word in words):
+        return None, "Параметр 'words' должен быть списком строк"
+    card_words = [card.get('hanzi') or card.get('word') for card in cards]
+    if not all(isinstance(word, str) and word.strip() for word in card_words):
+        return None, "У каждой карточки должно быть непустое строковое поле 'hanzi' или 'word'"
+    return list(dict.fromkeys(word for word in card_words + words if word)), None
+
+def int_param(data, name, default, minimum):
+    """Целый параметр запроса не меньше minimum; None, если значение некорректно"""
+    value = data.get(name)
+    if value is None:
+        return default
+    if isinstance(value, bool) or not isinstance(value, (int, str)) or not str(value).isdigit() \
+            or int(value) < minimum:
+        return None
+    return int(value)
+
+@app.route('/tasks', methods=['POST'])
+def submit_tasks():
+    """Пакетная постановка задач: по одной асинхронной задаче на слово (например, предзагрузка колоды)"""
     try:
-        logging.info(f"Генерация упражнения для слова: {word}, HSK: {hsk_level}, Язык: {system_language}")
+        data = request.get_json(silent=True)
+        if not isinstance(data, dict):
+            return jsonify({"error": "Тело запроса должно быть JSON-объектом"}), 400
+        
+        # Как и в /generate-multiple-exercises: карточки ({hanzi, ...}) или простой список слов
+        words, error = request_words(data)
+        if error:
+            return jsonify({"error": error}), 400
+        
+        if not words:
+            return jsonify({"error": "Не указаны слова (параметры 'cards' или 'words')"}), 400
+        if len(words) > TASKS_MAX_BATCH:
+            return jsonify({"error": f"Слишком много слов в одном запросе: {len(words)} (максимум {TASKS_MAX_BATCH})"}), 400
+        
+        # По умолчанию пакет - фоновая предзагрузка и не обгоняет задачи, которые пользователь ждет на экране
+        priority = data.get('priority', PRIORITY_PREFETCH)
+        if priority not in PRIORITIES:
+            return jsonify({"error": f"Неизвестный приоритет '{priority}', допустимые значения: {list(PRIORITIES)}"}), 400
+        
+        try:
+            admit_tasks(priority, count=len(words))
+        except AdmissionRejected as e:
+            return overloaded_response(e)
+        
+        hsk_level = data.get('hsk_level', 1)
+        system_language = data.get('system_language', 'ru')
+        tasks = []
+        for word in words:
+            task_id = submit_generation_task(
+                word, hsk_level, system_language,
+                data.get('validate', True), data.get('retry_on_invalid', True),
+                data.get('use_cache', True), priority
+            )
+            tasks.append({"word": word, "task_id": task_id})
+        
+        logging.info(f"Поставлено задач в очередь пакетом: {len(tasks)} (приоритет {priority})")
+        return jsonify({"status": "pending", "priority": priority, "tasks": tasks})
+        
+    except Exception as e:
+        logging.error(f"Ошибка пакетной постановки задач: {str(e)}", exc_info=True)
+        return jsonify({
+            "status": "error",
+            "message": "Внутренняя ошибка сервера"
+        }), 500
+
+@app.route('/tasks/status', methods=['POST'])
+def tasks_status():
+    """Статусы нескольких задач одним запросом, вместе с результатами завершенных"""
+    try:
+        data = request.get_json(silent=True)
+        task_ids = data.get('task_ids') if isinstance(data, dict) else None
+        
+        if not isinstance(task_ids, list) or not all(isinstance(task_id, str) for task_id in task_ids):
+            return jsonify({"error": "Параметр 'task_ids' должен быть списком строк"}), 400
+        task_ids = list(dict.fromkeys(task_ids))
+        if not task_ids:
+            return jsonify({"error": "Не указаны ID задач (параметр 'task_ids')"}), 400
+        if len(task_ids) > TASKS_MAX_BATCH:
+            return jsonify({"error": f"Слишком много задач в одном запросе: {len(task_ids)} (максимум {TASKS_MAX_BATCH})"}), 400
+        
+        results = task_backend.get_results(task_ids)
+        tasks = {}
+        counts = {}
+        for task_id in task_ids:
+            task_result = results[task_id] or pending_task_status(task_id)
+            tasks[task_id] = task_result
+            counts[task_result["status"]] = counts.get(task_result["status"], 0) + 1
+        
+        return jsonify({"tasks": tasks, "counts": counts})
+        
+    except Exception as e:
+        logging.error(f"Ошибка получения статусов задач: {str(e)}", exc_info=True)
+        return jsonify({
+            "status": "error",
+            "message": "Внутренняя ошибка сервера"
+        }), 500
+
+def admission_stats():
+    depth = task_backend.depth()
+    drain_rate = task_backend.drain_rate()
+    return dict(
+        admission.stats(),
+        queue_depth=depth,
+        drain_rate=drain_rate,
+        estimated_wait={
+            priority: admission.estimated_wait(tasks_ahead(depth, priority), drain_rate)
+            for priority in PRIORITIES
+        }
+    )
+
+@app.route('/stats', methods=['GET'])
+def get_stats():
+    """Endpoint со статистикой хранилища упражнений и разбора ответов модели"""
+    return jsonify({
+        "exercise_store": exercise_store.stats(),
+        "parsing": parse_stats.stats(),
+        "single_flight": generation_flight.stats(),
+        "token_budget": token_budget.stats(),
+        "tasks": task_backend.stats(),
+        "workers": worker_pool.stats(),
+        "admission": admission_stats(),
+        "latency": dict(durations.stats(), expected_task_duration=expected_task_duration()),
+        "lm_backends": lm_router.stats(),
+        "validator": validator.stats() if validator_enabled else None
+    })
+
+@app.route('/generate-multiple-exercises', methods=['POST'])
+def generate_multiple_exercises():
+    """Endpoint для пакетной генерации упражнений: несколько слов в одном запросе к LM Studio"""
+    try:
+        data = request.get_json(silent=True)
+        if not isinstance(data, dict):
+            return jsonify({"error": "Тело запроса должно быть JSON-объектом"}), 400
+        
+        # Клиент присылает карточки ({hanzi, pinyin, translation}), поддерживаем и простой список слов
+        words, error = request_words(data)
+        if error:
+            return jsonify({"error": error}), 400
+        logging.info(f"Получен пакетный запрос на {len(words)} слов")
+        
+        # count = 0 или отсутствует - без ограничения
+        count = int_param(data, 'count', 0, minimum=0)
+        batch_size = int_param(data, 'batch_size', 8, minimum=1)
+        if count is None or batch_size is None:
+            return jsonify({"error": "Параметры 'count' и 'batch_size' должны быть целыми числами "
+                                     "('count' >= 0, 'batch_size' >= 1)"}), 400
+        if count:
+            words = words[:count]
+        
+        if not words:
+            return jsonify({"error": "Не указаны слова (параметры 'cards' или 'words')"}), 400
+        
+        hsk_level = data.get('hsk_level', 1)
+        system_language = data.get('system_language', 'ru')
+        validate = data.get('validate', True)
+        
+        exercises, stats = generate_batch(
+            words, hsk_level, system_language,
+            complete=lm_complete,
+            generate_single=lambda w: generate_exercise_with_gemma(w, hsk_level, system_language, 0.9),
+            batch_size=batch_size
+        )
+        
+        for word, exercise in zip(words, exercises):
+            exercise["word"] = word
+        
+        # Все упражнения пакета проверяются одним вызовом валидатора (пакетными прогонами модели)
+        to_validate = [exercise for exercise in exercises if 'error' not in exercise]
+        if validate and validator_enabled and to_validate:
+            try:
+                for exercise, validation_result in zip(to_validate, validate_exercises_timed(to_validate)):
+                    exercise["validation"] = {
+                        "is_valid": validation_result.get("is_valid", True),
+                        "confidence": validation_result.get("confidence", 0.0),
+                        "semantic_score": validation_result.get("semantic_score", 0.0),
+                        "distractor_score": validation_result.get("distractor_score", 0.0)
+                    }
+            except Exception as e:
+                logging.error(f"Ошибка пакетной валидации: {str(e)}", exc_info=True)
+                for exercise in to_validate:
+                    exercise["validation_error"] = str(e)
         
-        # Формируем промпт для генерации упражнения
-        user_prompt = f"""Ты генератор учебных упражнений по китайскому языку. Вот твоя задача:
+        logging.info(f"Пакетная генерация завершена: {stats}")
+        return jsonify({"exercises": exercises, "stats": stats})
+        
+    except Exception as e:
+        logging.error(f"Ошибка пакетной генерации: {str(e)}", exc_info=True)
+        return jsonify({
+            "status": "error",
+            "message": "Внутренняя ошибка сервера"
+        }), 500
+
+def lm_complete(messages, temperature, max_tokens):
+    """Один запрос chat completion к LM Studio, возвращает текст ответа"""
+    response = run_lm_request(lm_router.chat_completion({
+        "model": "LM Studio",
+        "messages": messages,
+        "temperature": temperature,
+        "max_tokens": max_tokens,
+        "top_p": 0.95
+    }))
+    return response["choices"][0]["message"]["content"]
+
+def build_exercise_messages(word, hsk_level, system_language):
+    """Сообщения chat completion для генерации упражнения по одному слову"""
+    # Формируем промпт для генерации упражнения
+    user_prompt = f"""Ты генератор учебных упражнений по китайскому языку. Вот твоя задача:
 
 На вход ты получаешь:
 - одно китайское слово: {word}
@@ -335,9 +863,9 @@ def generate_exercise_with_gemma(word, hsk_level, system_language, temperature=0
   "translation": "перевод предложения"
 }}
 """
-        
-        # Улучшенный системный промпт с явными инструкциями по формату JSON
-        system_prompt = """Ты помощник для изучения китайского языка. Твоя задача - создавать упражнения в формате JSON.
+    
+    # Улучшенный системный промпт с явными инструкциями по формату JSON
+    system_prompt = """Ты помощник для изучения китайского языка. Твоя задача - создавать упражнения в формате JSON.
 
 ⚠️⚠️⚠️ КРИТИЧЕСКИ ВАЖНО: ⚠️⚠️⚠️
 1. Возвращай ТОЛЬКО чистый валидный JSON, НЕ оборачивай его в тройные обратные кавычки.
@@ -347,37 +875,152 @@ def generate_exercise_with_gemma(word, hsk_level, system_language, temperature=0
 5. НЕ включай никакого вступительного или заключительного текста.
 6. ТОЛЬКО JSON, ничего больше."""
 
-        # Ограничиваем генерацию полезных токенов для ускорения
-        max_tokens = 600
-        
-        # Попытка использовать более быстрые настройки генерации
-        response = lm_client.chat.completions.create(
-            model="LM Studio",  # В LM Studio это не имеет значения, т.к. модель уже загружена
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": user_prompt}
-            ],
-            temperature=temperature,
-            max_tokens=max_tokens,
-            top_p=0.95,
-            frequency_penalty=0,
-            presence_penalty=0
-        )
+    return [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": user_prompt}
+    ]
+
+def _prepend_delta(first, deltas):
+    """Поток фрагментов, начинающийся с уже прочитанного; закрытие прерывает запрос к LM Studio"""
+    try:
+        yield first
+        yield from deltas
+    finally:
+        deltas.close()
+
+def create_exercise_completion(messages, hsk_level, system_language, temperature, stream=False):
+    """
+    Запрос к LM Studio с response_format по JSON-схеме упражнения.
+    Если сервер не поддерживает json_schema, схема отключается и запрос повторяется без нее.
+    
+    max_tokens берется из бюджета для пары (HSK, язык), генерация останавливается
+    на закрывающей скобке JSON-объекта (EXERCISE_STOP). Возвращает текст ответа, а при stream=True -
+    итератор его фрагментов (закрывающую скобку дописывает вызывающий код).
+    """
+    global structured_output_enabled
+    payload = {
+        "model": "LM Studio",  # В LM Studio это не имеет значения, т.к. модель уже загружена
+        "messages": messages,
+        "temperature": temperature,
+        "max_tokens": token_budget.budget(hsk_level, system_language),
+        "top_p": 0.95,
+        "stop": EXERCISE_STOP
+    }
+    
+    def send(payload):
+        if stream:
+            deltas = lm_router.iter_stream(payload)
+            # Ошибка HTTP проявляется только при чтении первого фрагмента
+            first = next(deltas, None)
+            return deltas if first is None else _prepend_delta(first, deltas)
+        response = run_lm_request(lm_router.chat_completion(payload))
+        token_budget.record_response(hsk_level, system_language, response)
+        # Сервер не включает стоп-последовательность в ответ
+        return restore_json_end(response["choices"][0]["message"]["content"])
+    
+    if structured_output_enabled:
+        try:
+            return send(dict(payload, response_format=exercise_response_format(with_sentence=True)))
+        except LMRequestError as e:
+            if not is_response_format_rejected(e):
+                raise
+            logging.warning(f"LM Studio не принял response_format, переходим на свободный JSON: {str(e)}")
+            structured_output_enabled = False
+            parse_stats.record("schema_rejected")
+    return send(payload)
+
+def generate_exercise_with_gemma(word, hsk_level, system_language, temperature=0.7):
+    """Генерация упражнения с использованием Gemma3-IT-QAT через LM Studio"""
+    try:
+        logging.info(f"Генерация упражнения для слова: {word}, HSK: {hsk_level}, Язык: {system_language}")
+        
+        messages = build_exercise_messages(word, hsk_level, system_language)
+        started = time.time()
+        
+        # Ответ ограничен JSON-схемой, поэтому обычно разбирается без восстановления
+        content = create_exercise_completion(messages, hsk_level, system_language, temperature)
         
-        # Извлекаем сгенерированный контент
-        content = response.choices[0].message.content
         logging.info("Ответ от модели получен успешно")
         logging.debug(f"Ответ: {content[:200]}...")
         
         # Извлекаем JSON из ответа
-        return extract_exercise_data(content, word)
+        result = parse_exercise(content, word, extract_exercise_data, parse_stats)
+        if 'error' not in result:
+            durations.record(STAGE_GENERATION, time.time() - started)
+        return result
         
+    except TaskCancelled:
+        raise
     except Exception as e:
         logging.error(f"Ошибка генерации упражнения: {str(e)}", exc_info=True)
         return {
             "error": f"Ошибка генерации: {str(e)}"
         }
 
+def stream_exercise_events(word, hsk_level, system_language, validate=True, use_cache=True, temperature=0.7):
+    """
+    Генератор SSE-событий для потоковой генерации упражнения.
+    
+    Каждое поле JSON-ответа (sentence_with_gap, options, pinyin, translation, ...)
+    отправляется событием "field", как только модель его допишет. В конце
+    отправляется событие "result" с окончательно обработанным упражнением
+    (или "error"). Повторная генерация в потоковом режиме не выполняется,
+    так как поля уже отправлены клиенту.
+    """
+    if use_cache:
+        cached = cached_exercise(word, hsk_level, system_language, validate)
+        if cached is not None:
+            cached["cached"] = True
+            for field, value in cached.items():
+                yield format_sse("field", {"field": field, "value": value})
+            yield format_sse("result", cached)
+            return
+    
+    try:
+        logging.info(f"Потоковая генерация упражнения для слова: {word}, HSK: {hsk_level}, Язык: {system_language}")
+        stream = create_exercise_completion(
+            build_exercise_messages(word, hsk_level, system_language),
+            hsk_level,
+            system_language,
+            temperature,
+            stream=True
+        )
+        
+        parser = IncrementalFieldParser()
+        for delta in stream:
+            for field, value in parser.feed(delta):
+                yield format_sse("field", {"field": field, "value": value})
+            if parser.done:
+                # JSON-объект завершен: не ждем текст, который модель допишет после него
+                stream.close()
+                break
+        
+        # Окончательная обработка полного ответа тем же путем, что и без потока
+        result = parse_exercise(restore_json_end(parser.buffer), word, extract_exercise_data, parse_stats)
+        if 'error' in result:
+            yield format_sse("error", result)
+            return
+        
+        if validate and validator_enabled:
+            try:
+                validation_result = validate_exercise_timed(result)
+                result["validation"] = {
+                    "is_valid": validation_result.get("is_valid", True),
+                    "confidence": validation_result.get("confidence", 0.0),
+                    "semantic_score": validation_result.get("semantic_score", 0.0),
+                    "distractor_score": validation_result.get("distractor_score", 0.0)
+                }
+            except Exception as e:
+                logging.error(f"Ошибка валидации для '{word}': {str(e)}", exc_info=True)
+                result["validation_error"] = str(e)
+        
+        store_exercise(word, hsk_level, system_language, result)
+        yield format_sse("result", result)
+        
+    except Exception as e:
+        logging.error(f"Ошибка потоковой генерации упражнения: {str(e)}", exc_info=True)
+        yield format_sse("error", {"error": f"Ошибка генерации: {str(e)}"})
+
 def safe_json_parse(json_str, original_word):
     """
     Более надежный парсинг JSON строки с обработкой нестандартных кавычек и 
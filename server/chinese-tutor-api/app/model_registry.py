@@ -0,0 +1,147 @@
+"""
+Реестр моделей LM Studio.
+
+Список загруженных моделей читается из /v1/models в фоновом потоке и
+обновляется по таймеру или сразу после ошибки, поэтому запросы на генерацию
+отправляются напрямую в модель, которая точно загружена, без последовательного
+перебора всех кандидатов. Для каждой модели ведётся статистика задержек.
+"""
+import logging
+import threading
+import time
+from collections import deque
+
+# Сколько последних замеров хранить для перцентилей
+LATENCY_WINDOW = 100
+# Сколько секунд модель с ошибкой считается нежелательной
+FAILURE_COOLDOWN = 30.0
+
+
+class ModelRegistry:
+    def __init__(self, list_models, preferred_models, refresh_interval=60.0):
+        """
+        list_models() -> list[str] возвращает идентификаторы загруженных моделей,
+        preferred_models - модели в порядке предпочтения.
+        """
+        self._list_models = list_models
+        self.preferred_models = list(preferred_models)
+        self.refresh_interval = refresh_interval
+
+        self._lock = threading.Lock()
+        self._loaded = []
+        self._last_refresh = None
+        self._last_error = None
+        self._last_failure = {}
+        self._latency = {}
+
+        self._refresh_requested = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """Запускает фоновое обновление списка моделей (повторный вызов ничего не делает)"""
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._thread = threading.Thread(target=self._refresh_loop, name="model-registry", daemon=True)
+        self._thread.start()
+
+    def _refresh_loop(self):
+        if self._last_refresh is None:
+            self.refresh()
+        while True:
+            self._refresh_requested.wait(self.refresh_interval)
+            self._refresh_requested.clear()
+            self.refresh()
+
+    def refresh(self):
+        """Перечитывает список загруженных моделей; при ошибке сохраняет прежний список"""
+        try:
+            models = list(self._list_models())
+            with self._lock:
+                changed = models != self._loaded
+                self._loaded = models
+                self._last_refresh = time.time()
+                self._last_error = None
+            if changed:
+                logging.info(f"Загруженные модели LM Studio: {models}")
+        except Exception as e:
+            with self._lock:
+                self._last_error = str(e)
+            logging.warning(f"Не удалось обновить список моделей LM Studio: {e}")
+
+    def request_refresh(self):
+        """Просит фоновый поток обновить список моделей вне очереди"""
+        self._refresh_requested.set()
+
+    def candidates(self):
+        """
+        Модели в порядке, в котором их стоит пробовать.
+
+        Загруженные модели из списка предпочтений, а если ни одна из них не загружена -
+        любые загруженные модели. Модели с недавней ошибкой переносятся в конец. Пока
+        список загруженных моделей неизвестен, возвращается список предпочтений целиком.
+        """
+        with self._lock:
+            loaded = list(self._loaded)
+            last_failure = dict(self._last_failure)
+
+        if loaded:
+            ordered = [m for m in self.preferred_models if m in loaded] or loaded
+        else:
+            ordered = list(self.preferred_models)
+
+        now = time.time()
+        healthy = [m for m in ordered if now - last_failure.get(m, 0) > FAILURE_COOLDOWN]
+        return healthy + [m for m in ordered if m not in healthy]
+
+    def resolve(self):
+        """Лучшая модель для следующего запроса"""
+        candidates = self.candidates()
+        return candidates[0] if candidates else None
+
+    def _model_stats(self, model):
+        if model not in self._latency:
+            self._latency[model] = {
+                "requests": 0,
+                "failures": 0,
+                "total_time": 0.0,
+                "window": deque(maxlen=LATENCY_WINDOW)
+            }
+        return self._latency[model]
+
+    def record_success(self, model, seconds):
+        with self._lock:
+            stats = self._model_stats(model)
+            stats["requests"] += 1
+            stats["total_time"] += seconds
+            stats["window"].append(seconds)
+            self._last_failure.pop(model, None)
+
+    def record_failure(self, model, seconds=0.0):
+        """Учитывает ошибку модели и запрашивает внеочередное обновление списка моделей"""
+        with self._lock:
+            stats = self._model_stats(model)
+            stats["requests"] += 1
+            stats["failures"] += 1
+            self._last_failure[model] = time.time()
+        self.request_refresh()
+
+    def stats(self):
+        with self._lock:
+            latency = {}
+            for model, stats in self._latency.items():
+                window = sorted(stats["window"])
+                successes = stats["requests"] - stats["failures"]
+                latency[model] = {
+                    "requests": stats["requests"],
+                    "failures": stats["failures"],
+                    "avg_latency": stats["total_time"] / successes if successes else None,
+                    "p50_latency": window[len(window) // 2] if window else None,
+                    "p95_latency": window[min(len(window) - 1, int(len(window) * 0.95))] if window else None
+                }
+            return {
+                "loaded_models": list(self._loaded),
+                "preferred_models": list(self.preferred_models),
+                "last_refresh": self._last_refresh,
+                "last_error": self._last_error,
+                "latency": latency
+            }
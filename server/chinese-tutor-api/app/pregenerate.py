@@ -0,0 +1,193 @@
+"""
+Офлайн-предгенерация упражнений для целых списков слов HSK.
+
+Генерация (с валидацией и переводом) выполняется в несколько потоков,
+готовые упражнения сохраняются в хранилище упражнений. Прогресс пишется в
+файл контрольной точки, поэтому прерванный запуск можно продолжить с того
+же места: уже обработанные слова повторно не генерируются.
+"""
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+# Результаты обработки одного слова
+STATUS_STORED = "stored"      # упражнение сохранено в хранилище
+STATUS_REJECTED = "rejected"  # упражнение не прошло валидацию
+STATUS_FAILED = "failed"      # ошибка генерации, при повторном запуске слово обрабатывается снова
+
+# Как часто (в обработанных словах) сохранять контрольную точку и выводить прогресс
+CHECKPOINT_EVERY = 20
+
+
+def load_word_list(path):
+    """
+    Читает список слов: одно слово в строке, первая колонка при разделении
+    табуляцией, запятой или пробелом. Пустые строки и строки с # пропускаются.
+    """
+    words = []
+    with open(path, encoding="utf-8-sig") as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            word = line.replace("\t", " ").replace(",", " ").split()[0]
+            words.append(word)
+    # Дубликаты убираем, сохраняя порядок
+    return list(dict.fromkeys(words))
+
+
+class PregenerationCheckpoint:
+    """Файл контрольной точки: статус каждого обработанного ключа (слово, HSK, язык)"""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._statuses = {}
+        if os.path.exists(path):
+            try:
+                with open(path, encoding="utf-8") as f:
+                    self._statuses = json.load(f).get("statuses", {})
+                logging.info(f"Контрольная точка загружена: {path} ({len(self._statuses)} записей)")
+            except (OSError, json.JSONDecodeError) as e:
+                logging.warning(f"Не удалось прочитать контрольную точку {path}, начинаем заново: {e}")
+
+    @staticmethod
+    def _key(word, hsk_level, system_language):
+        return f"{word}|{hsk_level}|{system_language}"
+
+    def is_done(self, word, hsk_level, system_language):
+        """Слово уже сохранено или отклонено валидатором (ошибки генерации повторяются)"""
+        with self._lock:
+            status = self._statuses.get(self._key(word, hsk_level, system_language))
+        return status in (STATUS_STORED, STATUS_REJECTED)
+
+    def mark(self, word, hsk_level, system_language, status):
+        with self._lock:
+            self._statuses[self._key(word, hsk_level, system_language)] = status
+
+    def save(self):
+        """Атомарно записывает контрольную точку (через временный файл)"""
+        with self._lock:
+            data = json.dumps({"updated_at": time.time(), "statuses": self._statuses}, ensure_ascii=False)
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(data)
+        os.replace(tmp_path, self.path)
+
+
+def run_pregeneration(words, hsk_level, languages, generate_one, is_stored,
+                      concurrency=4, checkpoint=None):
+    """
+    Генерирует упражнения для всех пар (слово, язык).
+
+    generate_one(word, hsk_level, system_language) -> STATUS_* выполняет генерацию,
+    валидацию и сохранение; is_stored(word, hsk_level, system_language) -> bool
+    проверяет хранилище. Возвращает словарь со сводкой по пропускной способности.
+    """
+    jobs = []
+    skipped = 0
+    for word in words:
+        for system_language in languages:
+            if is_stored(word, hsk_level, system_language) or (
+                    checkpoint and checkpoint.is_done(word, hsk_level, system_language)):
+                skipped += 1
+            else:
+                jobs.append((word, system_language))
+
+    counts = {STATUS_STORED: 0, STATUS_REJECTED: 0, STATUS_FAILED: 0}
+    durations = []
+    interrupted = False
+    logging.info(f"Предгенерация: {len(jobs)} упражнений в работе, {skipped} уже готовы, потоков: {concurrency}")
+
+    def timed(word, system_language):
+        start_time = time.time()
+        try:
+            status = generate_one(word, hsk_level, system_language)
+        except Exception as e:
+            logging.error(f"Ошибка предгенерации для '{word}' ({system_language}): {e}", exc_info=True)
+            status = STATUS_FAILED
+        return status, time.time() - start_time
+
+    start_time = time.time()
+    pending = {}
+    job_iter = iter(jobs)
+    processed = 0
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="pregenerate") as executor:
+        try:
+            while True:
+                # Держим в работе не больше concurrency задач, чтобы прерывание было быстрым
+                while len(pending) < concurrency:
+                    job = next(job_iter, None)
+                    if job is None:
+                        break
+                    pending[executor.submit(timed, *job)] = job
+                if not pending:
+                    break
+
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    word, system_language = pending.pop(future)
+                    status, seconds = future.result()
+                    counts[status] += 1
+                    durations.append(seconds)
+                    processed += 1
+                    if checkpoint:
+                        checkpoint.mark(word, hsk_level, system_language, status)
+
+                    if processed % CHECKPOINT_EVERY == 0:
+                        if checkpoint:
+                            checkpoint.save()
+                        elapsed = time.time() - start_time
+                        logging.info(
+                            f"Предгенерация: {processed}/{len(jobs)} "
+                            f"({processed / elapsed * 60:.1f} упр./мин)"
+                        )
+        except KeyboardInterrupt:
+            interrupted = True
+            logging.warning("Предгенерация прервана, сохраняем контрольную точку")
+            for future in pending:
+                future.cancel()
+
+    if checkpoint:
+        checkpoint.save()
+
+    elapsed = time.time() - start_time
+    durations.sort()
+    return {
+        "words": len(words),
+        "languages": list(languages),
+        "hsk_level": hsk_level,
+        "total": len(jobs) + skipped,
+        "skipped": skipped,
+        "processed": processed,
+        "stored": counts[STATUS_STORED],
+        "rejected": counts[STATUS_REJECTED],
+        "failed": counts[STATUS_FAILED],
+        "interrupted": interrupted,
+        "elapsed": elapsed,
+        "per_minute": processed / elapsed * 60 if elapsed > 0 else 0.0,
+        "avg_latency": sum(durations) / len(durations) if durations else None,
+        "p95_latency": durations[min(len(durations) - 1, int(len(durations) * 0.95))] if durations else None
+    }
+
+
+def format_summary(summary):
+    """Текстовая сводка для вывода в консоль"""
+    lines = [
+        "=== Pre-generation summary ===",
+        f"- Words: {summary['words']} x languages {','.join(summary['languages'])} (HSK {summary['hsk_level']})",
+        f"- Already in store / checkpoint: {summary['skipped']}",
+        f"- Processed: {summary['processed']} "
+        f"(stored: {summary['stored']}, rejected: {summary['rejected']}, failed: {summary['failed']})",
+        f"- Elapsed: {summary['elapsed']:.1f} s, throughput: {summary['per_minute']:.1f} exercises/min",
+    ]
+    if summary["avg_latency"] is not None:
+        lines.append(
+            f"- Latency per exercise: avg {summary['avg_latency']:.2f} s, p95 {summary['p95_latency']:.2f} s"
+        )
+    if summary["interrupted"]:
+        lines.append("- Interrupted: run the same command again to resume")
+    return "\n".join(lines)
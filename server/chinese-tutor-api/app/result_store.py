@@ -0,0 +1,127 @@
+"""
+Хранилище результатов асинхронных задач с ограниченным временем жизни.
+
+Сроки истечения хранятся в min-куче, поэтому устаревшие записи удаляются за
+O(log n) при каждом обращении, без полного просмотра словаря. Количество
+записей и их суммарный размер ограничены: при превышении лимитов первыми
+вытесняются записи, которые истекут раньше всех.
+"""
+import heapq
+import itertools
+import json
+import threading
+import time
+
+DEFAULT_TTL = 300
+DEFAULT_MAX_ENTRIES = 10000
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+
+
+def _record_size(record):
+    """Приблизительный размер записи: длина ее JSON-представления"""
+    try:
+        return len(json.dumps(record, ensure_ascii=False, default=str))
+    except (TypeError, ValueError):
+        return len(str(record))
+
+
+class ResultStore:
+    def __init__(self, ttl=DEFAULT_TTL, max_entries=DEFAULT_MAX_ENTRIES, max_bytes=DEFAULT_MAX_BYTES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+
+        self._lock = threading.Lock()
+        # task_id -> (record, expires_at, size)
+        self._entries = {}
+        # (expires_at, порядковый номер, task_id); записи перезаписанных задач удаляются лениво
+        self._expiry = []
+        self._counter = itertools.count()
+        self._bytes = 0
+
+        self.expired = 0
+        self.evicted_entries = 0
+        self.evicted_bytes = 0
+
+    def _remove(self, task_id):
+        record, expires_at, size = self._entries.pop(task_id)
+        self._bytes -= size
+
+    def _pop_earliest(self):
+        """Удаляет запись, истекающую раньше всех; возвращает False, если записей нет"""
+        while self._expiry:
+            expires_at, _, task_id = heapq.heappop(self._expiry)
+            entry = self._entries.get(task_id)
+            if entry is not None and entry[1] == expires_at:
+                self._remove(task_id)
+                return True
+        return False
+
+    def _expire(self, now):
+        while self._expiry and self._expiry[0][0] <= now:
+            expires_at, _, task_id = heapq.heappop(self._expiry)
+            entry = self._entries.get(task_id)
+            if entry is not None and entry[1] == expires_at:
+                self._remove(task_id)
+                self.expired += 1
+        # Куча очищается от устаревших ссылок, если их накопилось слишком много
+        if len(self._expiry) > 2 * len(self._entries) + 64:
+            self._expiry = [item for item in self._expiry
+                            if item[2] in self._entries and self._entries[item[2]][1] == item[0]]
+            heapq.heapify(self._expiry)
+
+    def put(self, task_id, record, ttl=None):
+        """Сохраняет результат задачи на ttl секунд (по умолчанию self.ttl)"""
+        now = time.time()
+        expires_at = now + (self.ttl if ttl is None else ttl)
+        size = _record_size(record)
+        with self._lock:
+            self._expire(now)
+            if task_id in self._entries:
+                self._remove(task_id)
+            self._entries[task_id] = (record, expires_at, size)
+            self._bytes += size
+            heapq.heappush(self._expiry, (expires_at, next(self._counter), task_id))
+
+            while len(self._entries) > self.max_entries and self._pop_earliest():
+                self.evicted_entries += 1
+            while self._bytes > self.max_bytes and len(self._entries) > 1 and self._pop_earliest():
+                self.evicted_bytes += 1
+
+    def get(self, task_id):
+        """Результат задачи или None, если его нет или он истек"""
+        now = time.time()
+        with self._lock:
+            self._expire(now)
+            entry = self._entries.get(task_id)
+            return entry[0] if entry is not None else None
+
+    def __contains__(self, task_id):
+        return self.get(task_id) is not None
+
+    def pop(self, task_id):
+        with self._lock:
+            entry = self._entries.get(task_id)
+            if entry is None:
+                return None
+            self._remove(task_id)
+            return entry[0]
+
+    def __len__(self):
+        with self._lock:
+            self._expire(time.time())
+            return len(self._entries)
+
+    def stats(self):
+        with self._lock:
+            self._expire(time.time())
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_entries": self.max_entries,
+                "max_bytes": self.max_bytes,
+                "ttl": self.ttl,
+                "expired": self.expired,
+                "evicted_entries": self.evicted_entries,
+                "evicted_bytes": self.evicted_bytes
+            }
@@ -0,0 +1,96 @@
+"""
+Single-flight: объединение одинаковых одновременных запросов на генерацию.
+
+Если упражнение для ключа (word, hsk_level, system_language) уже генерируется,
+повторные запросы не запускают новую генерацию в LM Studio, а ждут результат
+первого запроса и получают его копию.
+"""
+import copy
+import logging
+import threading
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.waiters = 0
+
+
+class SingleFlight:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+        self.executed = 0
+        self.coalesced = 0
+
+    def do(self, key, fn):
+        """
+        Выполняет fn() для ключа, если для него еще нет выполняющегося вызова,
+        иначе дожидается уже запущенного вызова. Исключение fn() получают все
+        ожидающие. Ожидающие получают глубокую копию результата, чтобы изменения
+        в одном ответе не затрагивали другие.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            if call is not None:
+                call.waiters += 1
+                self.coalesced += 1
+                leader = False
+            else:
+                call = _Call()
+                self._calls[key] = call
+                self.executed += 1
+                leader = True
+
+        if not leader:
+            logging.info(f"Запрос {key} присоединен к уже выполняющейся генерации")
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return copy.deepcopy(call.result)
+
+        try:
+            call.result = fn()
+            return call.result
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                # Брошенный вызов (abandon) уже убран, под ключом может быть новый
+                if self._calls.get(key) is call:
+                    del self._calls[key]
+            # Копии для ожидающих делаются до того, как вызывающий код успеет изменить результат
+            if call.waiters and call.error is None:
+                call.result = copy.deepcopy(call.result)
+            call.done.set()
+
+    def abandon(self, key):
+        """
+        Отказ от выполняющегося вызова, если его результат никто не ждет: вызов
+        убирается из таблицы, и новые запросы с этим ключом запускают свой.
+        Проверка ожидающих и отказ выполняются под одной блокировкой, поэтому
+        запрос не может присоединиться к вызову, который затем прервут.
+        Возвращает True, если вызов можно прерывать.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            if call is None:
+                return True
+            if call.waiters:
+                return False
+            del self._calls[key]
+            return True
+
+    def stats(self):
+        with self._lock:
+            total = self.executed + self.coalesced
+            return {
+                "in_flight": len(self._calls),
+                "executed": self.executed,
+                "coalesced": self.coalesced,
+                "coalesce_rate": self.coalesced / total if total else 0.0
+            }
@@ -0,0 +1,113 @@
+"""
+Потоковая выдача упражнений: инкрементальный разбор JSON-ответа модели
+и форматирование событий Server-Sent Events.
+"""
+import json
+import logging
+
+
+def format_sse(event, data):
+    """Форматирует одно событие Server-Sent Events"""
+    payload = json.dumps(data, ensure_ascii=False)
+    return f"event: {event}\ndata: {payload}\n\n"
+
+
+class IncrementalFieldParser:
+    """
+    Инкрементальный парсер JSON-объекта верхнего уровня.
+
+    Принимает ответ модели кусками по мере генерации и возвращает поля
+    объекта сразу, как только значение поля полностью получено.
+    Текст до первой открывающей скобки (например, ```json) пропускается.
+    """
+
+    def __init__(self):
+        self.buffer = ""
+        self.fields = {}
+        self.done = False
+        self._pos = 0
+        self._started = False
+        self._depth = 0
+        self._in_string = False
+        self._escaped = False
+        self._key_start = None
+        self._key = None
+        self._value_start = None
+
+    def feed(self, text):
+        """Добавляет очередной фрагмент и возвращает список завершённых полей (key, value)"""
+        self.buffer += text
+        completed = []
+
+        while self._pos < len(self.buffer) and not self.done:
+            index = self._pos
+            char = self.buffer[index]
+            self._pos += 1
+
+            if not self._started:
+                if char == '{':
+                    self._started = True
+                    self._depth = 1
+                continue
+
+            if self._in_string:
+                if self._escaped:
+                    self._escaped = False
+                elif char == '\\':
+                    self._escaped = True
+                elif char == '"':
+                    self._in_string = False
+                    if self._depth == 1:
+                        if self._key is None and self._value_start is None:
+                            self._key = self._decode(self._key_start, index + 1)
+                        elif self._value_start is not None and self.buffer[self._value_start] == '"':
+                            # Строковое значение готово сразу на закрывающей кавычке
+                            self._finish_value(index + 1, completed)
+                continue
+
+            if char == '"':
+                self._in_string = True
+                if self._depth == 1:
+                    if self._key is None:
+                        self._key_start = index
+                    elif self._value_start is None:
+                        self._value_start = index
+                continue
+
+            if (self._depth == 1 and self._key is not None and self._value_start is None
+                    and char not in ' \t\r\n:'):
+                self._value_start = index
+
+            if char in '[{':
+                self._depth += 1
+            elif char in ']}':
+                self._depth -= 1
+                if self._depth == 0:
+                    self._finish_value(index, completed)
+                    self.done = True
+                elif self._depth == 1 and self._value_start is not None:
+                    # Массив или вложенный объект на верхнем уровне закрыт
+                    self._finish_value(index + 1, completed)
+            elif char == ',' and self._depth == 1:
+                self._finish_value(index, completed)
+
+        return completed
+
+    def _decode(self, start, end):
+        try:
+            return json.loads(self.buffer[start:end])
+        except json.JSONDecodeError:
+            return None
+
+    def _finish_value(self, end, completed):
+        if self._key is not None and self._value_start is not None:
+            raw = self.buffer[self._value_start:end].strip()
+            try:
+                value = json.loads(raw)
+                self.fields[self._key] = value
+                completed.append((self._key, value))
+            except json.JSONDecodeError:
+                logging.debug(f"Не удалось разобрать значение поля '{self._key}': {raw[:50]}")
+        self._key_start = None
+        self._key = None
+        self._value_start = None
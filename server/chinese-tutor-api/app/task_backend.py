@@ -0,0 +1,651 @@
+"""
+Хранилища очереди и результатов асинхронных задач генерации.
+
+MemoryTaskBackend - очередь и результаты в памяти процесса (по умолчанию).
+SqliteTaskBackend - очередь и результаты в SQLite-файле (WAL): задачи
+переживают перезапуск сервера, а несколько процессов на одной машине могут
+разбирать общую очередь. Задача забирается атомарно (claim) и подтверждается
+записью результата (complete). Пока задача выполняется, процесс периодически
+продлевает свои claim (heartbeat); если процесс упал и перестал их продлевать,
+через visibility_timeout секунд задача снова становится доступной. Результат
+записывает только обработчик, которому принадлежит текущий claim.
+
+Оба хранилища имеют одинаковый интерфейс: submit, get (claim), complete,
+get_result, wait_result, position, cancel, is_cancel_requested,
+find_by_idempotency_key, depth, drain_rate, stats, close.
+
+Повторная отправка задачи с тем же ключом идемпотентности (заголовок
+Idempotency-Key) возвращает уже созданную задачу, а не ставит новую.
+"""
+import json
+import logging
+import os
+import queue
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from collections import deque
+from contextlib import contextmanager
+
+from task_queue import PriorityTaskQueue, PRIORITIES, PRIORITY_PREFETCH, PREFETCH_AGING
+from result_store import ResultStore, DEFAULT_TTL, DEFAULT_MAX_ENTRIES, DEFAULT_MAX_BYTES
+
+DEFAULT_TASK_DB_PATH = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data", "tasks.sqlite3"
+)
+
+# Через сколько секунд задача без продления claim снова выдается другому обработчику
+VISIBILITY_TIMEOUT = 300.0
+# Сколько раз за visibility_timeout продлеваются claim выполняющихся задач
+HEARTBEATS_PER_TIMEOUT = 3
+# Сколько раз задача может быть выдана, прежде чем она завершится ошибкой
+MAX_ATTEMPTS = 3
+# Как часто другие процессы проверяют очередь на новые задачи
+POLL_INTERVAL = 0.5
+# Как часто удалять результаты с истекшим сроком хранения
+PURGE_INTERVAL = 60.0
+# Сколько идентификаторов задач передается в одном SQL-запросе (лимит параметров SQLite)
+BATCH_QUERY_SIZE = 500
+# Сколько хранится ключ идемпотентности задачи, которая еще не завершилась
+IDEMPOTENCY_TTL = 3600
+# Окно, по которому считается скорость разбора очереди (задач в секунду)
+DRAIN_WINDOW = 60.0
+
+# Результаты cancel()
+CANCEL_CANCELLED = "cancelled"    # задача убрана из очереди
+CANCEL_REQUESTED = "cancelling"   # задача выполняется, обработчик прервет ее при ближайшей проверке
+CANCEL_FINISHED = "finished"      # задача уже завершилась
+
+
+class TaskCancelled(Exception):
+    """Выполнение задачи прервано, потому что клиент ее отменил"""
+
+
+def cancelled_record():
+    return {
+        "status": "cancelled",
+        "message": "Задача отменена",
+        "created_at": time.time()
+    }
+
+
+class _CompletionWaiters:
+    """События завершения задач для ожидающих клиентов (long-poll, SSE)"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # task_id -> [событие, число ожидающих]
+        self._events = {}
+
+    @contextmanager
+    def waiting(self, task_id):
+        with self._lock:
+            entry = self._events.setdefault(task_id, [threading.Event(), 0])
+            entry[1] += 1
+        try:
+            yield entry[0]
+        finally:
+            with self._lock:
+                entry[1] -= 1
+                # Событие удаляется вместе с последним ожидающим, чтобы не копить события
+                # для задач, которые так и не завершились
+                if entry[1] == 0 and self._events.get(task_id) is entry:
+                    del self._events[task_id]
+
+    def notify(self, task_id):
+        with self._lock:
+            entry = self._events.get(task_id)
+        if entry is not None:
+            entry[0].set()
+
+    def count(self):
+        with self._lock:
+            return sum(entry[1] for entry in self._events.values())
+
+
+class _TaskBackend:
+    """Общее ожидание результата для хранилищ задач (наследники определяют get_result)"""
+
+    # Интервал повторной проверки результата; None - результат приходит только из этого процесса
+    result_poll_interval = None
+
+    def __init__(self):
+        self._waiters = _CompletionWaiters()
+        self.started_at = time.time()
+
+    def _drain_span(self, window, now, oldest=None):
+        """
+        Длина окна скорости разбора: сразу после запуска окно короче window,
+        если только в окне нет завершений, записанных раньше (другими процессами)
+        """
+        since = self.started_at if oldest is None else min(self.started_at, oldest)
+        return max(1.0, min(window, now - since))
+
+    def get_results(self, task_ids):
+        """Результаты нескольких задач: task_id -> результат или None"""
+        return {task_id: self.get_result(task_id) for task_id in task_ids}
+
+    def wait_result(self, task_id, timeout):
+        """Результат задачи; если его еще нет, ждет завершения не дольше timeout секунд"""
+        result = self.get_result(task_id)
+        # not timeout > 0 отсекает и NaN: с ним цикл ожидания никогда бы не завершился
+        if result is not None or not timeout > 0:
+            return result
+        deadline = time.time() + timeout
+        with self._waiters.waiting(task_id) as event:
+            # Повторная проверка: задача могла завершиться до регистрации ожидающего
+            result = self.get_result(task_id)
+            while result is None:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                interval = self.result_poll_interval
+                event.wait(remaining if interval is None else min(interval, remaining))
+                result = self.get_result(task_id)
+        return result
+
+
+class MemoryTaskBackend(_TaskBackend):
+    """Очередь с приоритетами и хранилище результатов в памяти процесса"""
+
+    name = "memory"
+
+    def __init__(self, prefetch_aging=PREFETCH_AGING, result_ttl=DEFAULT_TTL,
+                 max_entries=DEFAULT_MAX_ENTRIES, max_bytes=DEFAULT_MAX_BYTES):
+        super().__init__()
+        self.queue = PriorityTaskQueue(prefetch_aging=prefetch_aging)
+        self.results = ResultStore(ttl=result_ttl, max_entries=max_entries, max_bytes=max_bytes)
+        # Ключ идемпотентности -> task_id; после завершения задачи ключ живет столько же, сколько результат
+        self.idempotency = ResultStore(ttl=IDEMPOTENCY_TTL, max_entries=max_entries)
+
+        self._lock = threading.Lock()
+        self._task_keys = {}
+        # task_id -> время, когда задачу забрал обработчик
+        self._running = {}
+        self._cancel_requested = set()
+        # Время завершения недавних задач для скорости разбора очереди
+        self._completions = deque()
+        self.cancelled = 0
+
+    def submit(self, task_id, payload, priority, idempotency_key=None):
+        """Ставит задачу в очередь; возвращает task_id (для повторного ключа - ID уже созданной задачи)"""
+        if idempotency_key:
+            with self._lock:
+                existing = self.idempotency.get(idempotency_key)
+                if existing is not None:
+                    return existing
+                self.idempotency.put(idempotency_key, task_id)
+                self._task_keys[task_id] = idempotency_key
+        self.queue.put((task_id, payload), priority)
+        return task_id
+
+    def find_by_idempotency_key(self, idempotency_key):
+        return self.idempotency.get(idempotency_key)
+
+    def get(self, timeout=None):
+        """Следующая задача (task_id, payload); queue.Empty, если за timeout задач не появилось"""
+        task = self.queue.get(timeout=timeout)
+        with self._lock:
+            self._running[task[0]] = time.time()
+        return task
+
+    def complete(self, task_id, record):
+        """Сохраняет результат задачи; возвращает True (в памяти claim не может быть потерян)"""
+        self.results.put(task_id, record)
+        with self._lock:
+            self._running.pop(task_id, None)
+            self._cancel_requested.discard(task_id)
+            idempotency_key = self._task_keys.pop(task_id, None)
+            if idempotency_key is not None:
+                self.idempotency.put(idempotency_key, task_id, ttl=self.results.ttl)
+            now = time.time()
+            self._completions.append(now)
+            while self._completions and self._completions[0] < now - DRAIN_WINDOW:
+                self._completions.popleft()
+        self._waiters.notify(task_id)
+        return True
+
+    def position(self, task_id):
+        """
+        Состояние незавершенной задачи: {"state": "queued", "tasks_ahead": N} или
+        {"state": "running", "started_at": ...}; None, если задача не в очереди и не выполняется
+        """
+        ahead = self.queue.position(lambda item: item[0] == task_id)
+        if ahead is not None:
+            return {"state": "queued", "tasks_ahead": ahead}
+        with self._lock:
+            started_at = self._running.get(task_id)
+        if started_at is not None:
+            return {"state": "running", "started_at": started_at}
+        return None
+
+    def cancel(self, task_id):
+        """Отменяет задачу: из очереди удаляет сразу, выполняющуюся помечает для прерывания"""
+        if self.queue.remove(lambda item: item[0] == task_id):
+            self.complete(task_id, cancelled_record())
+            with self._lock:
+                self.cancelled += 1
+            return CANCEL_CANCELLED
+        with self._lock:
+            if task_id in self._running:
+                self._cancel_requested.add(task_id)
+                return CANCEL_REQUESTED
+        if self.results.get(task_id) is not None:
+            return CANCEL_FINISHED
+        return None
+
+    def is_cancel_requested(self, task_id):
+        with self._lock:
+            return task_id in self._cancel_requested
+
+    def depth(self):
+        """Число задач в очереди по приоритетам"""
+        return self.queue.stats()["depth"]
+
+    def drain_rate(self, window=DRAIN_WINDOW):
+        """Сколько задач в секунду завершалось за последние window секунд"""
+        now = time.time()
+        with self._lock:
+            recent = sum(1 for finished_at in self._completions if finished_at >= now - window)
+        return recent / self._drain_span(window, now)
+
+    def get_result(self, task_id):
+        return self.results.get(task_id)
+
+    def stats(self):
+        return {
+            "backend": self.name,
+            "queue": self.queue.stats(),
+            "results": self.results.stats(),
+            "idempotency_keys": len(self.idempotency),
+            "cancelled": self.cancelled,
+            "waiting_clients": self._waiters.count()
+        }
+
+    def close(self):
+        pass
+
+
+class SqliteTaskBackend(_TaskBackend):
+    """Очередь и результаты в SQLite (WAL), общие для всех процессов на машине"""
+
+    name = "sqlite"
+
+    def __init__(self, db_path=None, prefetch_aging=PREFETCH_AGING, result_ttl=DEFAULT_TTL,
+                 visibility_timeout=VISIBILITY_TIMEOUT, max_attempts=MAX_ATTEMPTS,
+                 poll_interval=POLL_INTERVAL):
+        super().__init__()
+        self.db_path = db_path or os.environ.get("TASK_DB_PATH", DEFAULT_TASK_DB_PATH)
+        self.prefetch_aging = prefetch_aging
+        self.result_ttl = result_ttl
+        self.visibility_timeout = visibility_timeout
+        self.max_attempts = max_attempts
+        self.poll_interval = poll_interval
+        # Задачу мог завершить другой процесс, поэтому ожидающие клиенты периодически проверяют базу
+        self.result_poll_interval = poll_interval
+        self.worker_prefix = f"{socket.gethostname()}:{os.getpid()}"
+
+        self._lock = threading.Lock()
+        # Будит обработчики этого процесса сразу после submit, другие процессы опрашивают базу
+        self._new_task = threading.Event()
+        self._last_purge = 0.0
+        # task_id -> идентификатор claim задач, выполняющихся в этом процессе
+        self._claims = {}
+        self._heartbeat_thread = None
+        self._closed = threading.Event()
+
+        self.claimed = 0
+        self.redelivered = 0
+        self.abandoned = 0
+        self.cancelled = 0
+        self.lost_claims = 0
+
+        directory = os.path.dirname(self.db_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        # Транзакции управляются явно (BEGIN IMMEDIATE), чтобы claim был атомарным между процессами
+        self._conn = sqlite3.connect(self.db_path, check_same_thread=False, isolation_level=None, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS tasks (
+                task_id TEXT PRIMARY KEY,
+                payload TEXT NOT NULL,
+                priority TEXT NOT NULL,
+                rank REAL NOT NULL,
+                status TEXT NOT NULL,
+                enqueued_at REAL NOT NULL,
+                visible_at REAL NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                worker TEXT,
+                result TEXT,
+                finished_at REAL,
+                idempotency_key TEXT,
+                cancel_requested INTEGER NOT NULL DEFAULT 0,
+                started_at REAL
+            )
+        """)
+        # Базы, созданные до появления отмены, ключей идемпотентности и продления claim
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(tasks)")}
+        if "idempotency_key" not in columns:
+            self._conn.execute("ALTER TABLE tasks ADD COLUMN idempotency_key TEXT")
+        if "cancel_requested" not in columns:
+            self._conn.execute("ALTER TABLE tasks ADD COLUMN cancel_requested INTEGER NOT NULL DEFAULT 0")
+        if "started_at" not in columns:
+            self._conn.execute("ALTER TABLE tasks ADD COLUMN started_at REAL")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_tasks_claim ON tasks (status, rank)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_tasks_visible ON tasks (status, visible_at)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_tasks_finished ON tasks (status, finished_at)")
+        self._conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_tasks_idempotency ON tasks (idempotency_key)")
+
+        queued = self._conn.execute("SELECT COUNT(*) FROM tasks WHERE status != 'done'").fetchone()[0]
+        logging.info(f"Очередь задач SQLite открыта: {self.db_path} (незавершенных задач: {queued})")
+
+    def _find_by_idempotency_key(self, idempotency_key):
+        row = self._conn.execute(
+            "SELECT task_id FROM tasks WHERE idempotency_key = ?", (idempotency_key,)
+        ).fetchone()
+        return row[0] if row is not None else None
+
+    def find_by_idempotency_key(self, idempotency_key):
+        with self._lock:
+            return self._find_by_idempotency_key(idempotency_key)
+
+    def submit(self, task_id, payload, priority, idempotency_key=None):
+        """Ставит задачу в очередь; возвращает task_id (для повторного ключа - ID уже созданной задачи)"""
+        if priority not in PRIORITIES:
+            raise ValueError(f"Неизвестный приоритет: {priority}")
+        now = time.time()
+        # Порядок выдачи: время постановки плюс смещение класса (то же старение, что и в памяти)
+        rank = now + (self.prefetch_aging if priority == PRIORITY_PREFETCH else 0.0)
+        with self._lock:
+            if idempotency_key:
+                existing = self._find_by_idempotency_key(idempotency_key)
+                if existing is not None:
+                    return existing
+            try:
+                self._conn.execute(
+                    "INSERT INTO tasks (task_id, payload, priority, rank, status, enqueued_at, visible_at, "
+                    "idempotency_key) VALUES (?, ?, ?, ?, 'queued', ?, ?, ?)",
+                    (task_id, json.dumps(payload, ensure_ascii=False), priority, rank, now, now,
+                     idempotency_key or None)
+                )
+            except sqlite3.IntegrityError:
+                # Тот же ключ одновременно отправлен в другой процесс
+                existing = self._find_by_idempotency_key(idempotency_key) if idempotency_key else None
+                if existing is None:
+                    raise
+                return existing
+        self._new_task.set()
+        return task_id
+
+    def _requeue_expired(self, now):
+        """Возвращает в очередь задачи упавших обработчиков; исчерпавшие попытки завершает ошибкой"""
+        expired = self._conn.execute(
+            "SELECT task_id, attempts, cancel_requested FROM tasks WHERE status = 'running' AND visible_at <= ?",
+            (now,)
+        ).fetchall()
+        for task_id, attempts, cancel_requested in expired:
+            if cancel_requested:
+                # Отмененную задачу упавшего обработчика повторно не выполняем
+                self._conn.execute(
+                    "UPDATE tasks SET status = 'done', result = ?, finished_at = ? WHERE task_id = ?",
+                    (json.dumps(cancelled_record(), ensure_ascii=False), now, task_id)
+                )
+                self.cancelled += 1
+            elif attempts >= self.max_attempts:
+                record = {
+                    "status": "error",
+                    "error": f"Задача не завершена за {attempts} попыток",
+                    "created_at": now
+                }
+                self._conn.execute(
+                    "UPDATE tasks SET status = 'done', result = ?, finished_at = ? WHERE task_id = ?",
+                    (json.dumps(record, ensure_ascii=False), now, task_id)
+                )
+                self.abandoned += 1
+                logging.error(f"Задача {task_id} не завершена за {attempts} попыток")
+            else:
+                self._conn.execute("UPDATE tasks SET status = 'queued' WHERE task_id = ?", (task_id,))
+                self.redelivered += 1
+                logging.warning(f"Задача {task_id} не подтверждена вовремя, возвращена в очередь")
+
+    def _purge(self, now):
+        if now - self._last_purge < PURGE_INTERVAL:
+            return
+        self._last_purge = now
+        deleted = self._conn.execute(
+            "DELETE FROM tasks WHERE status = 'done' AND finished_at < ?", (now - self.result_ttl,)
+        ).rowcount
+        if deleted:
+            logging.info(f"Удалено устаревших результатов задач: {deleted}")
+
+    def _claim(self):
+        now = time.time()
+        # Идентификатор claim уникален для каждой выдачи, даже если задачу повторно получит тот же поток
+        worker = f"{self.worker_prefix}:{threading.current_thread().name}:{uuid.uuid4().hex[:8]}"
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._requeue_expired(now)
+                self._purge(now)
+                row = self._conn.execute(
+                    "SELECT task_id, payload FROM tasks WHERE status = 'queued' ORDER BY rank LIMIT 1"
+                ).fetchone()
+                if row is not None:
+                    self._conn.execute(
+                        "UPDATE tasks SET status = 'running', visible_at = ?, attempts = attempts + 1, worker = ?, "
+                        "started_at = ? WHERE task_id = ?",
+                        (now + self.visibility_timeout, worker, now, row[0])
+                    )
+                    self.claimed += 1
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+            if row is None:
+                return None
+            self._claims[row[0]] = worker
+        self._start_heartbeat()
+        return row[0], json.loads(row[1])
+
+    def _start_heartbeat(self):
+        with self._lock:
+            if self._heartbeat_thread is not None:
+                return
+            self._heartbeat_thread = threading.Thread(target=self._heartbeat_loop, name="task-heartbeat", daemon=True)
+        self._heartbeat_thread.start()
+
+    def _heartbeat_loop(self):
+        interval = self.visibility_timeout / HEARTBEATS_PER_TIMEOUT
+        while not self._closed.wait(interval):
+            try:
+                self.heartbeat()
+            except Exception as e:
+                logging.error(f"Не удалось продлить claim задач: {str(e)}")
+
+    def heartbeat(self):
+        """
+        Продлевает claim задач, которые выполняются в этом процессе, чтобы долгая
+        генерация (ожидание сервера модели, повторы, best-of) не была выдана повторно
+        """
+        with self._lock:
+            if self._closed.is_set():
+                return
+            visible_at = time.time() + self.visibility_timeout
+            for task_id, worker in self._claims.items():
+                extended = self._conn.execute(
+                    "UPDATE tasks SET visible_at = ? WHERE task_id = ? AND worker = ? AND status = 'running'",
+                    (visible_at, task_id, worker)
+                ).rowcount
+                if not extended:
+                    logging.warning(f"Claim задачи {task_id} потерян: задача выдана другому обработчику или завершена")
+
+    def get(self, timeout=None):
+        """Атомарно забирает следующую задачу (task_id, payload); queue.Empty по истечении timeout"""
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            self._new_task.clear()
+            task = self._claim()
+            if task is not None:
+                return task
+            remaining = None if deadline is None else deadline - time.time()
+            if remaining is not None and remaining <= 0:
+                raise queue.Empty
+            wait = self.poll_interval if remaining is None else min(self.poll_interval, remaining)
+            self._new_task.wait(wait)
+
+    def complete(self, task_id, record):
+        """
+        Подтверждает задачу: сохраняет результат, после чего задача больше не выдается.
+        Результат записывается, только если claim задачи все еще принадлежит этому
+        обработчику; возвращает True, если результат сохранен.
+        """
+        with self._lock:
+            worker = self._claims.pop(task_id, None)
+            recorded = worker is not None and self._conn.execute(
+                "UPDATE tasks SET status = 'done', result = ?, finished_at = ? "
+                "WHERE task_id = ? AND worker = ? AND status = 'running'",
+                (json.dumps(record, ensure_ascii=False), time.time(), task_id, worker)
+            ).rowcount > 0
+            if not recorded:
+                self.lost_claims += 1
+        if not recorded:
+            logging.warning(f"Результат задачи {task_id} не сохранен: claim принадлежит другому обработчику")
+            return False
+        self._waiters.notify(task_id)
+        return True
+
+    def get_result(self, task_id):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT result FROM tasks WHERE task_id = ? AND status = 'done' AND finished_at >= ?",
+                (task_id, time.time() - self.result_ttl)
+            ).fetchone()
+        return json.loads(row[0]) if row is not None else None
+
+    def get_results(self, task_ids):
+        """Результаты нескольких задач одним запросом на каждые BATCH_QUERY_SIZE идентификаторов"""
+        task_ids = list(task_ids)
+        results = dict.fromkeys(task_ids)
+        min_finished = time.time() - self.result_ttl
+        with self._lock:
+            for start in range(0, len(task_ids), BATCH_QUERY_SIZE):
+                chunk = task_ids[start:start + BATCH_QUERY_SIZE]
+                placeholders = ", ".join("?" * len(chunk))
+                rows = self._conn.execute(
+                    f"SELECT task_id, result FROM tasks WHERE task_id IN ({placeholders}) "
+                    f"AND status = 'done' AND finished_at >= ?",
+                    (*chunk, min_finished)
+                ).fetchall()
+                for task_id, result in rows:
+                    results[task_id] = json.loads(result)
+        return results
+
+    def position(self, task_id):
+        """
+        Состояние незавершенной задачи: {"state": "queued", "tasks_ahead": N} или
+        {"state": "running", "started_at": ...}; None, если задача завершена или неизвестна
+        """
+        with self._lock:
+            row = self._conn.execute(
+                # Задачи, забранные до появления started_at: время claim восстанавливается по visible_at
+                "SELECT status, rank, COALESCE(started_at, visible_at - ?) FROM tasks WHERE task_id = ?",
+                (self.visibility_timeout, task_id)
+            ).fetchone()
+            if row is None or row[0] == "done":
+                return None
+            if row[0] == "running":
+                return {"state": "running", "started_at": row[2]}
+            ahead = self._conn.execute(
+                "SELECT COUNT(*) FROM tasks WHERE status = 'queued' AND rank < ?", (row[1],)
+            ).fetchone()[0]
+        return {"state": "queued", "tasks_ahead": ahead}
+
+    def cancel(self, task_id):
+        """Отменяет задачу: из очереди удаляет сразу, выполняющуюся помечает для прерывания"""
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._conn.execute("SELECT status FROM tasks WHERE task_id = ?", (task_id,)).fetchone()
+                status = row[0] if row is not None else None
+                outcome = None
+                if status == "queued":
+                    self._conn.execute(
+                        "UPDATE tasks SET status = 'done', result = ?, finished_at = ? WHERE task_id = ?",
+                        (json.dumps(cancelled_record(), ensure_ascii=False), time.time(), task_id)
+                    )
+                    self.cancelled += 1
+                    outcome = CANCEL_CANCELLED
+                elif status == "running":
+                    self._conn.execute("UPDATE tasks SET cancel_requested = 1 WHERE task_id = ?", (task_id,))
+                    outcome = CANCEL_REQUESTED
+                elif status == "done":
+                    outcome = CANCEL_FINISHED
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        if outcome == CANCEL_CANCELLED:
+            self._waiters.notify(task_id)
+        return outcome
+
+    def is_cancel_requested(self, task_id):
+        """Запрошена ли отмена задачи (в том числе из другого процесса)"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT cancel_requested FROM tasks WHERE task_id = ?", (task_id,)
+            ).fetchone()
+        return bool(row and row[0])
+
+    def depth(self):
+        """Число задач в очереди по приоритетам (общей для всех процессов)"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT priority, COUNT(*) FROM tasks WHERE status = 'queued' GROUP BY priority"
+            ).fetchall()
+        depth = {priority: 0 for priority in PRIORITIES}
+        depth.update(rows)
+        return depth
+
+    def drain_rate(self, window=DRAIN_WINDOW):
+        """Сколько задач в секунду завершалось за последние window секунд во всех процессах"""
+        now = time.time()
+        with self._lock:
+            recent, oldest = self._conn.execute(
+                "SELECT COUNT(*), MIN(finished_at) FROM tasks WHERE status = 'done' AND finished_at >= ?",
+                (now - window,)
+            ).fetchone()
+        return recent / self._drain_span(window, now, oldest)
+
+    def stats(self):
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT status, priority, COUNT(*) FROM tasks GROUP BY status, priority"
+            ).fetchall()
+            running_here = len(self._claims)
+        counts = {}
+        for status, priority, count in rows:
+            counts.setdefault(status, {})[priority] = count
+        return {
+            "backend": self.name,
+            "db_path": self.db_path,
+            "tasks": counts,
+            "claimed": self.claimed,
+            "redelivered": self.redelivered,
+            "abandoned": self.abandoned,
+            "cancelled": self.cancelled,
+            "lost_claims": self.lost_claims,
+            "running_here": running_here,
+            "waiting_clients": self._waiters.count(),
+            "visibility_timeout": self.visibility_timeout,
+            "result_ttl": self.result_ttl
+        }
+
+    def close(self):
+        self._closed.set()
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,122 @@
+"""
+Очередь задач генерации с классами приоритета.
+
+Задачи interactive (пользователь ждет упражнение на экране) выдаются раньше
+задач prefetch (фоновая предзагрузка колоды). Чтобы prefetch не голодали,
+используется старение: задача prefetch, ожидающая дольше PREFETCH_AGING секунд,
+выдается наравне со свежей interactive.
+"""
+import queue
+import threading
+import time
+from collections import deque
+
+PRIORITY_INTERACTIVE = "interactive"
+PRIORITY_PREFETCH = "prefetch"
+PRIORITIES = (PRIORITY_INTERACTIVE, PRIORITY_PREFETCH)
+
+# Через сколько секунд ожидания prefetch сравнивается с новой interactive задачей
+PREFETCH_AGING = 30.0
+
+
+class PriorityTaskQueue:
+    def __init__(self, prefetch_aging=PREFETCH_AGING):
+        self.prefetch_aging = prefetch_aging
+        # Внутри класса порядок FIFO, поэтому в голове очереди всегда самая старая задача
+        self._queues = {priority: deque() for priority in PRIORITIES}
+        self._offsets = {PRIORITY_INTERACTIVE: 0.0, PRIORITY_PREFETCH: prefetch_aging}
+        self._not_empty = threading.Condition()
+
+        self.dispatched = {priority: 0 for priority in PRIORITIES}
+        self.aged_dispatches = 0
+
+    def put(self, item, priority=PRIORITY_INTERACTIVE):
+        if priority not in self._queues:
+            raise ValueError(f"Неизвестный приоритет: {priority}")
+        with self._not_empty:
+            self._queues[priority].append((time.time(), item))
+            self._not_empty.notify()
+
+    def _pop(self):
+        """Задача с наименьшей оценкой: смещение класса минус время ожидания"""
+        now = time.time()
+        best = None
+        for priority in PRIORITIES:
+            if self._queues[priority]:
+                enqueued_at = self._queues[priority][0][0]
+                score = self._offsets[priority] - (now - enqueued_at)
+                if best is None or score < best[0]:
+                    best = (score, priority)
+        if best is None:
+            return None
+
+        priority = best[1]
+        if priority == PRIORITY_PREFETCH and self._queues[PRIORITY_INTERACTIVE]:
+            self.aged_dispatches += 1
+        self.dispatched[priority] += 1
+        return self._queues[priority].popleft()[1]
+
+    def get(self, block=True, timeout=None):
+        """Следующая задача; при пустой очереди ждет или выбрасывает queue.Empty"""
+        with self._not_empty:
+            deadline = None if timeout is None else time.time() + timeout
+            while True:
+                item = self._pop()
+                if item is not None:
+                    return item
+                if not block:
+                    raise queue.Empty
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    raise queue.Empty
+                self._not_empty.wait(remaining)
+
+    def remove(self, match):
+        """Удаляет из очереди первую задачу, для которой match(item) истинно; True, если задача найдена"""
+        with self._not_empty:
+            for q in self._queues.values():
+                for index, (enqueued_at, item) in enumerate(q):
+                    if match(item):
+                        del q[index]
+                        return True
+        return False
+
+    def position(self, match):
+        """
+        Сколько задач будет выдано раньше первой задачи, для которой match(item) истинно;
+        None, если такой задачи в очереди нет. Порядок выдачи - по времени постановки
+        плюс смещение класса, как в _pop.
+        """
+        with self._not_empty:
+            target = None
+            for priority, q in self._queues.items():
+                for enqueued_at, item in q:
+                    if match(item):
+                        target = enqueued_at + self._offsets[priority]
+                        break
+                if target is not None:
+                    break
+            if target is None:
+                return None
+            return sum(
+                1
+                for priority, q in self._queues.items()
+                for enqueued_at, _ in q
+                if enqueued_at + self._offsets[priority] < target
+            )
+
+    def qsize(self):
+        with self._not_empty:
+            return sum(len(q) for q in self._queues.values())
+
+    def stats(self):
+        now = time.time()
+        with self._not_empty:
+            return {
+                "depth": {priority: len(q) for priority, q in self._queues.items()},
+                "oldest_wait": {
+                    priority: now - q[0][0] if q else 0.0 for priority, q in self._queues.items()
+                },
+                "dispatched": dict(self.dispatched),
+                "aged_dispatches": self.aged_dispatches
+            }
@@ -0,0 +1,147 @@
+"""
+Ограничение длины генерации упражнений.
+
+1. Стоп-последовательность на закрывающей скобке JSON-объекта: модель не тратит
+   время на пояснения после JSON. Сервер не включает стоп-последовательность в
+   ответ, поэтому скобка дописывается обратно (restore_json_end).
+   LM Studio ищет стоп-последовательности в сыром тексте, не различая строки JSON,
+   поэтому одиночная "}" обрезала бы ответ на скобке внутри значения.
+2. Адаптивный max_tokens для каждой пары (HSK, язык): бюджет вычисляется по
+   скользящему окну реальных длин ответов (usage.completion_tokens) как
+   высокий перцентиль с запасом. Пока данных мало, используется значение по умолчанию.
+"""
+import logging
+import math
+import threading
+from collections import deque
+
+# Перевод строки внутри строки JSON экранируется, поэтому "\n}" встречается только
+# вне строк - на закрывающей скобке объекта, записанного с отступами (как в примере
+# промпта). Компактный JSON в одну строку эта последовательность не останавливает:
+# тогда ответ завершает JSON-схема (конец объекта), а при потоке - IncrementalFieldParser.done
+EXERCISE_STOP = ["\n}"]
+
+# Параметры бюджета по умолчанию
+DEFAULT_MAX_TOKENS = 600
+MIN_MAX_TOKENS = 150
+WINDOW_SIZE = 200
+MIN_SAMPLES = 20
+PERCENTILE = 0.99
+HEADROOM = 1.2
+# Ширина корзины гистограммы в /stats
+HISTOGRAM_BUCKET = 50
+
+
+def _unclosed_braces(text):
+    """Число незакрытых "{" вне строк JSON, начиная с первой открывающей скобки"""
+    depth = 0
+    in_string = False
+    escaped = False
+    start = text.find("{")
+    for char in text[start:] if start >= 0 else "":
+        if in_string:
+            if escaped:
+                escaped = False
+            elif char == "\\":
+                escaped = True
+            elif char == '"':
+                in_string = False
+        elif char == '"':
+            in_string = True
+        elif char == "{":
+            depth += 1
+        elif char == "}":
+            depth -= 1
+    return depth
+
+
+def restore_json_end(content):
+    """Дописывает закрывающую скобку, отрезанную стоп-последовательностью (скобки в строках не считаются)"""
+    if content is None:
+        return None
+    stripped = content.rstrip()
+    if _unclosed_braces(stripped) > 0:
+        return stripped + "}"
+    return content
+
+
+class TokenBudget:
+    def __init__(self, default=DEFAULT_MAX_TOKENS, minimum=MIN_MAX_TOKENS, maximum=None,
+                 window=WINDOW_SIZE, min_samples=MIN_SAMPLES, percentile=PERCENTILE, headroom=HEADROOM):
+        self.default = default
+        self.minimum = minimum
+        self.maximum = maximum or default
+        self.window = window
+        self.min_samples = min_samples
+        self.percentile = percentile
+        self.headroom = headroom
+
+        self._lock = threading.Lock()
+        self._samples = {}
+        self._truncations = {}
+
+    @staticmethod
+    def _key(hsk_level, system_language):
+        return f"{hsk_level}:{system_language}"
+
+    def _compute(self, samples):
+        if len(samples) < self.min_samples:
+            return self.default
+        ordered = sorted(samples)
+        observed = ordered[min(len(ordered) - 1, int(len(ordered) * self.percentile))]
+        return max(self.minimum, min(self.maximum, math.ceil(observed * self.headroom)))
+
+    def budget(self, hsk_level, system_language):
+        """max_tokens для следующего запроса с этими HSK и языком"""
+        with self._lock:
+            samples = self._samples.get(self._key(hsk_level, system_language))
+            return self._compute(samples) if samples else self.default
+
+    def record(self, hsk_level, system_language, completion_tokens, truncated=False):
+        """
+        Учитывает длину ответа. Если ответ обрезан по max_tokens, настоящая длина
+        неизвестна, поэтому учитывается максимальный бюджет: это быстро поднимает
+        перцентиль и следующие запросы получают больше токенов.
+        """
+        key = self._key(hsk_level, system_language)
+        with self._lock:
+            samples = self._samples.setdefault(key, deque(maxlen=self.window))
+            if truncated:
+                self._truncations[key] = self._truncations.get(key, 0) + 1
+                samples.append(self.maximum)
+                logging.warning(f"Ответ для {key} обрезан по max_tokens ({completion_tokens} токенов)")
+            elif completion_tokens:
+                samples.append(int(completion_tokens))
+
+    def record_response(self, hsk_level, system_language, response):
+        """Учитывает ответ chat completion (поля usage и finish_reason)"""
+        usage = response.get("usage") or {}
+        choices = response.get("choices") or [{}]
+        self.record(
+            hsk_level, system_language,
+            usage.get("completion_tokens"),
+            truncated=choices[0].get("finish_reason") == "length"
+        )
+
+    def stats(self):
+        with self._lock:
+            result = {}
+            for key, samples in self._samples.items():
+                ordered = sorted(samples)
+                histogram = {}
+                for tokens in ordered:
+                    bucket = tokens // HISTOGRAM_BUCKET * HISTOGRAM_BUCKET
+                    label = f"{bucket}-{bucket + HISTOGRAM_BUCKET - 1}"
+                    histogram[label] = histogram.get(label, 0) + 1
+                result[key] = {
+                    "samples": len(ordered),
+                    "p50": ordered[len(ordered) // 2] if ordered else None,
+                    "p95": ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))] if ordered else None,
+                    "max_tokens": self._compute(ordered) if ordered else self.default,
+                    "truncations": self._truncations.get(key, 0),
+                    "histogram": histogram
+                }
+            return {
+                "default_max_tokens": self.default,
+                "budgets": result
+            }
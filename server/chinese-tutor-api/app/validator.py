@@ -1,17 +1,38 @@
-from transformers import pipeline, BertForMaskedLM, BertTokenizer
+from transformers import BertForMaskedLM, BertTokenizer
 import torch
 import re
 import numpy as np
 import logging
 import os
 import time
+import atexit
+
+from embedding_cache import OptionEmbeddingCache
+from validator_backends import BACKEND_TORCH, create_encoder
+
+# Сколько упражнений проверяется за один прогон модели
+VALIDATION_BATCH_SIZE = 16
+# Сколько лучших предсказаний модели учитывается при оценке места пропуска
+GAP_PLACEMENT_TOP_K = 5
+
+# Пороги для semantic_score - доли вероятности правильного ответа среди вариантов
+# (при 4 вариантах случайному выбору соответствует 0.25).
+# Порог confidence: при типичной оценке дистракторов 0.8-0.9 упражнение принимается,
+# если доля правильного ответа не ниже 0.4-0.47, т.е. заметно выше случайной
+VALID_CONFIDENCE_THRESHOLD = 0.6
+# Ниже этой доли дистракторы вместе подходят к пропуску не хуже правильного ответа
+SEMANTIC_HINT_THRESHOLD = 0.5
+# Оценка, если модель не смогла оценить варианты: вместе с оценкой дистракторов
+# по умолчанию (0.6) дает confidence 0.66, и ошибка модели не отклоняет упражнение
+SEMANTIC_DEFAULT_SCORE = 0.7
 
 class ContentValidator:
-    def __init__(self):
+    def __init__(self, backend=None):
+        """backend - бэкенд кодировщика (torch, torch-int8, onnx-int8), по умолчанию из VALIDATOR_BACKEND"""
         logging.info("Инициализация валидатора на основе BERT-Chinese-WWM")
         self.model = None
         self.tokenizer = None
-        self.fill_mask_pipeline = None
+        self.encoder = None
         
         # Путь для локального кэширования моделей
         models_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "models")
@@ -37,14 +58,6 @@ class ContentValidator:
                 
                 self.model.eval()
                 
-                # Создаем pipeline для семантического анализа текста
-                logging.info("Инициализация fill-mask pipeline")
-                self.fill_mask_pipeline = pipeline(
-                    "fill-mask", 
-                    model=self.model,
-                    tokenizer=self.tokenizer
-                )
-                
                 logging.info(f"Модель {self.model_name} успешно загружена")
                 break
                 
@@ -65,7 +78,6 @@ class ContentValidator:
                         self.tokenizer = BertTokenizer.from_pretrained(self.model_name, local_files_only=False)
                         self.model = BertForMaskedLM.from_pretrained(self.model_name, local_files_only=False)
                         self.model.eval()
-                        self.fill_mask_pipeline = pipeline("fill-mask", model=self.model, tokenizer=self.tokenizer)
                         
                         logging.warning(f"Используется запасная модель {self.model_name}")
                     except Exception as fallback_error:
@@ -75,60 +87,142 @@ class ContentValidator:
         # Проверяем, что модель загружена
         if self.model is None or self.tokenizer is None:
             logging.critical("Не удалось инициализировать модели. Валидация будет всегда возвращать положительный результат.")
+        else:
+            # Кодировщик (fp32 или квантованный INT8), через который идут все прогоны модели
+            self.encoder = create_encoder(
+                backend or os.environ.get("VALIDATOR_BACKEND", BACKEND_TORCH),
+                self.model, models_dir, self.model_name
+            )
+            logging.info(f"Бэкенд валидатора: {self.encoder.name}")
+        
+        # Эмбеддинги вариантов ответов кэшируются между проверками (в памяти и на диске).
+        # Эмбеддинги квантованных бэкендов немного отличаются от fp32, поэтому кэш у каждого бэкенда свой
+        cache_path = os.environ.get("VALIDATOR_EMBEDDING_CACHE", os.path.join(models_dir, "option_embeddings"))
+        cache_model_name = getattr(self, "model_name", None)
+        if self.encoder is not None and self.encoder.name != BACKEND_TORCH:
+            cache_path += f".{self.encoder.name}"
+            cache_model_name = f"{cache_model_name}:{self.encoder.name}"
+        self.embedding_cache = OptionEmbeddingCache(cache_path, model_name=cache_model_name)
+        atexit.register(self.embedding_cache.flush)
     
     def validate_exercise(self, exercise_data):
         """Основной метод проверки упражнения"""
-        try:
-            logging.info(f"Валидация упражнения: {exercise_data.get('sentence_with_gap', '')}")
-            
-            # Проверка наличия необходимых полей
-            required_fields = ["sentence_with_gap", "options", "answer", "pinyin"]
-            if not all(field in exercise_data for field in required_fields):
-                logging.warning("Отсутствуют обязательные поля в упражнении")
-                return {
-                    "is_valid": False,
-                    "confidence": 0.0,
-                    "reason": "Отсутствуют необходимые поля"
-                }
-            
-            sentence = exercise_data["sentence_with_gap"]
-            options = exercise_data["options"]
-            correct_answer = exercise_data["answer"]
-            
-            # Базовые проверки
-            if not self._basic_checks(sentence, options, correct_answer):
-                return {
-                    "is_valid": False,
-                    "confidence": 0.0,
-                    "reason": "Упражнение не прошло базовые проверки"
-                }
-            
-            # Проверяем смысловую когерентность предложения с правильным ответом
-            semantic_score = self._evaluate_semantic_coherence(sentence, correct_answer)
-            
-            # Проверяем качество дистракторов (неправильных вариантов)
-            distractors = [opt for opt in options if opt != correct_answer]
-            distractor_scores = self._evaluate_distractors(sentence, distractors, correct_answer)
-            
-            # Оценка уверенности в правильности упражнения
-            confidence = semantic_score * 0.6 + distractor_scores * 0.4
-            
-            result = {
-                "is_valid": confidence > 0.6,  # Пороговое значение для принятия упражнения
-                "confidence": float(confidence),
-                "semantic_score": float(semantic_score),
-                "distractor_score": float(distractor_scores),
-                "improvements": []
-            }
-            
-            # Рекомендации по улучшению упражнения при необходимости
-            if semantic_score < 0.7:
-                result["improvements"].append("Предложение не очень естественно звучит с выбранным словом")
-            if distractor_scores < 0.5:
-                result["improvements"].append("Варианты ответов недостаточно близки/различимы по контексту")
+        return self.validate_exercises([exercise_data])[0]
+    
+    def validate_exercises(self, exercises):
+        """
+        Проверка списка упражнений (кандидатов best-of-N, пакетов); результаты в том же порядке.
+        
+        Все варианты ответов всех упражнений, подставленные в пропуск, оцениваются
+        одним прогоном модели с дополнением (padding) до общей длины; эмбеддинги
+        вариантов для оценки дистракторов считаются вторым прогоном.
+        Результат для каждого упражнения совпадает с проверкой по одному.
+        """
+        results = [None] * len(exercises)
+        # (индекс, предложение, варианты, правильный ответ) для упражнений, прошедших базовые проверки
+        pending = []
+        
+        for index, exercise_data in enumerate(exercises):
+            try:
+                logging.info(f"Валидация упражнения: {exercise_data.get('sentence_with_gap', '')}")
+                
+                # Проверка наличия необходимых полей
+                required_fields = ["sentence_with_gap", "options", "answer", "pinyin"]
+                if not all(field in exercise_data for field in required_fields):
+                    logging.warning("Отсутствуют обязательные поля в упражнении")
+                    results[index] = {
+                        "is_valid": False,
+                        "confidence": 0.0,
+                        "reason": "Отсутствуют необходимые поля"
+                    }
+                    continue
                 
-            # Подробное логирование результатов валидации
-            validation_log = f"""
+                sentence = exercise_data["sentence_with_gap"]
+                options = exercise_data["options"]
+                correct_answer = exercise_data["answer"]
+                
+                # Базовые проверки
+                if not self._basic_checks(sentence, options, correct_answer):
+                    results[index] = {
+                        "is_valid": False,
+                        "confidence": 0.0,
+                        "reason": "Упражнение не прошло базовые проверки"
+                    }
+                    continue
+                
+                pending.append((index, sentence, options, correct_answer))
+            except Exception as e:
+                results[index] = self._error_result(e)
+        
+        for start in range(0, len(pending), VALIDATION_BATCH_SIZE):
+            chunk = pending[start:start + VALIDATION_BATCH_SIZE]
+            try:
+                # Проверяем, насколько правильный ответ подходит к предложению лучше дистракторов
+                semantic_scores = self._evaluate_semantic_coherence(
+                    [(sentence, options, correct_answer) for _, sentence, options, correct_answer in chunk]
+                )
+                
+                # Проверяем качество дистракторов (неправильных вариантов)
+                distractor_scores = self._evaluate_distractors([
+                    (sentence, [opt for opt in options if opt != correct_answer], correct_answer)
+                    for _, sentence, options, correct_answer in chunk
+                ])
+                
+                for (index, sentence, options, correct_answer), (semantic_score, option_scores), distractor_score in zip(
+                        chunk, semantic_scores, distractor_scores):
+                    results[index] = self._build_result(
+                        sentence, options, correct_answer, semantic_score, distractor_score, option_scores
+                    )
+            except Exception as e:
+                if len(chunk) > 1:
+                    # Повторная проверка по одному: ошибка затрагивает только свое упражнение
+                    for index, *_ in chunk:
+                        results[index] = self.validate_exercise(exercises[index])
+                else:
+                    results[chunk[0][0]] = self._error_result(e)
+        
+        return results
+    
+    def stats(self):
+        return {
+            "model": getattr(self, "model_name", None),
+            "backend": self.encoder.name if self.encoder is not None else None,
+            "embedding_cache": self.embedding_cache.stats()
+        }
+    
+    def _error_result(self, error):
+        logging.error(f"Ошибка при валидации: {str(error)}", exc_info=True)
+        return {
+            "is_valid": True,  # В случае ошибки считаем валидным, чтобы не блокировать работу
+            "confidence": 0.5,
+            "reason": f"Ошибка валидации: {str(error)}"
+        }
+    
+    def _build_result(self, sentence, options, correct_answer, semantic_score, distractor_scores, option_scores):
+        """Итоговая оценка упражнения по оценкам связности и дистракторов"""
+        # Оценка уверенности в правильности упражнения
+        confidence = semantic_score * 0.6 + distractor_scores * 0.4
+        
+        result = {
+            "is_valid": confidence > VALID_CONFIDENCE_THRESHOLD,
+            "confidence": float(confidence),
+            "semantic_score": float(semantic_score),
+            "distractor_score": float(distractor_scores),
+            # Вероятность каждого варианта в пропуске по мнению модели
+            "option_scores": {option: float(score) for option, score in option_scores.items()},
+            "improvements": []
+        }
+        
+        # Рекомендации по улучшению упражнения при необходимости
+        if semantic_score < SEMANTIC_HINT_THRESHOLD:
+            result["improvements"].append("Предложение не очень естественно звучит с выбранным словом")
+        if option_scores and max(option_scores, key=option_scores.get) != correct_answer:
+            result["improvements"].append("Один из неправильных вариантов подходит к пропуску лучше правильного ответа")
+        if distractor_scores < 0.5:
+            result["improvements"].append("Варианты ответов недостаточно близки/различимы по контексту")
+            
+        # Подробное логирование результатов валидации
+        validation_log = f"""
 === BERT-Chinese-WWM Validation Details ===
 - Sentence: {sentence}
 - Options: {options}
@@ -137,26 +231,27 @@ class ContentValidator:
 - Confidence: {result['confidence']:.4f}
 - Semantic Score: {result['semantic_score']:.4f}
 - Distractor Score: {result['distractor_score']:.4f}
+- Option Scores: {', '.join(f'{option}={score:.3f}' for option, score in result['option_scores'].items())}
 """
-            if result['improvements']:
-                validation_log += "- Suggestions for improvement:\n"
-                for imp in result['improvements']:
-                    validation_log += f"  * {imp}\n"
-                    
-            logging.info(validation_log)
-            
-            return result
-            
-        except Exception as e:
-            logging.error(f"Ошибка при валидации: {str(e)}", exc_info=True)
-            return {
-                "is_valid": True,  # В случае ошибки считаем валидным, чтобы не блокировать работу
-                "confidence": 0.5,
-                "reason": f"Ошибка валидации: {str(e)}"
-            }
+        if result['improvements']:
+            validation_log += "- Suggestions for improvement:\n"
+            for imp in result['improvements']:
+                validation_log += f"  * {imp}\n"
+                
+        logging.info(validation_log)
+        
+        return result
     
     def _basic_checks(self, sentence, options, correct_answer):
         """Быстрые проверки без использования модели"""
+        if not isinstance(sentence, str) or not isinstance(correct_answer, str) or not isinstance(options, list):
+            logging.warning("Предложение, ответ или варианты имеют неверный тип")
+            return False
+        
+        if not all(isinstance(option, str) and option.strip() for option in options):
+            logging.warning("Варианты ответа должны быть непустыми строками")
+            return False
+            
         if len(options) < 2:
             logging.warning("Слишком мало вариантов ответа")
             return False
@@ -175,120 +270,210 @@ class ContentValidator:
             
         return True
     
-    def _evaluate_semantic_coherence(self, sentence_with_gap, correct_answer):
-        """Оценка семантической связности предложения с правильным ответом"""
+    def _masked_log_probs(self, rows):
+        """
+        Логарифмы вероятностей словаря в заданных позициях: rows - список
+        (id токенов с [CLS]/[SEP], позиции). Все строки дополняются до общей длины
+        и проходят через кодировщик выбранного бэкенда одним прогоном; голова MLM
+        применяется только к нужным позициям, а не ко всем токенам всех строк.
+        """
+        max_length = max(len(token_ids) for token_ids, _ in rows)
+        input_ids = torch.full((len(rows), max_length), self.tokenizer.pad_token_id, dtype=torch.long)
+        attention_mask = torch.zeros((len(rows), max_length), dtype=torch.long)
+        for row, (token_ids, _) in enumerate(rows):
+            input_ids[row, :len(token_ids)] = torch.tensor(token_ids, dtype=torch.long)
+            attention_mask[row, :len(token_ids)] = 1
+        
+        with torch.no_grad():
+            hidden = self.encoder.encode(input_ids, attention_mask)
+            row_index = torch.tensor([row for row, (_, positions) in enumerate(rows) for _ in positions], dtype=torch.long)
+            position_index = torch.tensor([pos for _, positions in rows for pos in positions], dtype=torch.long)
+            log_probs = self.encoder.mlm_logits(hidden[row_index, position_index]).log_softmax(dim=-1)
+        
+        return list(log_probs.split([len(positions) for _, positions in rows]))
+    
+    def _gap_rows(self, sentence_with_gap, options):
+        """
+        Строки для оценки вариантов: пропуск заменяется на столько [MASK],
+        сколько токенов в варианте. Возвращает (id токенов, позиции масок, id токенов варианта).
+        """
+        before, _, after = sentence_with_gap.partition("____")
+        left = self.tokenizer.convert_tokens_to_ids(self.tokenizer.tokenize(before))
+        right = self.tokenizer.convert_tokens_to_ids(self.tokenizer.tokenize(after))
+        rows = []
+        for option in options:
+            option_ids = self.tokenizer.convert_tokens_to_ids(self.tokenizer.tokenize(option))
+            token_ids = (
+                [self.tokenizer.cls_token_id] + left
+                + [self.tokenizer.mask_token_id] * len(option_ids)
+                + right + [self.tokenizer.sep_token_id]
+            )
+            positions = list(range(1 + len(left), 1 + len(left) + len(option_ids)))
+            rows.append((token_ids, positions, option_ids))
+        return rows
+    
+    def _evaluate_semantic_coherence(self, items):
+        """
+        Оценка семантической связности: items - (предложение с пропуском, варианты, правильный ответ).
+        
+        Каждый вариант (правильный ответ и дистракторы) подставляется в пропуск как
+        последовательность [MASK] по числу его токенов, и по логитам MLM считается
+        средний логарифм вероятности его токенов. Все варианты всех упражнений
+        оцениваются одним прогоном. Оценка связности - доля вероятности правильного
+        ответа среди всех вариантов: она высокая, только если модель предпочитает
+        правильный ответ дистракторам. Возвращает список (оценка, вероятности вариантов).
+        """
         try:
-            # Заменяем пропуск на правильное слово
-            full_sentence = sentence_with_gap.replace("____", correct_answer)
-            
-            # Заменяем правильное слово на маску для проверки предсказаний BERT
-            masked_sentence = full_sentence.replace(correct_answer, self.tokenizer.mask_token, 1)
-            
-            # Получаем предсказания модели
-            predictions = self.fill_mask_pipeline(masked_sentence)
-            
-            # Извлекаем вероятности для топ-5 предсказаний
-            top_predictions = [(p["token_str"], p["score"]) for p in predictions]
-            
-            # Ищем наш правильный ответ среди предсказаний
-            for pred, score in top_predictions:
-                if correct_answer in pred or pred in correct_answer:
-                    return float(score)  # Если точное совпадение, возвращаем вероятность
-            
-            # Если нет точного совпадения, берем близость к топ-1 предсказанию
-            # Чем меньше вероятность топ-1, тем менее уверена модель, что правильнее было бы другое слово
-            return float(1.0 - top_predictions[0][1])
+            rows = []
+            spans = []
+            for sentence_with_gap, options, _ in items:
+                options = list(dict.fromkeys(options))
+                spans.append((options, len(rows)))
+                rows.extend(self._gap_rows(sentence_with_gap, options))
+            
+            log_probs = self._masked_log_probs([(token_ids, positions) for token_ids, positions, _ in rows])
+            
+            # Средний логарифм вероятности токенов варианта: длинные слова не штрафуются за длину
+            option_scores = []
+            for (_, _, option_ids), row_log_probs in zip(rows, log_probs):
+                if not option_ids:
+                    option_scores.append(float("-inf"))
+                    continue
+                token_log_probs = row_log_probs[torch.arange(len(option_ids)), torch.tensor(option_ids)]
+                option_scores.append(float(token_log_probs.mean()))
+            
+            results = []
+            for (_, _, correct_answer), (options, offset) in zip(items, spans):
+                scores = torch.tensor(option_scores[offset:offset + len(options)])
+                if torch.isinf(scores).all():
+                    # Ни один вариант не разбился на токены: softmax дал бы NaN
+                    results.append((SEMANTIC_DEFAULT_SCORE, {}))
+                    continue
+                probabilities = dict(zip(options, scores.softmax(dim=0).tolist()))
+                results.append((float(probabilities.get(correct_answer, 0.0)), probabilities))
+            return results
             
         except Exception as e:
+            if len(items) > 1:
+                # Ошибка одного упражнения не должна сбрасывать оценки остальных: оцениваем по одному
+                return [result for item in items for result in self._evaluate_semantic_coherence([item])]
             logging.error(f"Ошибка при оценке семантической связности: {str(e)}")
-            return 0.7  # Значение по умолчанию
+            return [(SEMANTIC_DEFAULT_SCORE, {})]
     
-    def _evaluate_distractors(self, sentence_with_gap, distractors, correct_answer):
-        """Оценка качества отвлекающих вариантов"""
+    def _option_embeddings(self, words):
+        """
+        Эмбеддинги слов: известные берутся из кэша, остальные считаются моделью
+        одним прогоном и добавляются в кэш
+        """
+        found, missing = self.embedding_cache.get_many(words)
+        if missing:
+            computed = self._compute_option_embeddings(missing)
+            self.embedding_cache.put_many({word: vector.numpy() for word, vector in computed.items()})
+            found.update({word: vector.numpy() for word, vector in computed.items()})
+        return {word: torch.from_numpy(np.asarray(found[word], dtype=np.float32)) for word in words}
+    
+    def _compute_option_embeddings(self, words):
+        """
+        Эмбеддинги слов: среднее последнего слоя по токенам слова.
+        Позиции дополнения (padding) в среднее не входят, поэтому эмбеддинг
+        слова не зависит от того, с какими словами оно попало в один прогон.
+        """
+        inputs = self.tokenizer(words, padding=True, return_tensors="pt")
+        with torch.no_grad():
+            hidden = self.encoder.encode(inputs["input_ids"], inputs["attention_mask"])
+        
+        mask = inputs["attention_mask"].unsqueeze(-1).to(hidden.dtype)
+        embeddings = (hidden * mask).sum(dim=1) / mask.sum(dim=1)
+        
+        # Нормализуем эмбеддинги
+        embeddings = embeddings / embeddings.norm(dim=1, keepdim=True)
+        return dict(zip(words, embeddings))
+    
+    def _evaluate_distractors(self, items):
+        """Оценка качества отвлекающих вариантов: items - (предложение, дистракторы, правильный ответ)"""
         try:
-            # Заменяем пропуск на MASK-токен для BERT
-            masked_sentence = sentence_with_gap.replace("____", self.tokenizer.mask_token)
-            
-            # Получаем эмбеддинги для всех вариантов
-            inputs = self.tokenizer(
-                [correct_answer] + distractors, 
-                padding=True, 
-                return_tensors="pt"
-            )
-            
-            with torch.no_grad():
-                outputs = self.model.bert(**{
-                    k: v for k, v in inputs.items() if k != 'token_type_ids'
-                })
+            # Эмбеддинги всех различных вариантов всех упражнений - одним прогоном
+            words = list(dict.fromkeys(
+                word for _, distractors, correct_answer in items for word in [correct_answer] + distractors
+            ))
+            embeddings = self._option_embeddings(words)
+            
+            scores = []
+            for _, distractors, correct_answer in items:
+                if not distractors:
+                    scores.append(0.6)  # Значение по умолчанию
+                    continue
                 
-            # Усредняем эмбеддинги последнего слоя
-            embeddings = outputs.last_hidden_state.mean(dim=1)
-            
-            # Нормализуем эмбеддинги
-            embeddings = embeddings / embeddings.norm(dim=1, keepdim=True)
-            
-            # Вычисляем косинусную близость между правильным ответом и дистракторами
-            correct_embedding = embeddings[0].unsqueeze(0)
-            distractor_embeddings = embeddings[1:]
-            
-            similarities = torch.matmul(correct_embedding, distractor_embeddings.transpose(0, 1)).squeeze()
-            similarities = similarities.cpu().numpy()
-            
-            # Средняя схожесть не должна быть слишком высокой (слишком похожие варианты)
-            # и не должна быть слишком низкой (слишком очевидные неправильные варианты)
-            avg_similarity = np.mean(similarities)
-            
-            # Идеальная схожесть около 0.5-0.7 (достаточно близко, но не идентично)
-            target_similarity = 0.6
-            
-            # Оценка качества дистракторов (чем ближе к целевой схожести, тем лучше)
-            distractor_score = 1.0 - abs(avg_similarity - target_similarity)
-            return float(distractor_score)
+                # Вычисляем косинусную близость между правильным ответом и дистракторами
+                correct_embedding = embeddings[correct_answer].unsqueeze(0)
+                distractor_embeddings = torch.stack([embeddings[word] for word in distractors])
+                
+                similarities = torch.matmul(correct_embedding, distractor_embeddings.transpose(0, 1)).squeeze(0)
+                similarities = similarities.cpu().numpy()
+                
+                # Средняя схожесть не должна быть слишком высокой (слишком похожие варианты)
+                # и не должна быть слишком низкой (слишком очевидные неправильные варианты)
+                avg_similarity = np.mean(similarities)
+                
+                # Идеальная схожесть около 0.5-0.7 (достаточно близко, но не идентично)
+                target_similarity = 0.6
+                
+                # Оценка качества дистракторов (чем ближе к целевой схожести, тем лучше)
+                scores.append(float(1.0 - abs(avg_similarity - target_similarity)))
+            return scores
             
         except Exception as e:
+            if len(items) > 1:
+                return [score for item in items for score in self._evaluate_distractors([item])]
             logging.error(f"Ошибка при оценке дистракторов: {str(e)}")
-            return 0.6  # Значение по умолчанию
+            return [0.6]  # Значение по умолчанию
             
     def analyze_gap_placement(self, full_sentence, gap_word):
-        """Анализ правильности размещения пропуска в предложении"""
+        """
+        Анализ правильности размещения пропуска в предложении.
+        
+        Для каждого вхождения слова в предложение строится вариант, где токены
+        слова заменены на [MASK]; все варианты проходят через модель одним
+        прогоном. Позиция оценивается по месту токенов слова среди лучших
+        GAP_PLACEMENT_TOP_K предсказаний в каждой маске: чем выше, тем лучше.
+        """
         try:
             # Разбиваем предложение на токены
-            tokens = self.tokenizer.tokenize(full_sentence)
+            token_ids = self.tokenizer.convert_tokens_to_ids(self.tokenizer.tokenize(full_sentence))
+            
+            # Токены слова, которое будет заменено на пропуск
+            word_ids = self.tokenizer.convert_tokens_to_ids(self.tokenizer.tokenize(gap_word))
+            if not word_ids:
+                return []
+            
+            # Варианты предложения с пропуском в каждом месте, где стоит слово
+            candidates = [
+                i for i in range(len(token_ids) - len(word_ids) + 1)
+                if token_ids[i:i + len(word_ids)] == word_ids
+            ]
+            if not candidates:
+                return []
+            
+            rows = []
+            for i in candidates:
+                masked_ids = list(token_ids)
+                masked_ids[i:i + len(word_ids)] = [self.tokenizer.mask_token_id] * len(word_ids)
+                rows.append((
+                    [self.tokenizer.cls_token_id] + masked_ids + [self.tokenizer.sep_token_id],
+                    list(range(1 + i, 1 + i + len(word_ids)))
+                ))
+            log_probs = self._masked_log_probs(rows)
             
-            # Находим индекс слова, которое будет заменено на пропуск
-            word_tokens = self.tokenizer.tokenize(gap_word)
-            
-            # Для каждого возможного места пропуска оцениваем вероятность
             positions = []
-            for i in range(len(tokens) - len(word_tokens) + 1):
-                potential_gap = tokens[i:i+len(word_tokens)]
-                
-                # Пропускаем, если не совпадает с искомым словом
-                joined = self.tokenizer.convert_tokens_to_string(potential_gap)
-                if gap_word not in joined:
-                    continue
-                
-                # Заменяем эту позицию на маску и оцениваем перплексию
-                masked_tokens = tokens.copy()
-                for j in range(i, i + len(word_tokens)):
-                    if j < len(masked_tokens):
-                        masked_tokens[j] = self.tokenizer.mask_token
-                
-                masked_sentence = self.tokenizer.convert_tokens_to_string(masked_tokens)
-                
-                # Предсказываем варианты для этой позиции
-                predictions = self.fill_mask_pipeline(masked_sentence)
-                
-                # Если правильное слово входит в топ предсказаний, это хорошая позиция для пропуска
-                top_predictions = [p["token_str"] for p in predictions]
+            for i, row_log_probs in zip(candidates, log_probs):
+                top_predictions = row_log_probs.topk(GAP_PLACEMENT_TOP_K, dim=-1).indices.tolist()
+                # Если токен слова входит в топ предсказаний, это хорошая позиция для пропуска
                 score = 0.0
-                for pred_idx, pred in enumerate(top_predictions):
-                    if gap_word in pred or pred in gap_word:
-                        # Чем выше позиция в списке, тем лучше
-                        score = float(1.0 - (pred_idx / len(top_predictions)))
-                        break
+                for predictions, word_id in zip(top_predictions, word_ids):
+                    if word_id in predictions:
+                        score += 1.0 - predictions.index(word_id) / GAP_PLACEMENT_TOP_K
                 
-                positions.append({"position": int(i), "score": float(score)})
+                positions.append({"position": int(i), "score": float(score / len(word_ids))})
             
             # Сортируем позиции по убыванию оценки
             positions.sort(key=lambda x: x["score"], reverse=True)
@@ -296,4 +481,4 @@ class ContentValidator:
             return positions
         except Exception as e:
             logging.error(f"Ошибка при анализе размещения пропуска: {str(e)}")
-            return [] 
\ No newline at end of file
+            return []
@@ -0,0 +1,152 @@
+"""
+Бэкенды кодировщика BERT для валидатора.
+
+Валидатору от модели нужны только скрытые состояния последнего слоя
+(last_hidden_state): по ним считаются логиты MLM в позициях пропуска и
+эмбеддинги вариантов ответа. Поэтому заменяемая часть - кодировщик, а голова
+MLM применяется к нескольким позициям пропуска и остается в PyTorch.
+
+- torch      - исходная модель fp32;
+- torch-int8 - динамическая квантизация PyTorch: веса линейных слоев в INT8,
+               активации квантуются на лету;
+- onnx-int8  - кодировщик экспортируется в ONNX, веса квантуются динамически
+               (onnxruntime.quantization), граф выполняется в ONNX Runtime на CPU.
+
+Бэкенд выбирается переменной окружения VALIDATOR_BACKEND. Экспортированный
+граф сохраняется рядом с моделями и при следующем запуске используется повторно.
+Если квантованный бэкенд не удалось подготовить, используется torch.
+"""
+import logging
+import os
+import time
+
+import torch
+
+BACKEND_TORCH = "torch"
+BACKEND_TORCH_INT8 = "torch-int8"
+BACKEND_ONNX_INT8 = "onnx-int8"
+BACKENDS = (BACKEND_TORCH, BACKEND_TORCH_INT8, BACKEND_ONNX_INT8)
+
+ONNX_OPSET = 14
+
+
+class TorchEncoder:
+    """Кодировщик исходной модели PyTorch"""
+    name = BACKEND_TORCH
+
+    def __init__(self, model):
+        self.model = model
+
+    def encode(self, input_ids, attention_mask):
+        """last_hidden_state для пакета: input_ids и attention_mask - тензоры [строки, длина]"""
+        return self.model.bert(input_ids=input_ids, attention_mask=attention_mask).last_hidden_state
+
+    def mlm_logits(self, hidden):
+        """Логиты словаря для скрытых состояний выбранных позиций"""
+        return self.model.cls(hidden)
+
+
+class QuantizedTorchEncoder(TorchEncoder):
+    """Динамически квантованная копия модели (INT8 веса линейных слоев, включая голову MLM)"""
+    name = BACKEND_TORCH_INT8
+
+    def __init__(self, model):
+        start_time = time.time()
+        quantized = torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+        logging.info(f"Модель квантована динамически (INT8) за {time.time() - start_time:.2f} сек")
+        super().__init__(quantized)
+
+
+class _LastHiddenState(torch.nn.Module):
+    """Обертка для экспорта: граф возвращает только last_hidden_state"""
+
+    def __init__(self, bert):
+        super().__init__()
+        self.bert = bert
+
+    def forward(self, input_ids, attention_mask):
+        return self.bert(input_ids=input_ids, attention_mask=attention_mask).last_hidden_state
+
+
+class OnnxEncoder(TorchEncoder):
+    """Квантованный (INT8) граф кодировщика в ONNX Runtime; голова MLM - из исходной модели"""
+    name = BACKEND_ONNX_INT8
+
+    def __init__(self, model, export_dir):
+        import onnxruntime
+
+        super().__init__(model)
+        path = os.path.join(export_dir, "encoder.int8.onnx")
+        if not os.path.exists(path):
+            self._export(model, export_dir, path)
+
+        options = onnxruntime.SessionOptions()
+        threads = int(os.environ.get("VALIDATOR_ONNX_THREADS", 0))
+        if threads > 0:
+            options.intra_op_num_threads = threads
+        self.session = onnxruntime.InferenceSession(path, options, providers=["CPUExecutionProvider"])
+        logging.info(f"Граф кодировщика загружен в ONNX Runtime: {path}")
+
+    @staticmethod
+    def _export(model, export_dir, path):
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+
+        os.makedirs(export_dir, exist_ok=True)
+        fp32_path = os.path.join(export_dir, "encoder.fp32.onnx")
+        tmp_path = path + ".tmp"
+        start_time = time.time()
+
+        sample_ids = torch.ones((2, 8), dtype=torch.long)
+        sample_mask = torch.ones((2, 8), dtype=torch.long)
+        export_kwargs = dict(
+            input_names=["input_ids", "attention_mask"],
+            output_names=["last_hidden_state"],
+            dynamic_axes={
+                "input_ids": {0: "batch", 1: "sequence"},
+                "attention_mask": {0: "batch", 1: "sequence"},
+                "last_hidden_state": {0: "batch", 1: "sequence"}
+            },
+            opset_version=ONNX_OPSET
+        )
+        with torch.no_grad():
+            try:
+                torch.onnx.export(_LastHiddenState(model.bert), (sample_ids, sample_mask), fp32_path,
+                                  dynamo=False, **export_kwargs)
+            except TypeError:
+                # Старые версии torch не знают параметра dynamo
+                torch.onnx.export(_LastHiddenState(model.bert), (sample_ids, sample_mask), fp32_path,
+                                  **export_kwargs)
+
+        try:
+            quantize_dynamic(fp32_path, tmp_path, weight_type=QuantType.QInt8)
+            os.replace(tmp_path, path)
+        finally:
+            for leftover in (fp32_path, tmp_path):
+                if os.path.exists(leftover):
+                    os.remove(leftover)
+        logging.info(f"Кодировщик экспортирован в ONNX и квантован (INT8) за {time.time() - start_time:.2f} сек")
+
+    def encode(self, input_ids, attention_mask):
+        hidden, = self.session.run(["last_hidden_state"], {
+            "input_ids": input_ids.numpy(),
+            "attention_mask": attention_mask.numpy()
+        })
+        return torch.from_numpy(hidden)
+
+
+def create_encoder(backend, model, models_dir, model_name):
+    """Кодировщик выбранного бэкенда; при ошибке подготовки - исходная модель torch"""
+    if backend not in BACKENDS:
+        logging.warning(f"Неизвестный бэкенд валидатора {backend}, используется {BACKEND_TORCH}")
+        backend = BACKEND_TORCH
+
+    try:
+        if backend == BACKEND_TORCH_INT8:
+            return QuantizedTorchEncoder(model)
+        if backend == BACKEND_ONNX_INT8:
+            export_dir = os.path.join(models_dir, "onnx", model_name.replace("/", "--"))
+            return OnnxEncoder(model, export_dir)
+    except Exception as e:
+        logging.error(f"Не удалось подготовить бэкенд валидатора {backend}: {str(e)}. "
+                      f"Используется {BACKEND_TORCH}")
+    return TorchEncoder(model)
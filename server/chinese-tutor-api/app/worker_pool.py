@@ -0,0 +1,115 @@
+"""
+Пул потоков-обработчиков асинхронных задач генерации.
+
+Несколько потоков забирают задачи из общей очереди, поэтому очередь
+разбирается с той параллельностью, которую выдерживают серверы моделей.
+При остановке потоки перестают брать новые задачи и дорабатывают текущие.
+"""
+import logging
+import queue
+import threading
+import time
+
+
+class _WorkerStats:
+    def __init__(self, name):
+        self.name = name
+        self.tasks_done = 0
+        self.errors = 0
+        self.busy_time = 0.0
+        self.busy_since = None
+        self.started_at = time.time()
+
+    def snapshot(self, now):
+        busy_time = self.busy_time + (now - self.busy_since if self.busy_since else 0.0)
+        uptime = now - self.started_at
+        return {
+            "name": self.name,
+            "busy": self.busy_since is not None,
+            "tasks_done": self.tasks_done,
+            "errors": self.errors,
+            "busy_time": busy_time,
+            "utilization": busy_time / uptime if uptime > 0 else 0.0
+        }
+
+
+class WorkerPool:
+    def __init__(self, task_queue, handler, size=4, name="task-worker", poll_interval=0.5):
+        """
+        task_queue - очередь с методом get(timeout=...), выбрасывающим queue.Empty;
+        handler(task) обрабатывает одну задачу, исключения логируются и учитываются.
+        """
+        self.task_queue = task_queue
+        self.handler = handler
+        self.size = max(1, size)
+        self.name = name
+        self.poll_interval = poll_interval
+
+        self._stopping = threading.Event()
+        self._lock = threading.Lock()
+        self._threads = []
+        self._stats = []
+
+    def start(self):
+        with self._lock:
+            if self._threads:
+                return
+            for index in range(self.size):
+                stats = _WorkerStats(f"{self.name}-{index}")
+                thread = threading.Thread(target=self._run, args=(stats,), name=stats.name, daemon=True)
+                self._stats.append(stats)
+                self._threads.append(thread)
+                thread.start()
+        logging.info(f"Запущено обработчиков задач: {self.size}")
+
+    def _run(self, stats):
+        while not self._stopping.is_set():
+            try:
+                # Короткий таймаут, чтобы поток вовремя заметил остановку пула
+                task = self.task_queue.get(timeout=self.poll_interval)
+            except queue.Empty:
+                continue
+
+            with self._lock:
+                stats.busy_since = time.time()
+            failed = False
+            try:
+                self.handler(task)
+            except Exception as e:
+                failed = True
+                logging.error(f"Ошибка в обработчике {stats.name}: {str(e)}", exc_info=True)
+            finally:
+                with self._lock:
+                    stats.busy_time += time.time() - stats.busy_since
+                    stats.busy_since = None
+                    # Задачи с ошибкой считаются отдельно от выполненных
+                    if failed:
+                        stats.errors += 1
+                    else:
+                        stats.tasks_done += 1
+
+    def shutdown(self, timeout=30.0):
+        """Останавливает прием задач и ждет завершения текущих (не дольше timeout секунд)"""
+        if self._stopping.is_set():
+            return
+        self._stopping.set()
+        logging.info("Остановка обработчиков задач, ожидание текущих задач...")
+        deadline = time.time() + timeout
+        for thread in self._threads:
+            thread.join(max(0.0, deadline - time.time()))
+        still_running = [thread.name for thread in self._threads if thread.is_alive()]
+        if still_running:
+            logging.warning(f"Обработчики не завершились за {timeout} сек: {still_running}")
+
+    def stats(self):
+        now = time.time()
+        with self._lock:
+            workers = [stats.snapshot(now) for stats in self._stats]
+        return {
+            "size": self.size,
+            "stopping": self._stopping.is_set(),
+            "busy": sum(1 for worker in workers if worker["busy"]),
+            "tasks_done": sum(worker["tasks_done"] for worker in workers),
+            "errors": sum(worker["errors"] for worker in workers),
+            "workers": workers
+        }
@@ -10,6 +10,9 @@ Usage:
   python run_server.py --test-lm     # Test LM Studio connection
   python run_server.py --port=5000   # Specify server port
   python run_server.py --lm-url=http://localhost:1234 # Specify LM Studio URL
+  python run_server.py --lm-urls=http://host1:1234,http://host2:1234 # Balance across several backends
+  python run_server.py --pregenerate words.txt --hsk 3 --lang ru,en --concurrency 8
+                                     # Fill the exercise store for a word list offline
 """
 import os
 import sys
@@ -20,7 +23,7 @@ import argparse
 import subprocess
 import threading
 import socket
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, Response, stream_with_context
 from openai import OpenAI
 import requests
 import re
@@ -47,6 +50,21 @@ except ImportError:
     print("Warning: Could not import Translator. Translation will be disabled.")
     translator_enabled = False
 
+from batch_generator import generate_batch
+from exercise_store import ExerciseStore
+from streaming import IncrementalFieldParser, format_sse
+from lm_client import LMRequestError
+from lm_router import LMRouter, parse_backend_urls, parse_concurrency
+from model_registry import ModelRegistry
+from exercise_schema import exercise_response_format, is_response_format_rejected, parse_exercise, ParseStats
+from single_flight import SingleFlight
+from token_budget import TokenBudget, EXERCISE_STOP, restore_json_end
+from pregenerate import (
+    load_word_list, PregenerationCheckpoint, run_pregeneration, format_summary,
+    STATUS_STORED, STATUS_REJECTED, STATUS_FAILED
+)
+import asyncio
+
 # Initialize Flask app
 app = Flask(__name__)
 logging.basicConfig(level=logging.DEBUG, 
@@ -56,10 +74,37 @@ logging.basicConfig(level=logging.DEBUG,
 # Default values that will be overridden by arguments
 SERVER_PORT = int(os.environ.get("API_SERVER_PORT", 5000))
 LM_STUDIO_URL = os.environ.get("LM_STUDIO_URL", "http://localhost:1234")
+# Optional comma-separated list of OpenAI-compatible backends; requests are balanced across them
+LM_STUDIO_URLS = os.environ.get("LM_STUDIO_URLS", "")
+if parse_backend_urls(LM_STUDIO_URLS):
+    LM_STUDIO_URL = parse_backend_urls(LM_STUDIO_URLS)[0]
 
 # Initialize OpenAI client for LM Studio
 lm_client = None  # Will be initialized after parsing arguments
 
+# Shared LM router: one keep-alive connection pool per backend (created for the current backend list)
+lm_pool = None
+lm_pool_lock = threading.Lock()
+
+# Upper bound for the best_of parameter of /generate
+MAX_BEST_OF = int(os.environ.get("MAX_BEST_OF", 8))
+
+# Send the exercise JSON schema as response_format so the output parses on the first attempt
+STRUCTURED_OUTPUT = os.environ.get("LM_STRUCTURED_OUTPUT", "1") != "0"
+# Cleared if LM Studio rejects response_format; requests then fall back to free-form JSON
+structured_output_supported = True
+# Counters of strict parses vs. the regex repair cascade
+parse_stats = ParseStats()
+
+# max_tokens per (hsk_level, system_language), learned from observed completion lengths
+token_budget = TokenBudget(default=int(os.environ.get("LM_MAX_TOKENS", 600)))
+
+# Coalesces concurrent /generate calls with the same generation parameters (see generation_key)
+generation_flight = SingleFlight()
+
+# Models in order of preference when generating an exercise
+MODELS_TO_TRY = ["gemma-3-4b-it-qat", "gemma-3-1b-it-qat", "gemma2-3-4b-it-qat", "gemma-2-7b-it-qat"]
+
 # Initialize validator if available
 if validator_enabled:
     try:
@@ -78,12 +123,57 @@ if translator_enabled:
         translator_enabled = False
         logging.error(f"Error initializing translator: {str(e)}")
 
+# Prompt version is part of the exercise store key: changing the prompt invalidates stored exercises
+PROMPT_VERSION = "word-v1"
+
+# Exercise store (in-process LRU in front of a SQLite file)
+exercise_store = ExerciseStore(
+    prompt_version=PROMPT_VERSION,
+    capacity=int(os.environ.get("EXERCISE_STORE_CAPACITY", 2000))
+)
+
+def lm_backend_urls():
+    """LM backends in use: LM_STUDIO_URLS if set, otherwise the single LM_STUDIO_URL"""
+    return parse_backend_urls(LM_STUDIO_URLS) or [LM_STUDIO_URL.rstrip('/')]
+
+def get_lm_pool():
+    """Return the shared LM router, recreating it if the backend list has changed"""
+    global lm_pool
+    with lm_pool_lock:
+        urls = lm_backend_urls()
+        if lm_pool is None or lm_pool.urls != urls:
+            if lm_pool is not None:
+                lm_pool.close()
+            # Per-backend limit of concurrent requests: one value for all backends or a comma-separated list
+            concurrency = os.environ.get("LM_BACKEND_CONCURRENCY") or os.environ.get("LM_POOL_MAX_CONNECTIONS", "32")
+            lm_pool = LMRouter(
+                urls,
+                max_concurrency=parse_concurrency(concurrency, len(urls)),
+                max_keepalive_connections=int(os.environ.get("LM_POOL_MAX_KEEPALIVE", 16)),
+                ejection_time=float(os.environ.get("LM_BACKEND_EJECTION_TIME", 30)),
+                default_timeout=90.0
+            )
+        return lm_pool
+
+def _list_loaded_models():
+    pool = get_lm_pool()
+    return pool.run(pool.list_models(timeout=5))
+
+# Registry of models loaded in LM Studio, refreshed in the background and after failures
+model_registry = ModelRegistry(
+    _list_loaded_models,
+    MODELS_TO_TRY,
+    refresh_interval=float(os.environ.get("LM_MODELS_REFRESH_INTERVAL", 60))
+)
+
 # Function to initialize LM client with the current URL
 def initialize_lm_client():
     global lm_client
     global LM_STUDIO_URL
     
     logging.info(f"Initializing connection to LM Studio at: {LM_STUDIO_URL}")
+    if len(lm_backend_urls()) > 1:
+        logging.info(f"Requests will be balanced across LM backends: {lm_backend_urls()}")
     
     # Проверка корректности URL
     if not LM_STUDIO_URL.startswith(("http://", "https://")):
@@ -140,45 +230,18 @@ def initialize_lm_client():
         logging.error(f"Error checking host connectivity: {e}")
         # Продолжим даже при ошибке проверки
     
-    # Тестируем подключение к API LM Studio напрямую через requests
+    # Тестируем подключение к API LM Studio через общий пул соединений
     try:
-        import requests
-        
-        # Создаем сессию без прокси
-        session = requests.Session()
-        session.trust_env = False  # Игнорируем системные настройки прокси
+        pool = get_lm_pool()
         
         logging.info(f"Testing API using direct HTTP request to {LM_STUDIO_URL}/v1/models")
         
-        response = session.get(f"{LM_STUDIO_URL}/v1/models", timeout=15)
-        if response.status_code == 200:
-            models_data = response.json().get("data", [])
-            available_models = [model.get("id", "unknown") for model in models_data]
+        try:
+            available_models = pool.run(pool.list_models(timeout=15))
             logging.info(f"LM Studio connection successful. Available models: {available_models}")
+        except Exception as models_error:
+            logging.error(f"HTTP request to /v1/models failed: {models_error}")
             
-            # Создаем клиент для OpenAI API с отключенными прокси
-            import httpx
-            http_client = httpx.Client(transport=httpx.HTTPTransport(proxy=None))
-            
-            # Инициализируем клиент OpenAI
-            lm_client = OpenAI(
-                base_url=f"{LM_STUDIO_URL}/v1",
-                api_key="not-needed",
-                timeout=30.0,
-                max_retries=1,
-                http_client=http_client
-            )
-            return True
-        else:
-            logging.error(f"HTTP request failed. Status: {response.status_code}, Response: {response.text}")
-            
-            # Пробуем получить информацию об ошибке
-            try:
-                error_data = response.json()
-                logging.error(f"API error details: {error_data}")
-            except:
-                pass
-                
             # Пробуем более специфичный запрос к API
             try:
                 logging.info("Attempting alternative API test: sending a simple chat completion")
@@ -189,33 +252,29 @@ def initialize_lm_client():
                     ],
                     "max_tokens": 20
                 }
-                
-                alt_response = session.post(
-                    f"{LM_STUDIO_URL}/v1/chat/completions",
-                    json=payload,
-                    timeout=20
-                )
-                
-                if alt_response.status_code == 200:
-                    logging.info("Alternative API test successful")
-                    # Создаем клиент OpenAI
-                    import httpx
-                    http_client = httpx.Client(transport=httpx.HTTPTransport(proxy=None))
-                    lm_client = OpenAI(
-                        base_url=f"{LM_STUDIO_URL}/v1",
-                        api_key="not-needed",
-                        timeout=30.0,
-                        max_retries=1,
-                        http_client=http_client
-                    )
-                    return True
-                else:
-                    logging.error(f"Alternative API test failed: {alt_response.status_code}")
-                    return False
-                    
+                pool.run(pool.chat_completion(payload, timeout=20))
+                logging.info("Alternative API test successful")
             except Exception as alt_error:
                 logging.error(f"Alternative API test failed: {alt_error}")
                 return False
+        
+        # Список загруженных моделей читаем сразу, дальше он обновляется в фоне
+        model_registry.refresh()
+        model_registry.start()
+        
+        # Создаем клиент для OpenAI API с отключенными прокси
+        import httpx
+        http_client = httpx.Client(transport=httpx.HTTPTransport(proxy=None))
+        
+        # Инициализируем клиент OpenAI
+        lm_client = OpenAI(
+            base_url=f"{LM_STUDIO_URL}/v1",
+            api_key="not-needed",
+            timeout=30.0,
+            max_retries=1,
+            http_client=http_client
+        )
+        return True
     except Exception as e:
         logging.error(f"Failed to initialize connection to LM Studio: {e}")
         lm_client = None
@@ -245,14 +304,9 @@ def health_check():
         if lm_client is not None:
             # Attempt to get available models from LM Studio
             try:
-                session = requests.Session()
-                session.trust_env = False
-                response = session.get(f"{LM_STUDIO_URL}/v1/models", timeout=3)
-                if response.status_code == 200:
-                    lm_studio_enabled = True
-                    models_data = response.json()
-                    if 'data' in models_data and isinstance(models_data['data'], list):
-                        lm_studio_models = [model.get('id', 'unknown') for model in models_data['data']]
+                pool = get_lm_pool()
+                lm_studio_models = pool.run(pool.list_models(timeout=3))
+                lm_studio_enabled = True
             except Exception as e:
                 logging.warning(f"Error checking LM Studio models: {e}")
     except Exception as e:
@@ -269,10 +323,24 @@ def health_check():
             "api_version": "1.0.0",
             "server_port": SERVER_PORT,
             "lm_studio_url": LM_STUDIO_URL,
+            "lm_backends": lm_backend_urls(),
             "local_ip": get_local_ip()
         }
     })
 
+@app.route('/stats', methods=['GET'])
+def get_stats():
+    """Statistics endpoint for server-side caches"""
+    return jsonify({
+        "exercise_store": exercise_store.stats(),
+        "models": model_registry.stats(),
+        "parsing": parse_stats.stats(),
+        "single_flight": generation_flight.stats(),
+        "token_budget": token_budget.stats(),
+        "lm_pool": lm_pool.stats() if lm_pool is not None else None,
+        "validator": validator.stats() if validator_enabled else None
+    })
+
 @app.route('/test-connection', methods=['GET'])
 def test_connection():
     """Test endpoint for checking connection to LM Studio"""
@@ -296,23 +364,22 @@ def test_connection():
         except Exception as e:
             logging.error(f"Error connecting to LM Studio with OpenAI client: {str(e)}", exc_info=True)
             
-            # Попробуем запасной вариант с прямым HTTP-запросом
+            # Попробуем запасной вариант с прямым HTTP-запросом через общий пул соединений
             try:
-                import requests
-                response = requests.get(f"{LM_STUDIO_URL}/v1/models", timeout=5)
-                if response.status_code == 200:
-                    return jsonify({
-                        "status": "success",
-                        "models": [model.get("id") for model in response.json().get("data", [])],
-                        "connection": True,
-                        "note": "Connected via HTTP request (OpenAI client failed)"
-                    })
-                else:
-                    return jsonify({
-                        "status": "error",
-                        "message": f"HTTP error: {response.status_code} - {response.text}",
-                        "connection": False
-                    }), 500
+                pool = get_lm_pool()
+                models = pool.run(pool.list_models(timeout=5))
+                return jsonify({
+                    "status": "success",
+                    "models": models,
+                    "connection": True,
+                    "note": "Connected via HTTP request (OpenAI client failed)"
+                })
+            except LMRequestError as http_error:
+                return jsonify({
+                    "status": "error",
+                    "message": f"HTTP error: {http_error}",
+                    "connection": False
+                }), 500
             except Exception as http_error:
                 logging.error(f"HTTP fallback also failed: {str(http_error)}", exc_info=True)
                 return jsonify({
@@ -386,130 +453,48 @@ def generate_exercise():
         hsk_level = data.get('hsk_level', 1)
         system_language = data.get('system_language', 'ru')
         validate = data.get('validate', True)
+        use_cache = data.get('use_cache', True)
         
         if not word:
             return jsonify({"error": "Word parameter (word) is missing"}), 400
         
-        # Generate exercise
-        result = generate_exercise_with_word(word, hsk_level, system_language)
+        # Streaming mode: exercise fields are pushed as SSE events while the model generates them
+        stream = data.get('stream', False) or request.args.get('stream') == 'true'
+        if stream:
+            events = stream_exercise_events(word, hsk_level, system_language, validate, use_cache)
+            return Response(
+                stream_with_context(events),
+                mimetype='text/event-stream',
+                headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+            )
+        
+        retry_on_invalid = data.get('retry_on_invalid', True)
+        
+        # Best-of-N mode: N candidates are generated concurrently and the best validated one wins
+        best_of = data.get('best_of', 1)
+        if isinstance(best_of, bool) or not isinstance(best_of, (int, str)) or not str(best_of).isdigit() \
+                or int(best_of) < 1:
+            return jsonify({"error": f"Invalid best_of '{best_of}': expected a positive integer"}), 400
+        best_of = min(int(best_of), MAX_BEST_OF)
+        
+        # Serve a previously generated exercise for the same word/HSK/language if we have one
+        if use_cache:
+            cached = cached_exercise(word, hsk_level, system_language, validate)
+            if cached is not None:
+                logging.info(f"Exercise for '{word}' (HSK {hsk_level}, {system_language}) served from store")
+                cached["cached"] = True
+                return jsonify(cached)
+        
+        # Concurrent requests with the same word/HSK/language and generation options share a single generation
+        result = generation_flight.do(
+            generation_key(word, hsk_level, system_language, validate, retry_on_invalid, best_of),
+            lambda: generate_validated_exercise(
+                word, hsk_level, system_language, validate, retry_on_invalid, best_of
+            )
+        )
         
         if 'error' in result:
             return jsonify(result), 500
-            
-        # Validate exercise if enabled
-        if validate and validator_enabled:
-            try:
-                validation_result = validator.validate_exercise(result)
-                
-                # Add validation info to result
-                result["validation"] = {
-                    "is_valid": validation_result.get("is_valid", True),
-                    "confidence": float(validation_result.get("confidence", 0.0)),
-                    "semantic_score": float(validation_result.get("semantic_score", 0.0)),
-                    "distractor_score": float(validation_result.get("distractor_score", 0.0))
-                }
-                
-                # Подробное логирование результатов валидации
-                validation_log = f"""
-=== BERT-Chinese-WWM Validation Results ===
-- Word: {word}
-- Sentence: {result.get('sentence_with_gap', '')}
-- Options: {result.get('options', [])}
-- Is Valid: {validation_result.get('is_valid', True)}
-- Confidence: {validation_result.get('confidence', 0.0):.4f}
-- Semantic Score: {validation_result.get('semantic_score', 0.0):.4f}
-- Distractor Score: {validation_result.get('distractor_score', 0.0):.4f}
-======================================
-"""
-                logging.info(validation_log)
-                
-                # If validation fails, regenerate once
-                if not validation_result.get("is_valid", True) and data.get('retry_on_invalid', True):
-                    logging.warning(f"Validation failed for '{word}', trying to regenerate...")
-                    retry_count = 1
-                    max_retries = 3
-                    while retry_count <= max_retries:
-                        try:
-                            # Regenerate with higher temperature for diversity
-                            retry_result = generate_exercise_with_word(
-                                word, hsk_level, system_language, temperature=0.9
-                            )
-                            
-                            if 'error' not in retry_result:
-                                # Validate regenerated exercise
-                                retry_validation = validator.validate_exercise(retry_result)
-                                retry_result["validation"] = {
-                                    "is_valid": retry_validation.get("is_valid", True),
-                                    "confidence": float(retry_validation.get("confidence", 0.0)),
-                                    "semantic_score": float(retry_validation.get("semantic_score", 0.0)),
-                                    "distractor_score": float(retry_validation.get("distractor_score", 0.0)),
-                                    "is_retry": True
-                                }
-                                
-                                # Use result with best confidence score
-                                if retry_validation.get("confidence", 0.0) > validation_result.get("confidence", 0.0):
-                                    result = retry_result
-                                    logging.info("Using regenerated exercise with higher score")
-                                    
-                                    # Подробное логирование результатов повторной валидации
-                                    retry_validation_log = f"""
-=== REGENERATED BERT-Chinese-WWM Validation Results ===
-- Word: {word}
-- Sentence: {retry_result.get('sentence_with_gap', '')}
-- Options: {retry_result.get('options', [])}
-- Is Valid: {retry_validation.get('is_valid', True)}
-- Confidence: {retry_validation.get('confidence', 0.0):.4f}
-- Semantic Score: {retry_validation.get('semantic_score', 0.0):.4f}
-- Distractor Score: {retry_validation.get('distractor_score', 0.0):.4f}
-- IMPROVED: YES (using regenerated exercise)
-"""
-                                    if 'improvements' in retry_validation and retry_validation['improvements']:
-                                        retry_validation_log += "- Suggestions for improvement:\n"
-                                        for imp in retry_validation['improvements']:
-                                            retry_validation_log += f"  * {imp}\n"
-                                    
-                                    logging.info(retry_validation_log)
-                                else:
-                                    # Если повторная генерация не дала улучшений, логируем это тоже
-                                    logging.info(f"""
-=== REGENERATED BERT-Chinese-WWM Validation Results ===
-- Word: {word}
-- Sentence: {retry_result.get('sentence_with_gap', '')}
-- Options: {retry_result.get('options', [])}
-- Is Valid: {retry_validation.get('is_valid', True)}
-- Confidence: {retry_validation.get('confidence', 0.0):.4f}
-- Semantic Score: {retry_validation.get('semantic_score', 0.0):.4f}
-- Distractor Score: {retry_validation.get('distractor_score', 0.0):.4f}
-- IMPROVED: NO (keeping original exercise)
-""")
-                                break
-                        except Exception as e:
-                            logging.error(f"Error during exercise generation for word '{word}': {e}")
-                            if retry_count < max_retries:
-                                retry_count += 1
-                                logging.info(f"Retrying... (attempt {retry_count} of {max_retries})")
-                                continue
-                            else:
-                                logging.warning(f"Failed to generate exercise after {max_retries} attempts, using fallback")
-                                # Use a simple fallback exercise
-                                result = {
-                                    "sentence_with_gap": f"这是____{word}。", 
-                                    "options": [word, "好", "人", "不"],
-                                    "correctAnswer": word,
-                                    "pinyin": pinyin.get_pinyin(f"这是{word}。"),
-                                    "translation": "This is " + word + ".",
-                                    "generated_with": "fallback",
-                                    "validation": {
-                                        "is_valid": True,
-                                        "confidence": 0.5,
-                                        "semantic_score": 0.5,
-                                        "distractor_score": 0.5
-                                    }
-                                }
-                                break
-            except Exception as e:
-                logging.error(f"Validation error: {str(e)}", exc_info=True)
-                result["validation_error"] = str(e)
         
         return jsonify(result)
         
@@ -520,13 +505,80 @@ def generate_exercise():
             "message": "Internal server error"
         }), 500
 
-def generate_exercise_with_word(word, hsk_level, system_language, temperature=0.7):
-    """Generate exercise using the given word"""
+@app.route('/generate-multiple-exercises', methods=['POST'])
+def generate_multiple_exercises():
+    """Endpoint for generating exercises for many words, packing several words into one LM call"""
     try:
-        logging.info(f"Generating exercise for word: {word}, HSK: {hsk_level}, Language: {system_language}")
+        data = request.get_json(silent=True)
+        if not isinstance(data, dict):
+            return jsonify({"error": "Request body must be a JSON object"}), 400
+        
+        # The Flutter client sends cards ({hanzi, pinyin, translation}); a plain word list is accepted too
+        words, error = request_words(data)
+        if error:
+            return jsonify({"error": error}), 400
+        
+        # A missing count or 0 means no limit
+        count = int_param(data, 'count', 0, minimum=0)
+        batch_size = int_param(data, 'batch_size', 8, minimum=1)
+        if count is None or batch_size is None:
+            return jsonify({"error": "Parameters 'count' and 'batch_size' must be integers "
+                                     "('count' >= 0, 'batch_size' >= 1)"}), 400
+        if count:
+            words = words[:count]
+        
+        if not words:
+            return jsonify({"error": "Words parameter (cards or words) is missing"}), 400
+        
+        hsk_level = data.get('hsk_level', 1)
+        system_language = data.get('system_language', 'ru')
+        validate = data.get('validate', True)
+        logging.info(f"Batch request received for {len(words)} words")
+        
+        if lm_client is None and not initialize_lm_client():
+            logging.error("LM Studio client is not initialized, generating batch one by one")
+        
+        def complete(messages, temperature, max_tokens):
+            content, _ = request_completion(messages, temperature, max_tokens)
+            if content is None:
+                raise RuntimeError("LM Studio returned no content for batch request")
+            return content
+        
+        exercises, stats = generate_batch(
+            words, hsk_level, system_language,
+            complete=complete,
+            generate_single=lambda w: generate_exercise_with_word(w, hsk_level, system_language, temperature=0.9),
+            batch_size=batch_size
+        )
+        
+        for word, exercise in zip(words, exercises):
+            exercise["word"] = word
+        
+        # The whole batch goes through the validator in one call (batched model passes)
+        to_validate = [exercise for exercise in exercises if 'error' not in exercise]
+        if validate and validator_enabled and to_validate:
+            try:
+                for exercise, validation_result in zip(to_validate, validator.validate_exercises(to_validate)):
+                    exercise["validation"] = validation_summary(validation_result)
+            except Exception as e:
+                logging.error(f"Batch validation error: {str(e)}", exc_info=True)
+                for exercise in to_validate:
+                    exercise["validation_error"] = str(e)
         
-        # Create prompt for exercise generation
-        user_prompt = f"""Ты генератор учебных упражнений по китайскому языку. Вот твоя задача:
+        logging.info(f"Batch generation finished: {stats}")
+        return jsonify({"exercises": exercises, "stats": stats})
+        
+    except Exception as e:
+        logging.error(f"Batch generation error: {str(e)}", exc_info=True)
+        return jsonify({
+            "status": "error",
+            "message": "Internal server error"
+        }), 500
+
+def build_exercise_messages(word, hsk_level, system_language):
+    """Build chat completion messages for a single-word exercise"""
+    # Create prompt for exercise generation
+    user_prompt = f"""Ты генератор учебных упражнений по китайскому языку. Вот твоя задача:
 
 На вход ты получаешь:
 - одно китайское слово: {word}
@@ -559,32 +611,9 @@ def generate_exercise_with_word(word, hsk_level, system_language, temperature=0.
   "options": ["...", "...", "...", "..."],
   "answer": "..."
 }}"""
-        
-        # Проверим, инициализирован ли клиент LM Studio
-        if lm_client is None:
-            logging.error("LM Studio client is not initialized")
-            logging.info("Trying to initialize LM Studio client")
-            if not initialize_lm_client():
-                logging.error("Failed to initialize LM Studio client. Using fallback approach.")
-                return generate_exercise_fallback(word, hsk_level, system_language)
-        
-        # Пробуем прямой HTTP-запрос к LM Studio вместо OpenAI клиента
-        try:
-            import requests
-            from requests.adapters import HTTPAdapter
-            
-            logging.info(f"Using direct HTTP request to {LM_STUDIO_URL}/v1/chat/completions")
-            
-            # Создаем сессию без прокси
-            session = requests.Session()
-            session.trust_env = False  # Игнорируем системные настройки прокси
-            
-            headers = {
-                "Content-Type": "application/json"
-            }
-            
-            # Улучшенный системный промпт с явными инструкциями по формату JSON
-            system_prompt = """Ты помощник для изучения китайского языка. Твоя задача - создавать упражнения в формате JSON.
+    
+    # Улучшенный системный промпт с явными инструкциями по формату JSON
+    system_prompt = """Ты помощник для изучения китайского языка. Твоя задача - создавать упражнения в формате JSON.
 
 ⚠️⚠️⚠️ КРИТИЧЕСКИ ВАЖНО: ⚠️⚠️⚠️
 1. Возвращай ТОЛЬКО чистый валидный JSON, НЕ оборачивая его в тройные обратные кавычки.
@@ -593,49 +622,334 @@ def generate_exercise_with_word(word, hsk_level, system_language, temperature=0.
 4. Убедись, что все ключи и строковые значения обрамлены двойными кавычками.
 5. НЕ включай никакого вступительного или заключительного текста.
 6. ТОЛЬКО JSON, ничего больше."""
+    
+    messages = [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": user_prompt}
+    ]
+    return messages
+
+def generate_validated_exercise(word, hsk_level, system_language, validate=True, retry_on_invalid=True, best_of=1):
+    """Generate an exercise, validate it (regenerating if needed) and store the result"""
+    if best_of > 1 and validate and validator_enabled:
+        result = generate_best_of_n(word, hsk_level, system_language, best_of)
+        store_exercise(word, hsk_level, system_language, result)
+        return result
+    
+    # Generate exercise
+    result = generate_exercise_with_word(word, hsk_level, system_language)
+    
+    if 'error' in result:
+        return result
+        
+    # Validate exercise if enabled
+    if validate and validator_enabled:
+        try:
+            validation_result = validator.validate_exercise(result)
             
-            # Ограничиваем количество токенов для ускорения ответа
-            payload = {
-                "model": "gemma-3-4b-it-qat",
-                "messages": [
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": user_prompt}
-                ],
-                "temperature": temperature,
-                "max_tokens": 600,  # Уменьшаем для ускорения ответа
-                "top_p": 0.95
+            # Add validation info to result
+            result["validation"] = {
+                "is_valid": validation_result.get("is_valid", True),
+                "confidence": float(validation_result.get("confidence", 0.0)),
+                "semantic_score": float(validation_result.get("semantic_score", 0.0)),
+                "distractor_score": float(validation_result.get("distractor_score", 0.0))
             }
             
-            # Пробуем несколько моделей
-            models_to_try = ["gemma-3-4b-it-qat", "gemma-3-1b-it-qat", "gemma2-3-4b-it-qat", "gemma-2-7b-it-qat"]
+            # Подробное логирование результатов валидации
+            validation_log = f"""
+=== BERT-Chinese-WWM Validation Results ===
+- Word: {word}
+- Sentence: {result.get('sentence_with_gap', '')}
+- Options: {result.get('options', [])}
+- Is Valid: {validation_result.get('is_valid', True)}
+- Confidence: {validation_result.get('confidence', 0.0):.4f}
+- Semantic Score: {validation_result.get('semantic_score', 0.0):.4f}
+- Distractor Score: {validation_result.get('distractor_score', 0.0):.4f}
+======================================
+"""
+            logging.info(validation_log)
             
-            content = None
-            used_model = None
-            for model in models_to_try:
-                try:
-                    logging.info(f"Trying model: {model}")
-                    payload["model"] = model
-                    response = session.post(
-                        f"{LM_STUDIO_URL}/v1/chat/completions",
-                        headers=headers,
-                        json=payload,
-                        timeout=90  # Increased timeout for LM Studio
-                    )
-                    
-                    if response.status_code == 200:
-                        content = response.json()["choices"][0]["message"]["content"]
-                        used_model = model
-                        logging.info(f"Successfully generated exercise using model {model}")
-                        break
-                    else:
-                        logging.error(f"HTTP request failed with status {response.status_code} for model {model}")
-                except Exception as model_error:
-                    logging.error(f"Error with model {model}: {model_error}")
-                    continue
-        except Exception as http_error:
-            logging.error(f"All HTTP requests failed: {http_error}", exc_info=True)
-            content = None
-            used_model = None
+            # If validation fails, regenerate once
+            if not validation_result.get("is_valid", True) and retry_on_invalid:
+                logging.warning(f"Validation failed for '{word}', trying to regenerate...")
+                retry_count = 1
+                max_retries = 3
+                while retry_count <= max_retries:
+                    try:
+                        # Regenerate with higher temperature for diversity
+                        retry_result = generate_exercise_with_word(
+                            word, hsk_level, system_language, temperature=0.9
+                        )
+                        
+                        if 'error' not in retry_result:
+                            # Validate regenerated exercise
+                            retry_validation = validator.validate_exercise(retry_result)
+                            retry_result["validation"] = {
+                                "is_valid": retry_validation.get("is_valid", True),
+                                "confidence": float(retry_validation.get("confidence", 0.0)),
+                                "semantic_score": float(retry_validation.get("semantic_score", 0.0)),
+                                "distractor_score": float(retry_validation.get("distractor_score", 0.0)),
+                                "is_retry": True
+                            }
+                            
+                            # Use result with best confidence score
+                            if retry_validation.get("confidence", 0.0) > validation_result.get("confidence", 0.0):
+                                result = retry_result
+                                logging.info("Using regenerated exercise with higher score")
+                                
+                                # Подробное логирование результатов повторной валидации
+                                retry_validation_log = f"""
+=== REGENERATED BERT-Chinese-WWM Validation Results ===
+- Word: {word}
+- Sentence: {retry_result.get('sentence_with_gap', '')}
+- Options: {retry_result.get('options', [])}
+- Is Valid: {retry_validation.get('is_valid', True)}
+- Confidence: {retry_validation.get('confidence', 0.0):.4f}
+- Semantic Score: {retry_validation.get('semantic_score', 0.0):.4f}
+- Distractor Score: {retry_validation.get('distractor_score', 0.0):.4f}
+- IMPROVED: YES (using regenerated exercise)
+"""
+                                if 'improvements' in retry_validation and retry_validation['improvements']:
+                                    retry_validation_log += "- Suggestions for improvement:\n"
+                                    for imp in retry_validation['improvements']:
+                                        retry_validation_log += f"  * {imp}\n"
+                                
+                                logging.info(retry_validation_log)
+                            else:
+                                # Если повторная генерация не дала улучшений, логируем это тоже
+                                logging.info(f"""
+=== REGENERATED BERT-Chinese-WWM Validation Results ===
+- Word: {word}
+- Sentence: {retry_result.get('sentence_with_gap', '')}
+- Options: {retry_result.get('options', [])}
+- Is Valid: {retry_validation.get('is_valid', True)}
+- Confidence: {retry_validation.get('confidence', 0.0):.4f}
+- Semantic Score: {retry_validation.get('semantic_score', 0.0):.4f}
+- Distractor Score: {retry_validation.get('distractor_score', 0.0):.4f}
+- IMPROVED: NO (keeping original exercise)
+""")
+                            break
+                    except Exception as e:
+                        logging.error(f"Error during exercise generation for word '{word}': {e}")
+                        if retry_count < max_retries:
+                            retry_count += 1
+                            logging.info(f"Retrying... (attempt {retry_count} of {max_retries})")
+                            continue
+                        else:
+                            logging.warning(f"Failed to generate exercise after {max_retries} attempts, using fallback")
+                            # Use a simple fallback exercise
+                            result = {
+                                "sentence_with_gap": f"这是____{word}。", 
+                                "options": [word, "好", "人", "不"],
+                                "correctAnswer": word,
+                                "pinyin": pinyin.get_pinyin(f"这是{word}。"),
+                                "translation": "This is " + word + ".",
+                                "generated_with": "fallback",
+                                "validation": {
+                                    "is_valid": True,
+                                    "confidence": 0.5,
+                                    "semantic_score": 0.5,
+                                    "distractor_score": 0.5
+                                }
+                            }
+                            break
+        except Exception as e:
+            logging.error(f"Validation error: {str(e)}", exc_info=True)
+            result["validation_error"] = str(e)
+    
+    store_exercise(word, hsk_level, system_language, result)
+    return result
+
+def is_fallback_result(result, word):
+    """True for errors, fallback exercises and placeholders filled in by extract_exercise_data"""
+    if 'error' in result or "note" in result or result.get("generated_with") == "fallback":
+        return True
+    if result.get("sentence_with_gap") == f"这个句子中使用{word}。":
+        return True
+    return any(isinstance(option, str) and option.startswith("选项") for option in result.get("options") or [])
+
+def generation_key(word, hsk_level, system_language, validate, retry_on_invalid, best_of):
+    """Single-flight key: every parameter that changes the generated result"""
+    return (str(word), str(hsk_level), str(system_language), bool(validate), bool(retry_on_invalid), int(best_of))
+
+def request_words(data):
+    """Words of a batch request: cards ({hanzi, ...}) and/or a plain word list, without empty values and duplicates.
+    
+    Returns (words, None) or (None, error message for a 400 response).
+    """
+    cards = data.get('cards') or []
+    words = data.get('words') or []
+    if not isinstance(cards, list) or not all(isinstance(card, dict) for card in cards):
+        return None, "Parameter 'cards' must be a list of objects"
+    if not isinstance(words, list) or not all(isinstance(word, str) for word in words):
+        return None, "Parameter 'words' must be a list of strings"
+    card_words = [card.get('hanzi') or card.get('word') for card in cards]
+    if not all(isinstance(word, str) and word.strip() for word in card_words):
+        return None, "Every card must have a non-empty string 'hanzi' or 'word'"
+    return list(dict.fromkeys(word for word in card_words + words if word)), None
+
+def int_param(data, name, default, minimum):
+    """Integer request parameter of at least minimum; None if the value is invalid"""
+    value = data.get(name)
+    if value is None:
+        return default
+    if isinstance(value, bool) or not isinstance(value, (int, str)) or not str(value).isdigit() \
+            or int(value) < minimum:
+        return None
+    return int(value)
+
+def cached_exercise(word, hsk_level, system_language, validate):
+    """Stored exercise for a request; an unvalidated entry does not answer a request that asks for validation"""
+    cached = exercise_store.get(word, hsk_level, system_language)
+    if cached is None or (validate and validator_enabled and "validation" not in cached):
+        return None
+    return cached
+
+def store_exercise(word, hsk_level, system_language, result):
+    """Store only real LM results that passed validation (or were not validated); returns whether it was stored"""
+    if is_fallback_result(result, word) or "validation_error" in result:
+        return False
+    # The store key has no validation mode, so while the validator is up only validated results go in
+    if validator_enabled and "validation" not in result:
+        return False
+    if not result.get("validation", {}).get("is_valid", True):
+        return False
+    try:
+        exercise_store.put(word, hsk_level, system_language, result)
+        return True
+    except Exception as e:
+        logging.error(f"Failed to store exercise for '{word}': {e}", exc_info=True)
+        return False
+
+def validation_summary(validation_result):
+    """Validation fields returned to the client"""
+    return {
+        "is_valid": validation_result.get("is_valid", True),
+        "confidence": float(validation_result.get("confidence", 0.0)),
+        "semantic_score": float(validation_result.get("semantic_score", 0.0)),
+        "distractor_score": float(validation_result.get("distractor_score", 0.0)),
+        "option_scores": validation_result.get("option_scores", {})
+    }
+
+def generate_best_of_n(word, hsk_level, system_language, n, temperature=0.9):
+    """Generate n candidates concurrently and return the one with the highest validator confidence.
+    
+    Replaces the sequential regenerate-and-revalidate loop: tail latency is one
+    generation round plus one validation pass over all candidates.
+    """
+    logging.info(f"Generating {n} candidates for word: {word}, HSK: {hsk_level}, Language: {system_language}")
+    messages = build_exercise_messages(word, hsk_level, system_language)
+    
+    try:
+        pool = get_lm_pool()
+        responses = pool.run(generate_completions_async(
+            [messages] * n, temperature,
+            max_tokens=token_budget.budget(hsk_level, system_language),
+            response_format=exercise_response_format() if STRUCTURED_OUTPUT else None,
+            stop=EXERCISE_STOP,
+            budget_key=(hsk_level, system_language)
+        ))
+    except Exception as e:
+        logging.error(f"Concurrent candidate generation failed: {e}", exc_info=True)
+        responses = []
+    
+    candidates = []
+    for content, used_model in responses:
+        if content is None:
+            continue
+        candidate = parse_exercise(content, word, extract_exercise_data, parse_stats)
+        if 'error' in candidate:
+            continue
+        candidate["generated_with"] = used_model
+        supplement_with_translator(candidate, word, system_language)
+        candidates.append(candidate)
+    
+    if not candidates:
+        logging.error("No candidate could be generated. Using fallback approach.")
+        return generate_exercise_fallback(word, hsk_level, system_language)
+    
+    try:
+        validations = validator.validate_exercises(candidates)
+    except Exception as e:
+        logging.error(f"Validation error: {str(e)}", exc_info=True)
+        candidates[0]["validation_error"] = str(e)
+        return candidates[0]
+    
+    best_index = max(range(len(candidates)), key=lambda i: validations[i].get("confidence", 0.0))
+    result = candidates[best_index]
+    result["validation"] = validation_summary(validations[best_index])
+    result["validation"]["candidates"] = len(candidates)
+    
+    logging.info(
+        f"Best-of-{n} for '{word}': candidate {best_index + 1}/{len(candidates)} selected, "
+        f"confidences: {[round(v.get('confidence', 0.0), 4) for v in validations]}"
+    )
+    return result
+
+def pregenerate_exercise(word, hsk_level, system_language, best_of=1):
+    """Generate, validate and store one exercise for offline pre-generation; returns a STATUS_* value"""
+    if best_of > 1 and validator_enabled:
+        result = generate_best_of_n(word, hsk_level, system_language, best_of)
+    else:
+        result = generate_exercise_with_word(word, hsk_level, system_language)
+        if 'error' not in result and validator_enabled:
+            try:
+                result["validation"] = validation_summary(validator.validate_exercise(result))
+            except Exception as e:
+                logging.error(f"Validation error for '{word}': {str(e)}", exc_info=True)
+                return STATUS_FAILED
+    
+    if is_fallback_result(result, word) or "validation_error" in result:
+        return STATUS_FAILED
+    if not result.get("validation", {}).get("is_valid", True):
+        return STATUS_REJECTED
+    # Only a stored exercise lets the checkpoint mark the word as done
+    if not store_exercise(word, hsk_level, system_language, result):
+        return STATUS_FAILED
+    return STATUS_STORED
+
+def pregenerate_word_list(path, hsk_level, languages, concurrency=4, best_of=1, checkpoint_path=None):
+    """Run offline pre-generation for a word list and print a throughput summary"""
+    words = load_word_list(path)
+    checkpoint = PregenerationCheckpoint(checkpoint_path or f"{path}.hsk{hsk_level}.checkpoint.json")
+    print(f"Pre-generating exercises for {len(words)} words (HSK {hsk_level}, languages: {','.join(languages)})")
+    print(f"Checkpoint file: {checkpoint.path}")
+    
+    summary = run_pregeneration(
+        words, hsk_level, languages,
+        generate_one=lambda word, hsk, lang: pregenerate_exercise(word, hsk, lang, best_of),
+        is_stored=exercise_store.contains,
+        concurrency=concurrency,
+        checkpoint=checkpoint
+    )
+    print(format_summary(summary))
+    print(f"- LM pool: {get_lm_pool().stats()}")
+    print(f"- Parsing: {parse_stats.stats()}")
+    return summary
+
+def generate_exercise_with_word(word, hsk_level, system_language, temperature=0.7):
+    """Generate exercise using the given word"""
+    try:
+        logging.info(f"Generating exercise for word: {word}, HSK: {hsk_level}, Language: {system_language}")
+        
+        # Проверим, инициализирован ли клиент LM Studio
+        if lm_client is None:
+            logging.error("LM Studio client is not initialized")
+            logging.info("Trying to initialize LM Studio client")
+            if not initialize_lm_client():
+                logging.error("Failed to initialize LM Studio client. Using fallback approach.")
+                return generate_exercise_fallback(word, hsk_level, system_language)
+        
+        messages = build_exercise_messages(word, hsk_level, system_language)
+        # Ограничиваем количество токенов для ускорения ответа
+        # Budget learned from earlier responses for this HSK level and language; stop right after the JSON object
+        content, used_model = request_completion(
+            messages, temperature,
+            max_tokens=token_budget.budget(hsk_level, system_language),
+            response_format=exercise_response_format() if STRUCTURED_OUTPUT else None,
+            stop=EXERCISE_STOP,
+            budget_key=(hsk_level, system_language)
+        )
         
         # Если не удалось получить ответ, используем запасной вариант
         if content is None:
@@ -645,44 +959,15 @@ def generate_exercise_with_word(word, hsk_level, system_language, temperature=0.
         logging.info("Model response received successfully")
         logging.debug(f"Response: {content[:200]}...")
         
-        # Extract JSON from model response
-        result = extract_exercise_data(content, word)
+        # Extract JSON from model response (schema-conforming output parses directly)
+        result = parse_exercise(content, word, extract_exercise_data, parse_stats)
         
         # Add information about the model used
         if used_model:
             result["generated_with"] = used_model
         
         # Try to supplement missing translation or pinyin using translator
-        if translator_enabled and result:
-            if not result.get("pinyin") or not result.get("translation"):
-                chinese_sentence = result.get("sentence_with_gap", "").replace("____", word)
-                if chinese_sentence:
-                    # Get missing data from translator
-                    logging.info("Supplementing data using translator")
-                    
-                    # Determine target language
-                    target_lang = "en"
-                    if system_language == "ru":
-                        target_lang = "ru"
-                    
-                    trans_result = translator.process_text(
-                        chinese_sentence, 
-                        "zh", 
-                        target_lang,
-                        need_pinyin=True
-                    )
-                    
-                    # Add missing data if needed
-                    if not result.get("pinyin") and trans_result.get("pinyin"):
-                        result["pinyin"] = trans_result["pinyin"]
-                        logging.info("Added pinyin from translator")
-                        
-                    if not result.get("translation") and target_lang == "ru" and trans_result.get("russian"):
-                        result["translation"] = trans_result["russian"]
-                        logging.info("Added Russian translation from translator")
-                    elif not result.get("translation") and target_lang == "en" and trans_result.get("english"):
-                        result["translation"] = trans_result["english"]
-                        logging.info("Added English translation from translator")
+        supplement_with_translator(result, word, system_language)
         
         return result
         
@@ -690,6 +975,249 @@ def generate_exercise_with_word(word, hsk_level, system_language, temperature=0.
         logging.error(f"Error generating exercise: {str(e)}", exc_info=True)
         return generate_exercise_fallback(word, hsk_level, system_language)
 
+def supplement_with_translator(result, word, system_language):
+    """Fill missing pinyin or translation of an exercise using the Helsinki-NLP translator"""
+    if translator_enabled and result:
+        if not result.get("pinyin") or not result.get("translation"):
+            chinese_sentence = result.get("sentence_with_gap", "").replace("____", word)
+            if chinese_sentence:
+                # Get missing data from translator
+                logging.info("Supplementing data using translator")
+                
+                # Determine target language
+                target_lang = "en"
+                if system_language == "ru":
+                    target_lang = "ru"
+                
+                trans_result = translator.process_text(
+                    chinese_sentence, 
+                    "zh", 
+                    target_lang,
+                    need_pinyin=True
+                )
+                
+                # Add missing data if needed
+                if not result.get("pinyin") and trans_result.get("pinyin"):
+                    result["pinyin"] = trans_result["pinyin"]
+                    logging.info("Added pinyin from translator")
+                    
+                if not result.get("translation") and target_lang == "ru" and trans_result.get("russian"):
+                    result["translation"] = trans_result["russian"]
+                    logging.info("Added Russian translation from translator")
+                elif not result.get("translation") and target_lang == "en" and trans_result.get("english"):
+                    result["translation"] = trans_result["english"]
+                    logging.info("Added English translation from translator")
+    return result
+
+async def request_completion_async(messages, temperature=0.7, max_tokens=600, response_format=None,
+                                   stop=None, budget_key=None):
+    """Send a chat completion through the shared pool, trying known models in order.
+    
+    Returns (content, used_model); content is None when every model failed.
+    Many of these coroutines can run concurrently on the pool's event loop.
+    If the server rejects response_format, the request is repeated without it.
+    With budget_key=(hsk_level, system_language) the completion length is
+    recorded in token_budget.
+    """
+    global structured_output_supported
+    pool = get_lm_pool()
+    payload = {
+        "messages": messages,
+        "temperature": temperature,
+        "max_tokens": max_tokens,
+        "top_p": 0.95
+    }
+    if response_format is not None and structured_output_supported:
+        payload["response_format"] = response_format
+    if stop:
+        payload["stop"] = stop
+    
+    # The registry puts models known to be loaded first, so normally only one request is made
+    for model in model_registry.candidates():
+        start_time = time.time()
+        try:
+            logging.info(f"Using model: {model}")
+            try:
+                response = await pool.chat_completion(dict(payload, model=model), timeout=90)
+            except LMRequestError as schema_error:
+                if not is_response_format_rejected(schema_error) or "response_format" not in payload:
+                    raise
+                # Старые версии LM Studio не поддерживают json_schema - больше его не отправляем
+                logging.warning(f"LM Studio rejected response_format, falling back to free-form JSON: {schema_error}")
+                structured_output_supported = False
+                parse_stats.record("schema_rejected")
+                del payload["response_format"]
+                response = await pool.chat_completion(dict(payload, model=model), timeout=90)
+            content = response["choices"][0]["message"]["content"]
+            if stop == EXERCISE_STOP:
+                # The server drops the stop sequence itself, put the closing brace back
+                content = restore_json_end(content)
+            if budget_key is not None:
+                token_budget.record_response(*budget_key, response)
+            model_registry.record_success(model, time.time() - start_time)
+            logging.info(f"Successfully generated completion using model {model}")
+            return content, model
+        except LMRequestError as model_error:
+            model_registry.record_failure(model, time.time() - start_time)
+            logging.error(f"HTTP request failed for model {model}: {model_error}")
+        except Exception as model_error:
+            model_registry.record_failure(model, time.time() - start_time)
+            logging.error(f"Error with model {model}: {model_error}")
+    
+    return None, None
+
+def request_completion(messages, temperature=0.7, max_tokens=600, response_format=None, stop=None, budget_key=None):
+    """Blocking wrapper around request_completion_async for Flask request threads"""
+    try:
+        logging.info(f"Using pooled HTTP request to {LM_STUDIO_URL}/v1/chat/completions")
+        pool = get_lm_pool()
+        return pool.run(request_completion_async(
+            messages, temperature, max_tokens, response_format, stop, budget_key
+        ))
+    except Exception as http_error:
+        logging.error(f"All HTTP requests failed: {http_error}", exc_info=True)
+        return None, None
+
+async def generate_completions_async(message_batches, temperature=0.7, max_tokens=600, response_format=None,
+                                     stop=None, budget_key=None):
+    """Run several chat completions concurrently; returns a list of (content, used_model)"""
+    return await asyncio.gather(*[
+        request_completion_async(messages, temperature, max_tokens, response_format, stop, budget_key)
+        for messages in message_batches
+    ])
+
+def _prepend_delta(first, deltas, model, start_time):
+    """Stream of fragments starting with an already read one; closing it aborts the LM request.
+    
+    The model latency is recorded when the stream ends, so it covers the whole
+    completion and is comparable with non-streaming requests.
+    """
+    failed = False
+    try:
+        yield first
+        yield from deltas
+    except Exception:
+        failed = True
+        model_registry.record_failure(model, time.time() - start_time)
+        raise
+    finally:
+        deltas.close()
+        if not failed:
+            model_registry.record_success(model, time.time() - start_time)
+
+def open_completion_stream(messages, temperature=0.7, max_tokens=600, response_format=None, stop=None):
+    """Open a streaming chat completion through the shared pool, trying known models in order.
+    
+    Returns (used_model, deltas), where deltas yields content fragments as they are
+    decoded; (None, None) when every model failed. Closing deltas aborts the request.
+    """
+    global structured_output_supported
+    pool = get_lm_pool()
+    payload = {
+        "messages": messages,
+        "temperature": temperature,
+        "max_tokens": max_tokens,
+        "top_p": 0.95
+    }
+    if response_format is not None and structured_output_supported:
+        payload["response_format"] = response_format
+    if stop:
+        payload["stop"] = stop
+    
+    for model in model_registry.candidates():
+        start_time = time.time()
+        deltas = pool.iter_stream(dict(payload, model=model), timeout=90)
+        try:
+            # Ошибка HTTP проявляется только при чтении первого фрагмента
+            try:
+                first = next(deltas)
+            except LMRequestError as schema_error:
+                if not is_response_format_rejected(schema_error) or "response_format" not in payload:
+                    raise
+                logging.warning(f"LM Studio rejected response_format, falling back to free-form JSON: {schema_error}")
+                structured_output_supported = False
+                parse_stats.record("schema_rejected")
+                del payload["response_format"]
+                deltas = pool.iter_stream(dict(payload, model=model), timeout=90)
+                first = next(deltas)
+        except StopIteration:
+            return model, iter(())
+        except Exception as model_error:
+            model_registry.record_failure(model, time.time() - start_time)
+            logging.error(f"Streaming request failed for model {model}: {model_error}")
+            continue
+        logging.info(f"Streaming completion using model {model}")
+        return model, _prepend_delta(first, deltas, model, start_time)
+    
+    return None, None
+
+def stream_exercise_events(word, hsk_level, system_language, validate=True, use_cache=True, temperature=0.7):
+    """Generate SSE events for an exercise while the model is still writing it.
+    
+    Every JSON field (sentence_with_gap, options, pinyin, translation, ...) is sent as
+    a "field" event as soon as it is complete; the fully post-processed exercise is
+    sent as the final "result" event (or "error"). No regeneration happens in
+    streaming mode because the fields have already reached the client.
+    """
+    if use_cache:
+        cached = cached_exercise(word, hsk_level, system_language, validate)
+        if cached is not None:
+            cached["cached"] = True
+            for field, value in cached.items():
+                yield format_sse("field", {"field": field, "value": value})
+            yield format_sse("result", cached)
+            return
+    
+    try:
+        logging.info(f"Streaming exercise for word: {word}, HSK: {hsk_level}, Language: {system_language}")
+        messages = build_exercise_messages(word, hsk_level, system_language)
+        used_model, deltas = open_completion_stream(
+            messages, temperature,
+            max_tokens=token_budget.budget(hsk_level, system_language),
+            response_format=exercise_response_format() if STRUCTURED_OUTPUT else None,
+            stop=EXERCISE_STOP
+        )
+        
+        if deltas is None:
+            logging.error("Failed to open completion stream. Using fallback approach.")
+            yield format_sse("result", generate_exercise_fallback(word, hsk_level, system_language))
+            return
+        
+        parser = IncrementalFieldParser()
+        for delta in deltas:
+            for field, value in parser.feed(delta):
+                yield format_sse("field", {"field": field, "value": value})
+            if parser.done:
+                # The JSON object is complete: stop decoding whatever the model adds after it
+                deltas.close()
+                break
+        
+        # Post-process the full response the same way as the non-streaming path
+        result = parse_exercise(restore_json_end(parser.buffer), word, extract_exercise_data, parse_stats)
+        result["generated_with"] = used_model
+        supplement_with_translator(result, word, system_language)
+        
+        if validate and validator_enabled:
+            try:
+                validation_result = validator.validate_exercise(result)
+                result["validation"] = {
+                    "is_valid": validation_result.get("is_valid", True),
+                    "confidence": float(validation_result.get("confidence", 0.0)),
+                    "semantic_score": float(validation_result.get("semantic_score", 0.0)),
+                    "distractor_score": float(validation_result.get("distractor_score", 0.0))
+                }
+            except Exception as e:
+                logging.error(f"Validation error: {str(e)}", exc_info=True)
+                result["validation_error"] = str(e)
+        
+        store_exercise(word, hsk_level, system_language, result)
+        
+        yield format_sse("result", result)
+        
+    except Exception as e:
+        logging.error(f"Error streaming exercise: {str(e)}", exc_info=True)
+        yield format_sse("error", {"error": f"Streaming error: {str(e)}"})
+
 def generate_exercise_fallback(word, hsk_level, system_language):
     """Fallback method to generate a basic exercise when LM Studio is unavailable"""
     logging.info(f"Using fallback method to generate exercise for {word}")
@@ -1128,7 +1656,15 @@ if __name__ == "__main__":
     parser.add_argument("--both", action="store_true", help="Start server and run tests")
     parser.add_argument("--port", type=int, help="Server port (default: 5000)")
     parser.add_argument("--lm-url", type=str, help="LM Studio URL (default: http://localhost:1234)")
+    parser.add_argument("--lm-urls", type=str, help="Comma-separated list of LM backends to balance requests across")
     parser.add_argument("--enable-fallback", action="store_true", help="Enable fallback mode for exercise generation")
+    parser.add_argument("--pregenerate", type=str, metavar="WORDLIST",
+                        help="Generate exercises for every word in WORDLIST into the exercise store and exit")
+    parser.add_argument("--hsk", type=int, default=1, help="HSK level for --pregenerate (default: 1)")
+    parser.add_argument("--lang", type=str, default="ru", help="Comma-separated system languages for --pregenerate (default: ru)")
+    parser.add_argument("--concurrency", type=int, default=4, help="Parallel generations for --pregenerate (default: 4)")
+    parser.add_argument("--best-of", type=int, default=1, help="Candidates per exercise for --pregenerate (default: 1)")
+    parser.add_argument("--checkpoint", type=str, help="Checkpoint file for --pregenerate (default: next to WORDLIST)")
     
     args = parser.parse_args()
     
@@ -1139,7 +1675,13 @@ if __name__ == "__main__":
         
     if args.lm_url:
         LM_STUDIO_URL = args.lm_url
+        LM_STUDIO_URLS = ""
         print(f"LM Studio URL set to: {LM_STUDIO_URL}")
+    
+    if args.lm_urls:
+        LM_STUDIO_URLS = args.lm_urls
+        LM_STUDIO_URL = lm_backend_urls()[0]
+        print(f"LM backends set to: {lm_backend_urls()}")
 
     # Устанавливаем режим fallback, если указан соответствующий флаг
     ENABLE_FALLBACK = args.enable_fallback
@@ -1153,6 +1695,20 @@ if __name__ == "__main__":
         if not ENABLE_FALLBACK:
             logging.warning("Fallback mode not enabled - exercise generation may fail completely")
     
+    if args.pregenerate:
+        # Offline mode: fill the exercise store and exit without starting the server
+        languages = [lang.strip() for lang in args.lang.split(",") if lang.strip()]
+        pregenerate_word_list(
+            args.pregenerate, args.hsk, languages,
+            concurrency=max(1, args.concurrency),
+            best_of=min(max(1, args.best_of), MAX_BEST_OF),
+            checkpoint_path=args.checkpoint
+        )
+        sys.exit(0)
+    
+    # Reload the hottest stored exercises into memory before serving traffic
+    exercise_store.warm_up(int(os.environ.get("EXERCISE_STORE_WARMUP", 500)))
+    
     # Get local IP for mobile device connections
     local_ip = get_local_ip()
     
@@ -0,0 +1,142 @@
+"""
+Проверка паритета квантованных бэкендов валидатора с исходной моделью fp32.
+
+На фиксированном наборе упражнений сравниваются confidence, semantic_score и
+distractor_score бэкенда (torch-int8, onnx-int8) с бэкендом torch, а также
+совпадение решения is_valid и время проверки набора.
+
+Использование:
+  python test_validator_parity.py                          # оба квантованных бэкенда
+  python test_validator_parity.py --backend onnx-int8 --tolerance 0.03
+  python test_validator_parity.py --calibrate              # проверка порогов валидатора на наборе
+"""
+import argparse
+import logging
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+from tabulate import tabulate
+
+script_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(script_dir, 'app'))
+
+from validator import ContentValidator, VALID_CONFIDENCE_THRESHOLD, SEMANTIC_HINT_THRESHOLD
+from validator_backends import BACKEND_TORCH, BACKEND_TORCH_INT8, BACKEND_ONNX_INT8
+
+logging.basicConfig(level=logging.WARNING,
+                   format='%(asctime)s - %(levelname)s - %(message)s',
+                   stream=sys.stdout)
+
+METRICS = ["confidence", "semantic_score", "distractor_score"]
+
+# Фиксированный набор упражнений разных уровней HSK
+PARITY_EXERCISES = [
+    {"sentence_with_gap": "我每天早上都____一杯咖啡。", "options": ["喝", "吃", "看", "写"], "answer": "喝", "pinyin": "hē"},
+    {"sentence_with_gap": "他在____学习汉语。", "options": ["大学", "苹果", "天气", "衣服"], "answer": "大学", "pinyin": "dàxué"},
+    {"sentence_with_gap": "今天的天气很____。", "options": ["好", "书", "跑", "桌子"], "answer": "好", "pinyin": "hǎo"},
+    {"sentence_with_gap": "我想去商店____一些水果。", "options": ["买", "卖", "睡", "听"], "answer": "买", "pinyin": "mǎi"},
+    {"sentence_with_gap": "这个问题太____了，我不会做。", "options": ["难", "高", "快", "红"], "answer": "难", "pinyin": "nán"},
+    {"sentence_with_gap": "请把窗户____，外面太冷了。", "options": ["关上", "打开", "吃完", "看见"], "answer": "关上", "pinyin": "guānshang"},
+    {"sentence_with_gap": "我们公司的____非常快。", "options": ["发展", "电脑", "医生", "游泳"], "answer": "发展", "pinyin": "fāzhǎn"},
+    {"sentence_with_gap": "他的电脑坏了，需要换一个新的____。", "options": ["服务器", "朋友", "米饭", "杯子"], "answer": "服务器", "pinyin": "fúwùqì"},
+    {"sentence_with_gap": "她长得很____。", "options": ["美丽", "学习", "电脑", "发展"], "answer": "美丽", "pinyin": "měilì"},
+    {"sentence_with_gap": "经过努力，他终于____了自己的目标。", "options": ["实现", "实践", "发现", "出现"], "answer": "实现", "pinyin": "shíxiàn"},
+]
+
+
+def timed_validation(validator, exercises):
+    """Результаты проверки набора и время второго прогона (первый - прогрев)"""
+    validator.validate_exercises(exercises)
+    start_time = time.time()
+    results = validator.validate_exercises(exercises)
+    return results, time.time() - start_time
+
+
+def compare(reference_results, results):
+    """Максимальные расхождения метрик и число упражнений с другим решением is_valid"""
+    max_diffs = {metric: max(abs(ref.get(metric, 0.0) - res.get(metric, 0.0))
+                             for ref, res in zip(reference_results, results))
+                 for metric in METRICS}
+    disagreements = sum(ref["is_valid"] != res["is_valid"] for ref, res in zip(reference_results, results))
+    return max_diffs, disagreements
+
+
+def swapped_exercises(exercises):
+    """Заведомо неверные упражнения: правильным ответом объявлен первый дистрактор"""
+    return [dict(exercise, answer=next(option for option in exercise["options"] if option != exercise["answer"]))
+            for exercise in exercises]
+
+
+def calibration_report(validator):
+    """
+    Распределение semantic_score и confidence на наборе: исходные упражнения
+    должны приниматься, упражнения с подмененным ответом - отклоняться
+    """
+    rows = []
+    for label, exercises in [("верные", PARITY_EXERCISES), ("подмененный ответ", swapped_exercises(PARITY_EXERCISES))]:
+        results = validator.validate_exercises(exercises)
+        semantic = [result.get("semantic_score", 0.0) for result in results]
+        confidence = [result.get("confidence", 0.0) for result in results]
+        rows.append([label,
+                     f"{min(semantic):.3f} / {np.median(semantic):.3f} / {max(semantic):.3f}",
+                     f"{min(confidence):.3f} / {np.median(confidence):.3f} / {max(confidence):.3f}",
+                     f"{sum(result['is_valid'] for result in results)}/{len(results)}",
+                     f"{sum(score < SEMANTIC_HINT_THRESHOLD for score in semantic)}/{len(results)}"])
+    print(tabulate(rows, headers=["Упражнения", "semantic_score min/med/max", "confidence min/med/max",
+                                  f"is_valid (> {VALID_CONFIDENCE_THRESHOLD})",
+                                  f"подсказка (< {SEMANTIC_HINT_THRESHOLD})"], tablefmt="grid"))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Validator backend parity check")
+    parser.add_argument("--backend", type=str, default=f"{BACKEND_TORCH_INT8},{BACKEND_ONNX_INT8}",
+                        help="Comma-separated backends to compare with torch fp32")
+    parser.add_argument("--tolerance", type=float, default=0.05,
+                        help="Maximum allowed absolute difference of each metric (default: 0.05)")
+    parser.add_argument("--calibrate", action="store_true",
+                        help="Only report how the validator thresholds split the set with the fp32 model")
+    args = parser.parse_args()
+
+    # Эмбеддинги считаются заново, а не берутся из дискового кэша
+    os.environ["VALIDATOR_EMBEDDING_CACHE"] = os.path.join(tempfile.mkdtemp(), "option_embeddings")
+
+    reference = ContentValidator(backend=BACKEND_TORCH)
+    if args.calibrate:
+        calibration_report(reference)
+        return
+    reference_results, reference_time = timed_validation(reference, PARITY_EXERCISES)
+    print(f"{BACKEND_TORCH}: {len(PARITY_EXERCISES)} упражнений за {reference_time:.3f} сек")
+
+    passed = True
+    for backend in [name.strip() for name in args.backend.split(",") if name.strip()]:
+        validator = ContentValidator(backend=backend)
+        if validator.encoder is None or validator.encoder.name != backend:
+            print(f"\n{backend}: бэкенд недоступен, проверка пропущена")
+            passed = False
+            continue
+        results, elapsed = timed_validation(validator, PARITY_EXERCISES)
+
+        rows = []
+        for exercise, ref, res in zip(PARITY_EXERCISES, reference_results, results):
+            rows.append([exercise["sentence_with_gap"]]
+                        + [f"{ref.get(metric, 0.0):.3f} / {res.get(metric, 0.0):.3f}" for metric in METRICS]
+                        + ["да" if ref["is_valid"] == res["is_valid"] else "НЕТ"])
+        print(f"\n{backend} (fp32 / {backend})")
+        print(tabulate(rows, headers=["Предложение"] + METRICS + ["is_valid совпадает"], tablefmt="grid"))
+
+        max_diffs, disagreements = compare(reference_results, results)
+        backend_passed = all(diff <= args.tolerance for diff in max_diffs.values())
+        passed = passed and backend_passed
+        print(", ".join(f"max |Δ{metric}| = {diff:.4f}" for metric, diff in max_diffs.items()))
+        print(f"Расхождений is_valid: {disagreements}/{len(PARITY_EXERCISES)}; "
+              f"время {elapsed:.3f} сек (ускорение x{reference_time / elapsed:.2f}); "
+              f"{'паритет соблюден' if backend_passed else 'ПРЕВЫШЕН ДОПУСК'} ({args.tolerance})")
+
+    sys.exit(0 if passed else 1)
+
+
+if __name__ == "__main__":
+    main()